@@ -1,16 +1,18 @@
 import subprocess, time, os
 
+# The recognizers loading models start first: they load them while KSIM and FUSION start, and retry connecting until
+# they are listening, see components.fusion.conf.startup
+print("starting BODY")
+body = os.system(r"start cmd /c python -m components.skeletonRecognition.skeleton_client")
+print("starting Hands")
+RH = os.system(r"start cmd /c python -m components.handRecognition.depth_client")
 print("starting KSIM")
 ksim = subprocess.Popen(r"..\KSIM\KSIM\bin\x86\Release\KSIM.exe")
-time.sleep(1)
 print("starting FUSION")
 fusion = os.system(r"start cmd /c python -m components.fusion.fusion_server --mode brandeis")
+# The clients without models connect right away
 time.sleep(1)
-print("starting BODY")
-body = os.system(r"start cmd /c python -m components.skeletonRecognition.skeleton_client")
 print("starting SPEECH")
 speech = os.system(r"start cmd /c python -m components.speech.speech_client")
 print("starting EMOTION")
 speech = os.system(r"start cmd /c python -m components.emotion.emotion_client")
-print("starting Hands")
-RH = os.system(r"start cmd /c python -m components.handRecognition.depth_client")
\ No newline at end of file
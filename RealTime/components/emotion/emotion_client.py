@@ -4,7 +4,9 @@ import socket
 
 from components.fusion.conf.endpoints import connect
 from components.fusion.conf import decode
+from components.fusion.conf.reader import FrameReader
 from components.fusion.conf import streams
+from components.fusion.conf import codecs
 # Timestamp | frame type | command_length | command
 
 def decode_content(raw_frame, offset):
@@ -42,13 +44,16 @@ if __name__ == '__main__':
     kinect_socket = connect('kinect', args.kinect_host, 'Face')
     if kinect_socket is None:
         sys.exit(0)
+
+    kinect_reader = FrameReader(kinect_socket, size=1024)
         
     emotion_frame_id = streams.get_stream_id("Emotion")
+    emotion_encoder = codecs.get_codec(emotion_frame_id).encoder()
     fusion_socket = connect('fusion', args.fusion_host, 'Emotion') if args.fusion_host is not None else None
 
     while True:
         try:
-            (timestamp, _), (FaceFound, Engaged, LookinAway, WearingGlasses, Pitch, Yaw, Roll), _ = decode.read_frame(kinect_socket, decode_content)
+            (timestamp, _), (FaceFound, Engaged, LookinAway, WearingGlasses, Pitch, Yaw, Roll), _ = decode.read_frame(kinect_reader, decode_content)
         except socket.error:
             print("Unable to receive speech frame")
             break
@@ -70,8 +75,7 @@ if __name__ == '__main__':
 
         if fusion_socket is not None:
             try:
-                raw_data = struct.pack("<iqif" , emotion_frame_id, timestamp, att, prob)
-                fusion_socket.sendall(struct.pack("<i", len(raw_data)))
+                raw_data = emotion_encoder.encode(emotion_frame_id, timestamp, att, prob)
                 fusion_socket.sendall(raw_data)
             except socket.error:
                 print("Error: Connection to fusion lost")
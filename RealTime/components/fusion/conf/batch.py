@@ -0,0 +1,214 @@
+import struct
+
+# Registration flag asking fusion to accept batched framing on the connection
+BATCHED = 0x1
+
+# A batch is a single frame holding several messages, each one prefixed by its size as in the plain framing
+# size (int) | message count (int) | size (int) | message | size (int) | message | ...
+_frame_size = struct.Struct("<i")
+_batch_header = struct.Struct("<ii")
+
+
+class BatchWriter:
+    """
+    Coalesces the messages sent to fusion into batches, written with a single sendall().
+    With plain framing, when fusion did not accept batching, the messages are still written together, but fusion
+    reads them one at a time.
+    """
+
+    def __init__(self, sock, batched=True, max_messages=None, size=4096):
+        """
+        :param sock: Socket connected to fusion
+        :param batched: True if fusion accepted batched framing on this connection
+        :param max_messages: Number of messages after which add() flushes the batch, None to only flush explicitly
+        :param size: Initial size of the buffer in bytes, the buffer grows on demand
+        """
+        self.sock = sock
+        self.batched = batched
+        self.max_messages = max_messages
+        self._buffer = bytearray(size)
+        self._start = _batch_header.size if batched else 0
+        self._offset = self._start
+        self._count = 0
+
+    def _reserve(self, size):
+        if self._offset + size > len(self._buffer):
+            buffer = bytearray(max(self._offset + size, 2 * len(self._buffer)))
+            buffer[:self._offset] = self._buffer[:self._offset]
+            self._buffer = buffer
+
+    def _added(self):
+        self._count += 1
+        if self.max_messages is not None and self._count >= self.max_messages:
+            self.flush()
+
+    def add(self, message):
+        """
+        Add a message to the batch
+        :param message: Message prefixed by its size, e.g. from an Encoder
+        """
+        size = len(message)
+        self._reserve(size)
+        self._buffer[self._offset:self._offset + size] = message
+        self._offset += size
+        self._added()
+
+    def pack(self, codec, stream_id, timestamp, *content):
+        """
+        Pack a message into the batch in place
+        :param codec: Codec of the stream, from codecs
+        """
+        self._reserve(_frame_size.size + codec.message_size(*content))
+        self._offset = codec.pack_into(self._buffer, self._offset, stream_id, timestamp, *content)
+        self._added()
+
+    def flush(self):
+        """
+        Send the pending messages with a single sendall()
+        """
+        if self._count == 0:
+            return
+        if self.batched:
+            _batch_header.pack_into(self._buffer, 0, self._offset - _frame_size.size, self._count)
+        self.sock.sendall(memoryview(self._buffer)[:self._offset])
+        self._offset = self._start
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+
+def iter_messages(frame):
+    """
+    Split a batch, in one pass and without copying
+    :param frame: Batch excluding its size field
+    :return: generator of the messages of the batch, excluding their size fields
+    """
+    (count,) = struct.unpack_from("<i", frame)
+    offset = _frame_size.size
+    for _ in range(count):
+        (size,) = _frame_size.unpack_from(frame, offset)
+        offset += _frame_size.size
+        yield frame[offset:offset + size]
+        offset += size
+    if offset != len(frame):
+        raise struct.error("Batch of {} messages has {} trailing bytes".format(count, len(frame) - offset))
+
+
+if __name__ == '__main__':
+    # Benchmark of the framing modes at 30 Hz with 6 streams over loopback TCP, counting the send and receive
+    # syscalls and measuring the latency from the start of each frame until fusion decoded its message.
+    # Run as: python -m components.fusion.conf.batch [--help]
+    import argparse
+    import random
+    import socket
+    import threading
+    import time
+
+    from . import codecs, streams
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', default=30.0, type=float, help='frames per second')
+    parser.add_argument('--duration', default=5.0, type=float, help='seconds of sending')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    names = ["LH", "RH", "Body", "Speech", "Emotion", "Head"]
+    contents = {
+        "LH": (3,) + tuple(rng.random() for _ in range(codecs.get_codec_by_name("LH").content.size // 4 - 1)),
+        "RH": (5,) + tuple(rng.random() for _ in range(codecs.get_codec_by_name("RH").content.size // 4 - 1)),
+        "Body": (1, 2) + tuple(rng.random() for _ in range(24)) + (1,),
+        "Speech": (b"put that there",),
+        "Emotion": (2, 0.5),
+        "Head": (1,) + tuple(rng.random() for _ in range(codecs.get_codec_by_name("Head").content.size // 4 - 1)),
+    }
+    # Head has no stream id, it is sent with the id 0
+    stream_ids = {name: streams.get_stream_id(name) if streams.is_valid(name) else 0 for name in names}
+
+    def ticks():
+        # 100 ns ticks, as Kinect timestamps
+        return int(time.perf_counter() * 1e7)
+
+    def serve_once(listen_sock, recvs, latencies, batched):
+        # Read like fusion: the size field, then the frame, each with as many recv_into() as needed
+        conn, _ = listen_sock.accept()
+        size_field = bytearray(4)
+
+        def read_exactly(buffer):
+            view = memoryview(buffer)
+            while len(view) > 0:
+                n = conn.recv_into(view)
+                recvs[0] += 1
+                if n == 0:
+                    return False
+                view = view[n:]
+            return True
+
+        while read_exactly(size_field):
+            frame = bytearray(_frame_size.unpack(size_field)[0])
+            if not read_exactly(frame):
+                break
+            frame = memoryview(frame)
+            for message in iter_messages(frame) if batched else (frame,):
+                stream_id, timestamp = codecs.header.unpack_from(message)
+                if stream_id != 0:
+                    codecs.get_codec(stream_id).unpack_content_from(message)
+                latencies.append((ticks() - timestamp) / 10000)
+        conn.close()
+
+    def run(label, mode, nodelay):
+        listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_sock.bind(('localhost', 0))
+        listen_sock.listen(1)
+        recvs, latencies = [0], []
+        server = threading.Thread(target=serve_once, args=(listen_sock, recvs, latencies, mode == 'batched'))
+        server.start()
+
+        sock = socket.create_connection(listen_sock.getsockname())
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if nodelay else 0)
+        encoders = {name: codecs.get_codec_by_name(name).encoder() for name in names}
+        writer = BatchWriter(sock)
+        sends = 0
+        count = int(args.duration * args.rate)
+        start = time.perf_counter()
+        for i in range(count):
+            # Every stream of the frame shares its timestamp, taken when the frame starts
+            timestamp = ticks()
+            for name in names:
+                if mode == 'batched':
+                    writer.pack(codecs.get_codec_by_name(name), stream_ids[name], timestamp, *contents[name])
+                    continue
+                message = encoders[name].encode(stream_ids[name], timestamp, *contents[name])
+                if mode == 'split':
+                    # Size field and message written separately, as the recognizers used to
+                    sock.sendall(message[:_frame_size.size])
+                    sock.sendall(message[_frame_size.size:])
+                    sends += 2
+                else:
+                    sock.sendall(message)
+                    sends += 1
+            if mode == 'batched':
+                writer.flush()
+                sends += 1
+            time.sleep(max(0.0, start + (i + 1) / args.rate - time.perf_counter()))
+        elapsed = time.perf_counter() - start
+        sock.close()
+        server.join()
+        listen_sock.close()
+
+        latencies.sort()
+        print("{:26} {:>5} messages | syscalls/s: send {:6.0f} recv {:6.0f} | latency ms: p50 {:6.3f} p99 {:6.3f}"
+              .format(label, len(latencies), sends / elapsed, recvs[0] / elapsed,
+                      latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]))
+
+    print("{} streams at {} Hz for {} s".format(len(names), args.rate, args.duration))
+    run('split writes, Nagle', 'split', False)
+    run('split writes, NODELAY', 'split', True)
+    run('one write/message, NODELAY', 'single', True)
+    run('batched, NODELAY', 'batched', True)
@@ -0,0 +1,272 @@
+import struct
+
+from . import streams
+from .postures import right_hand_postures, head_postures
+
+# Messages sent by the recognizers to fusion are prefixed by their size
+# size (int) | stream id (int) | timestamp (long long) | content
+_frame_size = struct.Struct("<i")
+header = struct.Struct("<iq")
+
+
+class Codec:
+    """
+    Wire format of the messages of a stream sent to fusion, compiled once.
+    Messages are packed into caller provided buffers with pack_into(), or into a reusable buffer with an Encoder,
+    and their content is decoded in place with unpack_content_from().
+    """
+
+    def __init__(self, name, content_format):
+        """
+        :param name: Name of the stream
+        :param content_format: struct format of the content, little endian
+        """
+        self.name = name
+        self.content = struct.Struct("<" + content_format)
+        self.message = struct.Struct("<iq" + content_format)
+        # Size field and message, for the messages of fixed size
+        self.frame = struct.Struct("<iiq" + content_format)
+        self.fixed_size = True
+
+    def message_size(self, *content):
+        """
+        :return: size of the message holding the content, excluding the size field
+        """
+        return self.message.size
+
+    def pack_into(self, buffer, offset, stream_id, timestamp, *content):
+        """
+        Pack a message, prefixed by its size
+        :param buffer: writable buffer with room for at least 4 + message_size(*content) bytes from offset
+        :param offset: Index in buffer where the size field starts
+        :param stream_id: Stream id written in the header
+        :param timestamp: Timestamp written in the header
+        :param content: Values of the content
+        :return: offset of the end of the message
+        """
+        self.frame.pack_into(buffer, offset, self.message.size, stream_id, timestamp, *content)
+        return offset + self.frame.size
+
+    def unpack_content_from(self, frame, offset=header.size):
+        """
+        Decode the content of a message
+        :param frame: Message excluding the size field
+        :param offset: Index in frame where the content starts
+        :return: tuple of the values of the content
+        """
+        return self.content.unpack_from(frame, offset)
+
+    def encoder(self, size=256):
+        """
+        :param size: Initial size of the encoder's buffer in bytes, the buffer grows on demand
+        :return: a new Encoder of messages of this stream
+        """
+        return Encoder(self, size)
+
+
+class SpeechCodec(Codec):
+    """
+    Speech messages hold a variable length ascii command
+    # command length (int) | command (bytes)
+    """
+
+    def __init__(self, name):
+        Codec.__init__(self, name, "i")
+        self.fixed_size = False
+
+    def message_size(self, command):
+        return self.message.size + len(command)
+
+    def pack_into(self, buffer, offset, stream_id, timestamp, command):
+        size = self.message_size(command)
+        _frame_size.pack_into(buffer, offset, size)
+        self.message.pack_into(buffer, offset + _frame_size.size, stream_id, timestamp, len(command))
+        end = offset + _frame_size.size + size
+        buffer[end - len(command):end] = command
+        return end
+
+    def unpack_content_from(self, frame, offset=header.size):
+        (command_length,) = self.content.unpack_from(frame, offset)
+        start = offset + self.content.size
+        return (bytes(frame[start:start + command_length]),)
+
+
+class Encoder:
+    """
+    Packs the messages of a stream into a reusable buffer.
+    A returned view stays valid until the next call of encode().
+    """
+
+    def __init__(self, codec, size=256):
+        self.codec = codec
+        self._view = memoryview(bytearray(max(size, codec.frame.size)))
+        # Messages of fixed size are always the same view
+        self._frame = codec.frame if codec.fixed_size else None
+        self._frame_view = self._view[:codec.frame.size]
+        self._message_size = codec.message.size
+
+    def encode(self, stream_id, timestamp, *content):
+        """
+        Pack a message, prefixed by its size, ready to be sent with a single sendall()
+        :return: memoryview of the message
+        """
+        if self._frame is not None:
+            self._frame.pack_into(self._view, 0, self._message_size, stream_id, timestamp, *content)
+            return self._frame_view
+
+        size = _frame_size.size + self.codec.message_size(*content)
+        if len(self._view) < size:
+            # Reallocate instead of resizing, earlier views may still exist
+            self._view = memoryview(bytearray(max(size, 2 * len(self._view))))
+        self.codec.pack_into(self._view, 0, stream_id, timestamp, *content)
+        return self._view[:size]
+
+
+_codecs_by_name = {
+    # Max index | probabilities of every hand posture
+    "LH": Codec("LH", "i" + "f" * len(right_hand_postures)),
+    "RH": Codec("RH", "i" + "f" * len(right_hand_postures)),
+    # Left max index, right max index
+    # Left point x, y, var_x, var_y, right point x, y, var_x, var_y
+    # 8 probabilities for move left, right, up, down, front, back, still, servo * 2
+    # Engaged (1/0)
+    "Body": Codec("Body", "ii" + "4f" * 2 + "8f" * 2 + "i"),
+    # Max index | probabilities of every head posture
+    "Head": Codec("Head", "i" + "f" * len(head_postures)),
+    "Speech": SpeechCodec("Speech"),
+    # Attentive | probability
+    "Emotion": Codec("Emotion", "if"),
+}
+
+_codecs_by_id = {streams.get_stream_id(name): codec for name, codec in _codecs_by_name.items() if streams.is_valid(name)}
+
+
+def get_codec(stream_id):
+    """
+    :param stream_id: Stream id, as in streams
+    :return: Codec of the stream
+    """
+    try:
+        return _codecs_by_id[stream_id]
+    except KeyError:
+        raise streams.InvalidStreamError("No codec for stream id: {}".format(stream_id))
+
+
+def get_codec_by_name(stream_name):
+    """
+    :param stream_name: Stream name, as in streams
+    :return: Codec of the stream
+    """
+    try:
+        return _codecs_by_name[stream_name]
+    except KeyError:
+        raise streams.InvalidStreamError("No codec for stream: {}".format(stream_name))
+
+
+if __name__ == '__main__':
+    # Round trip checks of every codec, and a benchmark against building the format strings for every message
+    # Run as: python -m components.fusion.conf.codecs
+    import random
+    import time
+
+    rng = random.Random(0)
+
+    def random_content(name):
+        if name in ("LH", "RH"):
+            return (rng.randrange(len(right_hand_postures)),) + tuple(rng.random() for _ in right_hand_postures)
+        if name == "Body":
+            return (rng.randrange(34), rng.randrange(34)) + tuple(rng.random() for _ in range(24)) + (1,)
+        if name == "Head":
+            return (rng.randrange(len(head_postures)),) + tuple(rng.random() for _ in head_postures)
+        if name == "Speech":
+            return (rng.choice([b"", b"yes", b"put that there"]),)
+        if name == "Emotion":
+            return (2, rng.random())
+
+    def legacy_pack(name, stream_id, timestamp, content):
+        if name == "Speech":
+            command, = content
+            raw_data = struct.pack("<iqi" + str(len(command)) + "s", stream_id, timestamp, len(command), command)
+        elif name in ("LH", "RH", "Head"):
+            raw_data = struct.pack("<iqi" + "f" * (len(content) - 1), stream_id, timestamp, *content)
+        elif name == "Body":
+            raw_data = struct.pack("<iqii" + "ffff" * 2 + "ff" * 8 + 'i', stream_id, timestamp, *content)
+        else:
+            raw_data = struct.pack("<iqif", stream_id, timestamp, *content)
+        return struct.pack("<i", len(raw_data)) + raw_data
+
+    def legacy_unpack(name, frame):
+        header_id, ts = struct.unpack_from("<iq", frame)
+        for sname, sid in streams._stream_ids.items():
+            if header_id == sid:
+                break
+        if name == "Speech":
+            command_length = struct.unpack_from("<i", frame, 12)[0]
+            return struct.unpack_from("<" + str(command_length) + "s", frame, 16)
+        if name in ("LH", "RH"):
+            return struct.unpack_from("<" + "i" + "f" * len(right_hand_postures), frame, 12)
+        if name == "Body":
+            return struct.unpack_from("<" + "ii" + "4f" * 2 + "8f" * 2 + "i", frame, 12)
+        return struct.unpack_from("<if", frame, 12)
+
+    def approx_equal(a, b):
+        return len(a) == len(b) and all(abs(x - y) <= 1e-6 * max(1.0, abs(x)) if isinstance(x, float) else x == y
+                                        for x, y in zip(a, b))
+
+    # Round trips, and identical bytes to the format strings used until now
+    for name, codec in _codecs_by_name.items():
+        stream_id = streams.get_stream_id(name) if streams.is_valid(name) else 0
+        encoder = codec.encoder(size=8)
+        for i in range(100):
+            content = random_content(name)
+            message = encoder.encode(stream_id, i, *content)
+            assert bytes(message) == legacy_pack(name, stream_id, i, content), name
+            frame = message[_frame_size.size:]
+            assert _frame_size.unpack_from(message)[0] == len(frame)
+            assert header.unpack_from(frame) == (stream_id, i)
+            assert approx_equal(codec.unpack_content_from(frame), content), name
+            if streams.is_valid(name):
+                assert get_codec(stream_id) is codec
+        # Several messages packed back to back into one buffer
+        buf = bytearray(4096)
+        contents = [random_content(name) for _ in range(5)]
+        end = 0
+        for i, content in enumerate(contents):
+            end = codec.pack_into(buf, end, stream_id, i, *content)
+        offset = 0
+        for content in contents:
+            (size,) = _frame_size.unpack_from(buf, offset)
+            assert approx_equal(codec.unpack_content_from(buf, offset + _frame_size.size + header.size), content)
+            offset += _frame_size.size + size
+        assert offset == end
+    print("Round trips OK for {}".format(", ".join(sorted(_codecs_by_name))))
+
+    count = 20000
+    for name in ("RH", "Body", "Speech", "Emotion"):
+        codec = get_codec_by_name(name)
+        stream_id = streams.get_stream_id(name)
+        content = random_content(name)
+        encoder = codec.encoder()
+
+        start = time.perf_counter()
+        for i in range(count):
+            frame = legacy_pack(name, stream_id, i, content)
+        legacy_encode = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in range(count):
+            legacy_unpack(name, frame[4:])
+        legacy_decode = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(count):
+            message = encoder.encode(stream_id, i, *content)
+        encode = time.perf_counter() - start
+        frame = bytes(message[_frame_size.size:])
+        start = time.perf_counter()
+        for i in range(count):
+            get_codec(header.unpack_from(frame)[0]).unpack_content_from(frame)
+        decode = time.perf_counter() - start
+
+        print("{:8} encode {:6.2f} -> {:6.2f} us/msg | decode {:6.2f} -> {:6.2f} us/msg".format(
+            name, legacy_encode * 1e6 / count, encode * 1e6 / count,
+            legacy_decode * 1e6 / count, decode * 1e6 / count))
@@ -2,29 +2,33 @@ import socket
 import struct
 from collections import namedtuple, abc
 
+from . import batch
+from . import shm
 from . import streams
 
-HostInfo = namedtuple('HostInfo', 'port,can_connect,can_serve')
+# transport is how clients on the same machine send their messages [tcp|shm]
+# With shm, messages go through a shared memory ring, and TCP remains the fallback for remote or older hosts
+# For messages of a few hundred bytes both take about as long, see python -m components.fusion.conf.shm
+HostInfo = namedtuple('HostInfo', 'port,can_connect,can_serve,transport')
 
 _hosts = {
-    'kinect': HostInfo(8000, True, False),
-    'fusion': HostInfo(9125, True, True),
-    'brandeis': HostInfo(9126, False, True),
-    'gui': HostInfo(9127, False, True)
+    'kinect': HostInfo(8000, True, True, 'tcp'),
+    'fusion': HostInfo(9125, True, True, 'tcp'),
+    'brandeis': HostInfo(9126, False, True, 'tcp'),
+    'gui': HostInfo(9127, False, True, 'tcp'),
+    'inference': HostInfo(9128, True, True, 'tcp')
 }
 
 
-def connect(hostrole, hostname, stream_strs, timeout=False):
+def get_port(hostrole):
     """
-    Connect to a host
-    :param hostrole Role of the host in the system [fusion|kinect]
-    :param hostname Host name of the machine to which you are connecting
-    :param stream_strs: Accepted values are those defined in streams module
-    :param timeout: True to set the socket to timeout after 10s, False means no timeout
-    :return: Socket object on successful connection, None otherwise
+    :return: TCP port of the host role
     """
+    return _hosts[hostrole].port
+
 
-    port, can_connect, _ = _hosts[hostrole]
+def _open(hostrole, hostname, stream_strs, timeout, nodelay, flags=None):
+    port, can_connect, _, _ = _hosts[hostrole]
     if can_connect:
         addr = (hostname, port)
     else:
@@ -38,27 +42,188 @@ def connect(hostrole, hostname, stream_strs, timeout=False):
     if timeout:
         sock.settimeout(10)
 
+    # Messages are small and latency sensitive, so whether Nagle's algorithm delays them is chosen explicitly
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if nodelay else 0)
+
     try:
         sock.connect(addr)
     except socket.error:
         print("Failed to connect to {} at '{host[0]}:{host[1]}'".format(hostrole, host=addr))
         return None
 
+    if flags is not None and flags & shm.SHARED_MEMORY:
+        if not shm.is_available():
+            print("Shared memory needs Python 3.8 or later, sending to {} over TCP".format(hostrole))
+            flags = (flags & ~shm.SHARED_MEMORY) or None
+        elif not shm.is_local(sock.getsockname(), sock.getpeername()):
+            # Memory is only shared on the same machine
+            flags = (flags & ~shm.SHARED_MEMORY) or None
+
     stream_id = 0
     for stream_str in stream_strs:
         stream_id |= streams.get_stream_id(stream_str)
 
     try:
         print("Sending stream info")
-        sock.sendall(struct.pack('<iBi', 5, 1, stream_id))
+        if flags is None:
+            sock.sendall(struct.pack('<iBi', 5, 1, stream_id))
+        else:
+            sock.sendall(struct.pack('<iBiB', 6, 1, stream_id, flags))
     except socket.error:
         print("Error: {} refused to accept stream id".format(hostrole))
         return None
 
+    return sock, flags
+
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if chunk == b'':
+            raise EOFError("Received only {} bytes out of {}".format(len(data), size))
+        data += chunk
+    return data
+
+
+def _read_reply(sock, timeout):
+    """
+    Read the reply to a registration sent with flags
+    # accepted flags (byte) | shared memory name length (byte) | shared memory name, if shared memory was accepted
+    :return: (accepted flags, name of the shared memory or None), (None, None) if the host closed the connection
+             without replying, None if the host rejected the registration
+    """
+    # Older versions cannot parse a registration with flags: they close the connection without replying, as they do
+    # when they reject the streams, and the streams are registered again without flags
+    sock.settimeout(10)
+    try:
+        first = sock.recv(1)
+        if first == b'':
+            return None, None
+        accepted_flags = first[0]
+        name = None
+        if accepted_flags & shm.SHARED_MEMORY:
+            (length,) = _recv_exactly(sock, 1)
+            name = _recv_exactly(sock, length).decode('ascii')
+    except ConnectionResetError:
+        return None, None
+    except (socket.error, EOFError):
+        return None
+    sock.settimeout(10 if timeout else None)
+    return accepted_flags, name
+
+
+def _attach(sock, name):
+    """
+    :return: RingWriter writing to the shared memory of the connection, None if it cannot be attached
+    """
+    try:
+        return shm.RingWriter(sock, shm.Ring.attach(name))
+    except (OSError, ValueError, ImportError) as ex:
+        print("Unable to attach to shared memory {}: {}".format(name, ex))
+        return None
+
+
+def connect(hostrole, hostname, stream_strs, timeout=False, nodelay=True, transport=None):
+    """
+    Connect to a host
+    :param hostrole Role of the host in the system [fusion|kinect]
+    :param hostname Host name of the machine to which you are connecting
+    :param stream_strs: Accepted values are those defined in streams module
+    :param timeout: True to set the socket to timeout after 10s, False means no timeout
+    :param nodelay: True to disable Nagle's algorithm, sending every write right away
+    :param transport: Transport of the messages [tcp|shm], None for the one configured for the host role
+    :return: Socket object on successful connection, or RingWriter with shared memory, None otherwise
+    """
+    if transport is None:
+        transport = _hosts[hostrole].transport
+    opened = _open(hostrole, hostname, stream_strs, timeout, nodelay,
+                   shm.SHARED_MEMORY if transport == 'shm' else None)
+    if opened is None:
+        return None
+
+    sock, flags = opened
+    if flags is not None:
+        reply = _read_reply(sock, timeout)
+        if reply is None:
+            print("Error: {} rejected the streams {}".format(hostrole, stream_strs))
+            sock.close()
+            return None
+        accepted_flags, name = reply
+        if accepted_flags is None:
+            print("{} closed the connection without replying, registering without flags".format(hostrole))
+            sock.close()
+            return connect(hostrole, hostname, stream_strs, timeout, nodelay, 'tcp')
+        if accepted_flags & shm.SHARED_MEMORY:
+            writer = _attach(sock, name)
+            if writer is None:
+                # The host already expects the messages in shared memory, so register again
+                sock.close()
+                return connect(hostrole, hostname, stream_strs, timeout, nodelay, 'tcp')
+            print("Successfully connected to {} with shared memory".format(hostrole))
+            return writer
+
     print("Successfully connected to {}".format(hostrole))
     return sock
 
 
+def connect_batched(hostname, stream_strs, timeout=False, nodelay=True, max_messages=None, transport=None):
+    """
+    Connect to fusion with batched framing, coalescing several messages into one write, possibly of several streams
+    :param hostname Host name of the machine running fusion
+    :param stream_strs: Accepted values are those defined in streams module, several streams need batched framing
+    :param timeout: True to set the socket to timeout after 10s, False means no timeout
+    :param nodelay: True to disable Nagle's algorithm, sending every batch right away
+    :param max_messages: Number of messages after which a batch is sent, None to only send on flush()
+    :param transport: Transport of the messages [tcp|shm], None for the one configured for fusion
+    :return: BatchWriter on successful connection, with plain framing if fusion did not accept batching and a single
+             stream was requested, None otherwise
+    """
+    if transport is None:
+        transport = _hosts['fusion'].transport
+    opened = _open('fusion', hostname, stream_strs, timeout, nodelay,
+                   batch.BATCHED | (shm.SHARED_MEMORY if transport == 'shm' else 0))
+    if opened is None:
+        return None
+
+    sock = opened[0]
+    reply = _read_reply(sock, timeout)
+    if reply is None:
+        print("Error: fusion rejected the streams {}".format(stream_strs))
+        sock.close()
+        return None
+
+    accepted_flags, name = reply
+    if accepted_flags is None:
+        sock.close()
+        if not isinstance(stream_strs, str) and len(stream_strs) > 1:
+            print("Error: fusion did not reply, the streams {} cannot share a connection".format(stream_strs))
+            return None
+        print("Fusion closed the connection without replying, registering without flags, with plain framing")
+        plain = connect('fusion', hostname, stream_strs, timeout, nodelay, 'tcp')
+        return batch.BatchWriter(plain, False, max_messages) if plain is not None else None
+
+    if accepted_flags & shm.SHARED_MEMORY:
+        writer = _attach(sock, name)
+        if writer is None:
+            sock.close()
+            return connect_batched(hostname, stream_strs, timeout, nodelay, max_messages, 'tcp')
+        sock = writer
+
+    batched = accepted_flags & batch.BATCHED != 0
+    if not batched:
+        if isinstance(stream_strs, str) or len(stream_strs) == 1:
+            print("Fusion did not accept batched framing, using plain framing")
+        else:
+            print("Error: fusion did not accept the streams {} on a single connection".format(stream_strs))
+            sock.close()
+            return None
+
+    print("Successfully connected to fusion{}{}".format(" with batched framing" if batched else "",
+                                                       " over shared memory" if sock is not opened[0] else ""))
+    return batch.BatchWriter(sock, batched, max_messages)
+
+
 def serve(hostrole, hostname='', reuse=True):
     """
     Initialize a server socket
@@ -67,7 +232,7 @@ def serve(hostrole, hostname='', reuse=True):
     :param reuse: Reuse the server socket
     :return: Returns the initialized server socket
     """
-    port, _, can_serve = _hosts[hostrole]
+    port, _, can_serve, _ = _hosts[hostrole]
     if can_serve:
         addr = (hostname, port)
     else:
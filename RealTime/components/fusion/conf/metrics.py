@@ -0,0 +1,446 @@
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Metrics of a process: counters, gauges and latency histograms, registered by name and labels into the registry of
+# the process. Updating a metric only takes a short lock, the metrics are read by a Reporter thread printing a line
+# every few seconds, and by a text endpoint in the Prometheus exposition format, e.g.
+#   curl http://localhost:PORT/metrics
+# Components enable both with add_arguments() and from_arguments(), instead of printing from their loops.
+
+ns_per_ms = 1000000
+
+# Values below 2 ** _sub_bucket_bits are counted exactly, larger ones with a relative error below 2 ** -6
+_sub_bucket_bits = 7
+_sub_bucket_half = 1 << (_sub_bucket_bits - 1)
+_bucket_count = (64 - _sub_bucket_bits + 2) * _sub_bucket_half
+
+
+def _bucket_index(value):
+    shift = value.bit_length() - _sub_bucket_bits
+    if shift <= 0:
+        return value
+    return shift * _sub_bucket_half + (value >> shift)
+
+
+def _bucket_value(index):
+    """
+    :return: the largest value counted in the bucket
+    """
+    if index < 2 * _sub_bucket_half:
+        return index
+    shift = index // _sub_bucket_half - 1
+    return ((index - shift * _sub_bucket_half + 1) << shift) - 1
+
+
+class Counter:
+    """
+    Number of events since the start of the process
+    """
+    kind = 'counter'
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self._value += n
+
+    def value(self):
+        return self._value
+
+
+class Gauge:
+    """
+    Latest value of a quantity, e.g. a queue size. Values which are not numbers, e.g. the name of the recognized
+    gesture, are reported as they are and exported as a label.
+    """
+    kind = 'gauge'
+
+    def __init__(self):
+        self._value = None
+
+    def set(self, value):
+        self._value = value
+
+    def value(self):
+        return self._value
+
+
+class Histogram:
+    """
+    Log-linear histogram of non-negative integers, e.g. durations in ns, with a fixed relative precision and memory,
+    in the manner of HdrHistogram
+    """
+    kind = 'summary'
+
+    def __init__(self):
+        self._counts = [0] * _bucket_count
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        value = max(0, int(value))
+        with self._lock:
+            self._counts[_bucket_index(value)] += 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def merge(self, other):
+        """
+        Add the values of another histogram
+        """
+        with other._lock:
+            counts, count, total, lo, hi = list(other._counts), other.count, other.total, other.min, other.max
+        with self._lock:
+            for i, c in enumerate(counts):
+                if c:
+                    self._counts[i] += c
+            self.count += count
+            self.total += total
+            if lo is not None and (self.min is None or lo < self.min):
+                self.min = lo
+            if hi is not None and (self.max is None or hi > self.max):
+                self.max = hi
+
+    def value(self):
+        return self.count
+
+    def mean(self):
+        return self.total / self.count if self.count > 0 else 0.0
+
+    def percentile(self, p):
+        """
+        :param p: Percentile in [0, 100]
+        :return: upper bound of the bucket holding the percentile, clamped to the maximum, 0 when empty
+        """
+        with self._lock:
+            if self.count == 0:
+                return 0
+            rank = max(1, int(round(p / 100.0 * self.count)))
+            seen = 0
+            for i, c in enumerate(self._counts):
+                seen += c
+                if seen >= rank:
+                    return min(_bucket_value(i), self.max)
+        return self.max
+
+    def reset(self):
+        with self._lock:
+            self._counts = [0] * _bucket_count
+            self.count = 0
+            self.total = 0
+            self.min = None
+            self.max = None
+
+
+def _format_labels(labels):
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + "}" if labels else ""
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class Registry:
+    """
+    Metrics of a process, by name and labels
+    """
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._kinds = {}
+        self._lock = threading.Lock()
+        # Labels of every metric, e.g. the name of the process
+        self.labels = OrderedDict()
+
+    def _get(self, cls, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None or metric.kind != cls.kind:
+            with self._lock:
+                kind = self._kinds.setdefault(name, cls.kind)
+                if kind != cls.kind:
+                    raise ValueError("Metric {} is a {}, not a {}".format(name, kind, cls.kind))
+                metric = self._metrics.setdefault(key, cls())
+        return metric
+
+    def counter(self, name, **labels):
+        """
+        :return: the Counter of the name and labels, created on first use
+        """
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name, **labels):
+        """
+        :return: the Gauge of the name and labels, created on first use
+        """
+        return self._get(Gauge, name, labels)
+
+    def histogram(self, name, **labels):
+        """
+        :return: the Histogram of the name and labels, created on first use
+        """
+        return self._get(Histogram, name, labels)
+
+    def collect(self):
+        """
+        :return: list of (name, labels, metric), labels being a tuple of (key, value) pairs
+        """
+        return [(name, labels, metric) for (name, labels), metric in list(self._metrics.items())]
+
+    def text(self):
+        """
+        :return: the metrics in the Prometheus text exposition format, durations in ns are exported as they are
+        """
+        lines = []
+        common = tuple(self.labels.items())
+        typed = set()
+        # The lines of a metric must be consecutive
+        for name, labels, metric in sorted(self.collect(), key=lambda m: m[0]):
+            if name not in typed:
+                lines.append("# TYPE {} {}".format(name, metric.kind))
+                typed.add(name)
+            labels = common + labels
+            if isinstance(metric, Histogram):
+                for q in (0.5, 0.9, 0.99):
+                    lines.append("{}{} {}".format(name, _format_labels(labels + (('quantile', q),)),
+                                                  metric.percentile(q * 100)))
+                lines.append("{}_count{} {}".format(name, _format_labels(labels), metric.count))
+                lines.append("{}_sum{} {}".format(name, _format_labels(labels), metric.total))
+                continue
+            value = metric.value()
+            if value is None:
+                continue
+            if not _is_number(value):
+                labels, value = labels + (('value', value),), 1
+            lines.append("{}{} {}".format(name, _format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+
+class Reporter(threading.Thread):
+    """
+    Prints a line with the metrics of the registry at a fixed interval, so that the loops of the components do not
+    print: the rate of every counter since the previous line, the value of every gauge, and the median and 99th
+    percentile of every histogram
+    """
+
+    def __init__(self, registry, name, interval=5.0):
+        """
+        :param name: Name of the process at the start of the lines
+        :param interval: Seconds between two lines
+        """
+        threading.Thread.__init__(self, name="MetricsReporter")
+        self.daemon = True
+        self.registry = registry
+        self.process_name = name
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._previous = {}
+        self._previous_time = time.perf_counter()
+
+    def line(self):
+        """
+        :return: the line for the metrics since the previous call
+        """
+        now = time.perf_counter()
+        elapsed = max(now - self._previous_time, 1e-9)
+        self._previous_time = now
+        parts = []
+        for name, labels, metric in self.registry.collect():
+            # Histograms of durations are printed in ms
+            in_ns = isinstance(metric, Histogram) and name.endswith("_ns")
+            label = (name[:-3] if in_ns else name) + ("[" + ",".join(str(v) for _, v in labels) + "]" if labels else "")
+            if isinstance(metric, Counter):
+                key = (name, labels)
+                value = metric.value()
+                parts.append("{} {:.1f}/s".format(label, (value - self._previous.get(key, 0)) / elapsed))
+                self._previous[key] = value
+            elif isinstance(metric, Gauge):
+                value = metric.value()
+                if value is not None:
+                    parts.append("{} {}".format(label, "{:.3g}".format(value) if isinstance(value, float) else value))
+            elif metric.count > 0:
+                if in_ns:
+                    parts.append("{} p50 {:.2f} p99 {:.2f} ms".format(label, metric.percentile(50) / ns_per_ms,
+                                                                     metric.percentile(99) / ns_per_ms))
+                else:
+                    parts.append("{} p50 {} p99 {}".format(label, metric.percentile(50), metric.percentile(99)))
+        return "[{}] {}".format(self.process_name, " | ".join(parts))
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            print(self.line())
+
+    def stop(self):
+        self._stop_event.set()
+
+    def is_stopped(self):
+        return self._stop_event.is_set()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not logged
+        pass
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # As http.server.ThreadingHTTPServer, which needs Python 3.7
+    daemon_threads = True
+
+
+def serve(registry, port, host='127.0.0.1'):
+    """
+    Serve the text of the registry over HTTP from a background thread
+    :param port: Port to listen to, 0 for any free port
+    :return: the HTTP server, stopped with shutdown()
+    """
+    handler = type('MetricsHandler', (_Handler,), {'registry': registry})
+    server = _ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True).start()
+    return server
+
+
+# Registry of the process
+registry = Registry()
+
+
+def counter(name, **labels):
+    return registry.counter(name, **labels)
+
+
+def gauge(name, **labels):
+    return registry.gauge(name, **labels)
+
+
+def histogram(name, **labels):
+    return registry.histogram(name, **labels)
+
+
+def add_arguments(parser):
+    """
+    Add the options of the reporter and of the endpoint to an argparse parser, see from_arguments()
+    """
+    parser.add_argument('--metrics-port', default=None, type=int, help='local port serving the metrics over HTTP')
+    parser.add_argument('--report-interval', default=5.0, type=float,
+                        help='seconds between the lines printing the metrics, 0 not to print them')
+
+
+def from_arguments(name, args):
+    """
+    Start the reporter and the endpoint requested by the options added by add_arguments()
+    :param name: Name of the process, added as a label to every metric
+    :return: the Reporter, None if it is disabled
+    """
+    registry.labels['process'] = name
+    if args.metrics_port is not None:
+        server = serve(registry, args.metrics_port)
+        print("Serving metrics of {} on http://{}:{}/metrics".format(name, *server.server_address))
+    if args.report_interval <= 0:
+        return None
+    reporter = Reporter(registry, name, args.report_interval)
+    reporter.start()
+    return reporter
+
+
+if __name__ == '__main__':
+    # Checks the histograms and the text endpoint, and measures the cost of updating the metrics against printing
+    # Run as: python -m components.fusion.conf.metrics
+    import io
+    import random
+    import sys
+    import urllib.request
+
+    rng = random.Random(0)
+    values = [int(rng.lognormvariate(15, 1.5)) for _ in range(100000)] + list(range(200))
+    h = Histogram()
+    for v in values:
+        h.record(v)
+    values.sort()
+    for p in (1, 50, 90, 99, 99.9, 100):
+        exact = values[max(1, int(round(p / 100.0 * len(values)))) - 1]
+        estimate = h.percentile(p)
+        assert exact <= estimate <= exact * (1 + 2.0 ** -6) + 1, (p, exact, estimate)
+    assert all(_bucket_value(_bucket_index(v)) >= v and
+               _bucket_index(_bucket_value(_bucket_index(v))) == _bucket_index(v) for v in values)
+    merged = Histogram()
+    merged.merge(h)
+    merged.merge(h)
+    assert merged.count == 2 * h.count and merged.percentile(50) == h.percentile(50)
+    print("Histogram OK")
+
+    test_registry = Registry()
+    test_registry.labels['process'] = 'check'
+    frames = test_registry.counter("frames")
+    gesture = test_registry.gauge("gesture", hand="RH")
+    depth = test_registry.gauge("queue_size")
+    frame_time = test_registry.histogram("frame_time_ns")
+    for i in range(300):
+        frames.inc()
+        frame_time.record(i * 100000)
+    gesture.set('grab "two"')
+    depth.set(3)
+    assert test_registry.counter("frames") is frames
+    try:
+        test_registry.gauge("frames")
+        assert False
+    except ValueError:
+        pass
+    server = serve(test_registry, 0)
+    text = urllib.request.urlopen("http://{}:{}/metrics".format(*server.server_address)).read().decode('utf-8')
+    server.shutdown()
+    print(text, end='')
+    assert 'frames{process="check"} 300' in text
+    assert 'gesture{process="check",hand="RH",value="grab \\"two\\""} 1' in text
+    assert 'frame_time_ns_count{process="check"} 300' in text
+    reporter = Reporter(test_registry, "check")
+    print(reporter.line())
+    print("Registry OK")
+
+    # The loops used to print every frame, to a console which may be slow
+    count = 100000
+    out = io.StringIO()
+    start = time.perf_counter()
+    for i in range(count):
+        print('{:<20}'.format('grab'), '{:.1}'.format(0.5), end='\t', file=out)
+        print(file=out)
+    printing = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(count):
+        frames.inc()
+        gesture.set('grab')
+        frame_time.record(i)
+    updating = time.perf_counter() - start
+    print("Per frame: print to memory {:.2f} us, metrics {:.2f} us".format(printing * 1e6 / count,
+                                                                         updating * 1e6 / count))
+    if sys.stdout.isatty():
+        start = time.perf_counter()
+        for i in range(1000):
+            print('{:<20}'.format('grab'), '{:.1}'.format(0.5), end='\t')
+            print()
+        print("Per frame: print to the console {:.2f} us".format((time.perf_counter() - start) * 1e6 / 1000))
@@ -0,0 +1,395 @@
+import struct
+import time
+
+# Imported with the first ring, multiprocessing.shared_memory needs Python 3.8, see is_available()
+shared_memory = None
+resource_tracker = None
+
+# Registration flag asking fusion to carry the messages of the connection over a shared memory ring
+# The socket then only carries notifications, and tells each side when the other one goes away
+SHARED_MEMORY = 0x2
+
+default_capacity = 1 << 20
+
+# Seconds after which a reader waiting for notifications drains its ring anyway
+recheck_interval = 0.1
+
+# Ring layout, indices count the bytes written and read since the ring was created
+# write index (long long) | read index (long long) | capacity (long long) | data
+# Only the writer stores the write index and only the reader the read index, each on its own cache line
+_index = struct.Struct("<q")
+_write_offset = 0
+_read_offset = 64
+_capacity_offset = 128
+_data_offset = 192
+
+# Messages are stored as sent over TCP, prefixed by their size
+# A size of -1 marks the end of the data before the ring wraps around
+_frame_size = struct.Struct("<i")
+_wrap = -1
+
+# Names of the segments created by this process
+_created = set()
+
+
+def is_available():
+    """
+    :return: True if this Python can share memory, False otherwise, e.g. before 3.8, the messages then go over TCP
+    """
+    global shared_memory, resource_tracker
+    if shared_memory is None:
+        try:
+            from multiprocessing import shared_memory, resource_tracker
+        except ImportError:
+            return False
+    return True
+
+
+def _require():
+    if not is_available():
+        raise ImportError("Shared memory needs Python 3.8 or later")
+
+
+def is_local(sockname, peername):
+    """
+    :param sockname: Local address of a connected socket
+    :param peername: Remote address of the socket
+    :return: True if both ends of the connection are on the same machine, and can share memory
+    """
+    return sockname[0] == peername[0]
+
+
+class Ring:
+    """
+    Single producer, single consumer byte ring in a shared memory segment.
+    The process creating the ring owns the segment and unlinks it, the other one only attaches to it.
+    """
+
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner
+        self.buf = shm.buf
+        (self.capacity,) = _index.unpack_from(self.buf, _capacity_offset)
+        self.data = self.buf[_data_offset:_data_offset + self.capacity]
+
+    @classmethod
+    def create(cls, capacity=default_capacity):
+        """
+        :param capacity: Size of the data in bytes
+        :return: a new empty Ring, in a new shared memory segment
+        """
+        _require()
+        shm = shared_memory.SharedMemory(create=True, size=_data_offset + capacity)
+        _created.add(shm.name)
+        _index.pack_into(shm.buf, _write_offset, 0)
+        _index.pack_into(shm.buf, _read_offset, 0)
+        _index.pack_into(shm.buf, _capacity_offset, capacity)
+        return cls(shm, True)
+
+    @classmethod
+    def attach(cls, name):
+        """
+        :param name: Name of the shared memory segment of an existing Ring
+        :return: Ring attached to the segment
+        """
+        _require()
+        try:
+            # Python 3.13+
+            shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            shm = shared_memory.SharedMemory(name)
+            # Only the owner unlinks the segment, do not let the resource tracker unlink it when this process exits
+            if name not in _created:
+                resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm, False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write_index(self):
+        return _index.unpack_from(self.buf, _write_offset)[0]
+
+    def read_index(self):
+        return _index.unpack_from(self.buf, _read_offset)[0]
+
+    def close(self):
+        """
+        Detach from the segment, and unlink it if this process owns it
+        """
+        self.data.release()
+        self.data = None
+        self.buf = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # A message is still referenced, e.g. by the traceback of a decoding error, the memory is unmapped once
+            # it is collected
+            pass
+        if self.owner:
+            self.shm.unlink()
+            _created.discard(self.shm.name)
+
+
+class RingWriter:
+    """
+    Writes the messages of a connection to fusion into a Ring, in place of the socket.
+    Implements the subset of the socket interface used by the recognizers, every sendall() must hold whole messages,
+    prefixed by their size. Like sendall() on a socket, it blocks while the ring is full.
+    Fusion is only notified through the socket when the ring was empty, i.e. when fusion may be waiting for data.
+    """
+
+    def __init__(self, sock, ring):
+        """
+        :param sock: Socket connected to fusion, which accepted shared memory on this connection
+        :param ring: Ring attached to the segment named by fusion
+        """
+        self.sock = sock
+        self.ring = ring
+        self._buf = ring.buf
+        self._data = ring.data
+        self._capacity = ring.capacity
+        self._written = ring.write_index()
+        # Notifications never block, as long as some are pending fusion is woken up anyway
+        sock.setblocking(False)
+
+    def _notify(self):
+        try:
+            self.sock.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def sendall(self, data):
+        """
+        Write whole messages to the ring
+        :param data: One or several messages, each prefixed by its size
+        """
+        size = len(data)
+        offset = _frame_size.size + _frame_size.unpack_from(data)[0]
+        while offset < size:
+            offset += _frame_size.size + _frame_size.unpack_from(data, offset)[0]
+        if offset != size:
+            raise ValueError("Only whole messages can be written to shared memory, got {} bytes".format(size))
+
+        buf = self._buf
+        capacity = self._capacity
+        if size > capacity // 2:
+            raise ValueError("{} bytes do not fit in a ring of {} bytes".format(size, capacity))
+
+        written = self._written
+        position = written % capacity
+        # Messages are never split across the end of the ring
+        skipped = capacity - position if position + size > capacity else 0
+        while written + skipped + size - _index.unpack_from(buf, _read_offset)[0] > capacity:
+            # Fusion is behind, make sure that it is awake and wait for it to catch up
+            self._notify()
+            time.sleep(0.001)
+
+        if skipped > 0:
+            if skipped >= _frame_size.size:
+                _frame_size.pack_into(self._data, position, _wrap)
+            position = 0
+        self._data[position:position + size] = data
+        self._written = written + skipped + size
+        _index.pack_into(buf, _write_offset, self._written)
+
+        # The read index is loaded after the write index is stored. If fusion had read everything before, it may be
+        # waiting on the socket. A wakeup lost when both sides race is recovered by fusion checking its rings
+        # periodically
+        if _index.unpack_from(buf, _read_offset)[0] == written:
+            self._notify()
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self._buf = self._data = None
+        self.ring.close()
+        self.sock.close()
+
+
+class RingReader:
+    """
+    Reads the messages written by a RingWriter, in place in the shared memory.
+    """
+
+    def __init__(self, ring, sock=None):
+        """
+        :param ring: Ring created for the client
+        :param sock: Socket connected to the client, None when the caller reads the notifications itself
+        """
+        self.ring = ring
+        self.sock = sock
+        self._read = ring.read_index()
+
+    def recv_notifications(self):
+        """
+        Consume the pending notifications, once the socket is readable
+        :return: False if the client closed the connection, True otherwise
+        """
+        return self.sock.recv(4096) != b''
+
+    def frames(self):
+        """
+        Read the messages written so far. A message is released to the writer once the next one is requested, so it
+        must be decoded or copied before then.
+        :return: generator of memoryviews of the messages, excluding their size fields
+        """
+        ring = self.ring
+        capacity = ring.capacity
+        data = ring.data
+        written = ring.write_index()
+        while self._read < written:
+            position = self._read % capacity
+            size = _wrap if capacity - position < _frame_size.size else _frame_size.unpack_from(data, position)[0]
+            if size == _wrap:
+                self._read += capacity - position
+            else:
+                start = position + _frame_size.size
+                if size < 0 or start + size > capacity:
+                    raise struct.error("Corrupted ring, message of {} bytes at {}".format(size, position))
+                yield data[start:start + size]
+                self._read += _frame_size.size + size
+            _index.pack_into(ring.buf, _read_offset, self._read)
+            if self._read == written:
+                # Messages written while these were read
+                written = ring.write_index()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.ring.close()
+        if self.sock is not None:
+            self.sock.close()
+
+
+if __name__ == '__main__':
+    # Checks the ring with messages of every size wrapping around a small ring, then compares the latency of loopback
+    # TCP and shared memory from recognizers in another process to fusion, at 30 Hz and as fast as possible
+    # Run as: python -m components.fusion.conf.shm [--help]
+    import argparse
+    import os
+    import select
+    import socket
+    import subprocess
+    import sys
+    import threading
+
+    from . import codecs, streams
+    from .endpoints import connect
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', default=30.0, type=float, help='frames per second')
+    parser.add_argument('--duration', default=5.0, type=float, help='seconds of sending at the frame rate')
+    parser.add_argument('--burst', default=20000, type=int, help='messages per stream sent as fast as possible')
+    # Runs the recognizers, in their own process as when deployed
+    parser.add_argument('--send', nargs=3, metavar=('TRANSPORT', 'RATE', 'COUNT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    names = streams.get_active_streams()
+    contents = {
+        "LH": (3,) + (0.5,) * (codecs.get_codec_by_name("LH").content.size // 4 - 1),
+        "RH": (3,) + (0.5,) * (codecs.get_codec_by_name("RH").content.size // 4 - 1),
+        "Body": (1, 2) + (0.5,) * 24 + (1,),
+        "Speech": (b"put that there",),
+        "Emotion": (2, 0.5),
+    }
+
+    def ticks():
+        return int(time.perf_counter() * 1e7)
+
+    if args.send is not None:
+        transport, rate, count = args.send[0], float(args.send[1]), int(args.send[2])
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        socks = {name: connect('fusion', 'localhost', name, transport=transport) for name in names}
+        encoders = {name: codecs.get_codec_by_name(name).encoder() for name in names}
+        start, cpu = time.perf_counter(), time.process_time()
+        for i in range(count):
+            for name in names:
+                socks[name].sendall(encoders[name].encode(streams.get_stream_id(name), ticks(), *contents[name]))
+            if rate > 0:
+                time.sleep(max(0.0, start + (i + 1) / rate - time.perf_counter()))
+        print(time.perf_counter() - start, time.process_time() - cpu, file=stdout, flush=True)
+        time.sleep(0.5)
+        for sock in socks.values():
+            sock.close()
+        sys.exit()
+
+    from ..fusion_thread import Fusion
+
+    # Messages of every size, in order and intact, through a ring too small to hold them all
+    speech = codecs.get_codec_by_name("Speech")
+    encoder = speech.encoder()
+    writer_sock, reader_sock = socket.socketpair()
+    ring = Ring.create(256)
+    writer, reader = RingWriter(writer_sock, Ring.attach(ring.name)), RingReader(ring, reader_sock)
+    commands = [bytes([65 + i % 26]) * (i % 100) for i in range(2000)]
+
+    def write_all():
+        for i, command in enumerate(commands):
+            writer.sendall(encoder.encode(4, i, command))
+
+    thread = threading.Thread(target=write_all)
+    thread.start()
+    received = 0
+    while received < len(commands):
+        # Wait like fusion, for a notification or at most until the next periodic check
+        if select.select([reader_sock], [], [], 0.01)[0]:
+            reader.recv_notifications()
+        for frame in reader.frames():
+            assert codecs.header.unpack_from(frame) == (4, received)
+            assert speech.unpack_content_from(frame) == (commands[received],)
+            received += 1
+    # The last message must be released before the ring is closed
+    del frame
+    thread.join()
+    writer.close()
+    reader.close()
+    print("{} messages of 16 to 115 bytes through a ring of 256 bytes OK".format(received))
+
+    class Probe(Fusion):
+        def __init__(self, latencies):
+            Fusion.__init__(self)
+            self._latencies = latencies
+
+        def _handle_message(self, msg):
+            self._latencies.append((ticks() - msg.header.timestamp) / 10000)
+
+    def run(label, transport, rate, count):
+        latencies = []
+        fusion = Probe(latencies)
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            fusion.start()
+            time.sleep(0.2)
+            # The main thread only waits, so the CPU time of this process is the one of fusion
+            fusion_cpu = time.process_time()
+            result = subprocess.run([sys.executable, '-m', 'components.fusion.conf.shm', '--send', transport,
+                                     str(rate), str(count)], stdout=subprocess.PIPE, check=True)
+            elapsed, cpu = map(float, result.stdout.split())
+            while len(fusion._connected_streams()) > 0:
+                time.sleep(0.01)
+            fusion_cpu = time.process_time() - fusion_cpu
+            fusion.stop()
+            time.sleep(0.1)
+        finally:
+            sys.stdout = stdout
+        latencies.sort()
+        print("{:22} {:>6} messages, {:>7.0f} msg/s | CPU us/msg: sender {:5.1f} fusion {:5.1f} | "
+              "latency ms: p50 {:7.3f} p99 {:7.3f}".format(
+                  label, len(latencies), count * len(names) / elapsed, cpu * 1e6 / (count * len(names)),
+                  fusion_cpu * 1e6 / len(latencies), latencies[len(latencies) // 2],
+                  latencies[int(len(latencies) * 0.99)]))
+
+    print("{} streams from another process".format(len(names)))
+    for transport in ('tcp', 'shm'):
+        run("{} at {:g} Hz".format(transport, args.rate), transport, args.rate, int(args.rate * args.duration))
+    for transport in ('tcp', 'shm'):
+        run("{} as fast as possible".format(transport), transport, 0, args.burst)
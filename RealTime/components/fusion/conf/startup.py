@@ -0,0 +1,250 @@
+import threading
+import time
+
+from . import metrics
+
+# Startup of a component: its independent steps, e.g. loading each model and connecting to each host, run concurrently
+# as tasks of a Startup, which waits for the required ones and prints when each became ready, e.g.
+#   depth_client_BOTH ready in 9.84 s
+#     model                  0.00 s +    8.71 s ready
+#     warm-up                8.71 s +    1.13 s ready
+#     kinect                 0.00 s +    0.01 s ready
+#     RH forest              0.00 s +       ... loading
+# Tasks which are not required, e.g. the forests of the one-shot classifiers, keep running after the component starts,
+# and print when they become ready.
+# Components enable the options with add_arguments() and from_arguments().
+
+
+class Task(threading.Thread):
+    """
+    A step of the startup, run in its own thread
+    """
+
+    def __init__(self, startup, name, function, args, required, after=()):
+        """
+        :param function: called with args, in which the Tasks are replaced by their results once they are ready
+        :param required: whether the component waits for the task before starting
+        :param after: other Tasks to wait for before running
+        """
+        threading.Thread.__init__(self, name="Startup " + name, daemon=True)
+        self.startup = startup
+        self.task_name = name
+        self.function = function
+        self.args = args
+        self.required = required
+        self.after = after
+        self.value = None
+        self.error = None
+        # perf_counter() when the task started running, after the tasks it depends on, and when it ended
+        self.started = None
+        self.ended = None
+
+    def run(self):
+        try:
+            for task in self.after:
+                task.result()
+            args = [arg.result() if isinstance(arg, Task) else arg for arg in self.args]
+        except Exception as ex:
+            self.error = RuntimeError("{} depends on a task which failed: {}".format(self.task_name, ex))
+            self.ended = time.perf_counter()
+            return
+
+        self.started = time.perf_counter()
+        try:
+            self.value = self.function(*args)
+        except Exception as ex:
+            self.error = ex
+        self.ended = time.perf_counter()
+
+        duration_ms = (self.ended - self.started) * 1000
+        metrics.gauge("startup_ms", task=self.task_name).set(duration_ms)
+        if not self.required and self.startup.is_reported():
+            print("{}: {} {} after {:.2f} s".format(self.startup.component, self.task_name,
+                                                    "failed" if self.error is not None else "ready",
+                                                    self.ended - self.startup.start))
+
+    def result(self, timeout=None):
+        """
+        Wait for the task
+        :return: the value returned by the function of the task
+        :raises: the exception raised by the function, TimeoutError if the task is still running after timeout
+        """
+        self.join(timeout)
+        if self.is_alive():
+            raise TimeoutError("{} is not ready after {} s".format(self.task_name, timeout))
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def status(self):
+        if self.is_alive():
+            return "loading" if self.started is not None else "waiting"
+        return "failed: {}".format(self.error) if self.error is not None else "ready"
+
+
+class Startup:
+    """
+    Runs the steps of the startup of a component concurrently, and reports when each became ready
+    """
+
+    def __init__(self, component, warm_up=True, connect_timeout=30.0):
+        """
+        :param component: name of the component, printed in the report
+        :param warm_up: whether the models run once on blank inputs before the first frame, see warm_up()
+        :param connect_timeout: seconds during which connect() retries, for the hosts started at the same time
+        """
+        self.component = component
+        self.warm_up_models = warm_up
+        self.connect_timeout = connect_timeout
+        self.start = time.perf_counter()
+        self.tasks = []
+        self._reported = threading.Event()
+
+    def task(self, name, function, *args, required=True, after=()):
+        """
+        Start a task
+        :param name: name of the task in the report
+        :param function: called with args, in which the Tasks are replaced by their results once they are ready,
+        so that a task runs after the tasks it takes
+        :param required: whether wait() waits for the task
+        :param after: other Tasks to wait for before running
+        :return: Task, whose result() waits for the value returned by the function
+        """
+        task = Task(self, name, function, args, required, after)
+        self.tasks.append(task)
+        task.start()
+        return task
+
+    def connect(self, name, connect, *args, after=()):
+        """
+        Start a task connecting to a host, retrying until connect_timeout while the host is not listening yet
+        :param connect: e.g. endpoints.connect, returning None when the connection fails
+        :param after: other Tasks to wait for before connecting, e.g. the models, not to connect to a host streaming
+        frames before they can be processed
+        """
+        return self.task(name, retry, connect, args, self.connect_timeout, after=after)
+
+    def warm_up(self, name, model, *args):
+        """
+        Start a task running a model once on blank inputs, for the first frame not to pay for the initialization of
+        the graph, unless disabled
+        :param model: Task loading a model with a warm_up() method, called with args
+        :return: Task, whose result is the model
+        """
+        def warm_up(model):
+            if self.warm_up_models:
+                model.warm_up(*args)
+            return model
+
+        return self.task(name, warm_up, model)
+
+    def wait(self):
+        """
+        Wait for the required tasks and print the report
+        :raises: the exception of the first required task which failed
+        """
+        for task in self.tasks:
+            if task.required:
+                task.join()
+        print(self.report())
+        self._reported.set()
+        metrics.gauge("startup_ms", task="total").set((time.perf_counter() - self.start) * 1000)
+        for task in self.tasks:
+            if task.required and task.error is not None:
+                raise task.error
+
+    def is_reported(self):
+        return self._reported.is_set()
+
+    def report(self):
+        """
+        :return: time at which each task started after the start of the component, how long it took, and its status
+        """
+        lines = ["{} ready in {:.2f} s".format(self.component, (time.perf_counter() - self.start))]
+        for task in self.tasks:
+            started = "{:7.2f} s".format(task.started - self.start) if task.started is not None \
+                else "{:>9}".format("...")
+            duration = "{:7.2f} s".format(task.ended - task.started) \
+                if task.ended is not None and task.started is not None else "{:>9}".format("...")
+            lines.append("  {:<20}{} + {} {}".format(task.task_name, started, duration, task.status()))
+        return "\n".join(lines)
+
+
+def retry(connect, args, timeout, interval=0.5):
+    """
+    :param connect: function returning None when the connection fails
+    :return: the value of the first successful call of connect(*args), None after timeout seconds
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        connection = connect(*args)
+        if connection is not None or time.monotonic() >= deadline:
+            return connection
+        time.sleep(interval)
+
+
+def add_arguments(parser):
+    """
+    Add the options of the startup to an argparse parser, see from_arguments()
+    """
+    parser.add_argument('--no-warm-up', action='store_true', default=False,
+                        help='Do not run the models on blank inputs before the first frame')
+    parser.add_argument('--connect-timeout', default=30.0, type=float,
+                        help='seconds during which the connections are retried while the hosts are starting')
+
+
+def from_arguments(component, args):
+    """
+    :param component: name of the component
+    :return: Startup configured by the options added by add_arguments()
+    """
+    return Startup(component, not args.no_warm_up, args.connect_timeout)
+
+
+if __name__ == '__main__':
+    # Compares loading 2 models and connecting one after the other and concurrently, with steps emulated by sleeps
+    # Run as: python -m components.fusion.conf.startup
+    class Model:
+        def __init__(self, seconds):
+            time.sleep(seconds)
+            self.warm = False
+
+        def warm_up(self):
+            time.sleep(0.2)
+            self.warm = True
+
+    attempts = []
+
+    def connect(host):
+        attempts.append(host)
+        # The host starts listening after 0.4 s
+        return host if time.perf_counter() - startup.start > 0.4 else None
+
+    start = time.perf_counter()
+    Model(1.0).warm_up()
+    Model(0.8).warm_up()
+    time.sleep(1.0)
+    sequential = time.perf_counter() - start
+
+    startup = Startup("check", connect_timeout=2.0)
+    left = startup.warm_up("left warm-up", startup.task("left", Model, 1.0))
+    right = startup.warm_up("right warm-up", startup.task("right", Model, 0.8))
+    host = startup.connect("fusion", connect, "fusion")
+    kinect = startup.connect("kinect", connect, "kinect", after=(left, right))
+    background = startup.task("forest", time.sleep, 1.5, required=False)
+    failed = startup.task("failed", lambda: 1 / 0, required=False)
+    startup.wait()
+    concurrent = time.perf_counter() - startup.start
+    assert left.result().warm and right.result().warm and host.result() == "fusion" and len(attempts) > 2
+    assert kinect.started >= max(left.ended, right.ended)
+    assert background.is_alive() and isinstance(failed.error, ZeroDivisionError)
+    background.result()
+
+    try:
+        startup = Startup("check")
+        dependent = startup.task("dependent", lambda value: value, startup.task("failed", lambda: 1 / 0))
+        startup.wait()
+        raise AssertionError("expected the failure to be raised")
+    except ZeroDivisionError:
+        assert isinstance(dependent.error, RuntimeError)
+    print("sequential {:.2f} s, concurrent {:.2f} s".format(sequential, concurrent))
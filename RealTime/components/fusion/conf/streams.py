@@ -14,6 +14,8 @@ _active_streams = frozenset(["LH", "RH", "Body", "Speech", "Emotion"])
 
 _streams = frozenset(_stream_ids.keys())
 
+_stream_names = {sid: sname for sname, sid in _stream_ids.items()}
+
 for s in _active_streams:
     if s not in _stream_ids:
         raise Exception("Active streams configured incorrectly.\n{} not present in stream list.\n".format(s))
@@ -28,7 +30,7 @@ def is_valid(stream_name):
 
 
 def is_valid_id(stream_id):
-    return stream_id in _stream_ids.values()
+    return stream_id in _stream_names
 
 
 def is_active(stream_name):
@@ -40,10 +42,10 @@ def is_active_id(stream_id):
 
 
 def get_stream_name(stream_id):
-    for sname, sid in _stream_ids.items():
-        if stream_id == sid:
-            return sname
-    raise InvalidStreamError("Invalid stream id: {}".format(stream_id))
+    try:
+        return _stream_names[stream_id]
+    except KeyError:
+        raise InvalidStreamError("Invalid stream id: {}".format(stream_id))
 
 
 def get_stream_names():
@@ -54,6 +56,10 @@ def get_streams_count():
     return len(_streams)
 
 
+def get_active_streams():
+    return _active_streams
+
+
 def get_active_streams_count():
     return len(_active_streams)
 
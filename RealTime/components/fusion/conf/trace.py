@@ -0,0 +1,416 @@
+import json
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Latency tracing of the stages of the pipeline, e.g. read_frame -> preprocess -> inference -> send in a recognizer,
+# then sync -> state machines -> remote in fusion.
+# A span is the duration of a stage for a frame, the frame id is the timestamp of the Kinect frame, which every
+# component keeps with its data. Times are read from now(), in ns of time.perf_counter(), a monotonic clock shared by
+# the processes of a host, so the spans of the processes of a frame line up.
+# Spans are aggregated in process into a histogram per stage, also registered as the span_ns metric with the stage as
+# label, served as text on a local stats port, and can be
+# written to a trace file in the Chrome trace event format, viewable in chrome://tracing or https://ui.perfetto.dev
+# and summarized frame by frame with: python -m components.fusion.conf.trace report FILE [FILE ...]
+# Tracing is disabled until enable() is called, spans are then no-ops costing a function call.
+
+from . import metrics
+from .metrics import Histogram, ns_per_ms
+
+# time.perf_counter_ns() needs Python 3.7, before that the ns are computed from time.perf_counter()
+if hasattr(time, 'perf_counter_ns'):
+    now = time.perf_counter_ns
+else:
+    def now():
+        return int(time.perf_counter() * 1e9)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('tracer', 'stage', 'frame_id', 'start')
+
+    def __init__(self, tracer, stage, frame_id):
+        self.tracer = tracer
+        self.stage = stage
+        self.frame_id = frame_id
+
+    def __enter__(self):
+        self.start = now()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.stage, self.frame_id, self.start, now())
+        return False
+
+
+class Tracer:
+    """
+    Aggregates the spans of a process into histograms, and writes them to a trace file from a background thread
+    """
+
+    def __init__(self, name, path=None, registry=None, max_pending=65536, max_open=256, flush_interval=0.2):
+        """
+        :param name: Name of the process in the stats and trace file, e.g. "depth_client"
+        :param path: Path of the trace file, None not to write the spans
+        :param registry: metrics.Registry to register the histograms into, None not to register them
+        :param max_pending: Number of spans queued for the trace file before dropping the oldest ones
+        :param max_open: Number of spans started with begin() and not ended yet before forgetting the oldest ones
+        :param flush_interval: Seconds between the writes of the queued spans to the trace file
+        """
+        self.name = name
+        self.path = path
+        self.registry = registry
+        self.max_open = max_open
+        self._histograms = OrderedDict()
+        self._lock = threading.Lock()
+        self._open = OrderedDict()
+        self._pid = os.getpid()
+        # Appending to a deque is atomic, so recording a span takes no lock and never wakes the writer
+        self._pending = deque(maxlen=max_pending) if path is not None else None
+        self._queued = 0
+        self._written = 0
+        self.flush_interval = flush_interval
+        self._stop_event = threading.Event()
+        self._writer = None
+        self._stats_sock = None
+        if path is not None:
+            self._writer = threading.Thread(target=self._write_events, name="TraceWriter", daemon=True)
+            self._writer.start()
+
+    def histogram(self, stage):
+        """
+        :return: Histogram of the durations of the stage in ns
+        """
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.get(stage)
+                if histogram is None:
+                    histogram = self._histograms[stage] = Histogram() if self.registry is None else \
+                        self.registry.histogram("span_ns", stage=stage)
+        return histogram
+
+    def stages(self):
+        return list(self._histograms.keys())
+
+    def span(self, stage, frame_id=None):
+        """
+        :return: context manager recording the duration of its block as a span of the stage
+        """
+        return _Span(self, stage, frame_id)
+
+    def record(self, stage, frame_id, start, end=None):
+        """
+        Record a span measured by the caller
+        :param frame_id: Timestamp of the Kinect frame, None when the frame is not known, e.g. for a batch
+        :param start: Start of the span, from now()
+        :param end: End of the span, None for now
+        """
+        if end is None:
+            end = now()
+        self.histogram(stage).record(end - start)
+        if self._pending is not None:
+            self._pending.append((stage, frame_id, start, end, threading.get_ident()))
+            self._queued += 1
+
+    def begin(self, stage, frame_id):
+        """
+        Start a span ended by end(), possibly in another thread. Only the first begin() of a frame is kept.
+        """
+        start = now()
+        key = (stage, frame_id)
+        with self._lock:
+            if key not in self._open:
+                self._open[key] = start
+                if len(self._open) > self.max_open:
+                    self._open.popitem(last=False)
+
+    def end(self, stage, frame_id):
+        """
+        End a span started by begin(), ignored if it was not started or was forgotten
+        """
+        with self._lock:
+            start = self._open.pop((stage, frame_id), None)
+        if start is not None:
+            self.record(stage, frame_id, start)
+
+    def stats_text(self):
+        """
+        :return: summary of the histograms, one line per stage, in ms
+        """
+        return format_stats("{} pid {}".format(self.name, self._pid), self._histograms)
+
+    def serve_stats(self, port, host='127.0.0.1'):
+        """
+        Serve the summary of the histograms to every connection, e.g. for: nc localhost PORT
+        :param port: Port to listen to, 0 for any free port
+        :return: the address served
+        """
+        self._stats_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._stats_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._stats_sock.bind((host, port))
+        self._stats_sock.listen(5)
+        threading.Thread(target=self._serve_stats, name="TraceStats", daemon=True).start()
+        return self._stats_sock.getsockname()
+
+    def _serve_stats(self):
+        while not self._stop_event.is_set():
+            try:
+                conn, _ = self._stats_sock.accept()
+            except OSError:
+                break
+            try:
+                conn.sendall(self.stats_text().encode('ascii'))
+            except OSError:
+                pass
+            finally:
+                conn.close()
+
+    def _write_events(self):
+        # A JSON array which is never closed, which the trace viewers accept, so that the file stays valid if the
+        # process is killed
+        with open(self.path, 'w') as f:
+            f.write("[\n")
+            f.write(json.dumps({"name": "process_name", "ph": "M", "pid": self._pid, "tid": 0,
+                                "args": {"name": self.name}}) + ",\n")
+            while True:
+                stopping = self._stop_event.wait(self.flush_interval)
+                while len(self._pending) > 0:
+                    stage, frame_id, start, end, tid = self._pending.popleft()
+                    event = {"name": stage, "ph": "X", "ts": start / 1000.0, "dur": (end - start) / 1000.0,
+                             "pid": self._pid, "tid": tid}
+                    if frame_id is not None:
+                        event["args"] = {"frame": frame_id}
+                    f.write(json.dumps(event) + ",\n")
+                    self._written += 1
+                f.flush()
+                if stopping:
+                    break
+
+    def close(self):
+        """
+        Write the pending spans and stop serving the stats
+        """
+        self._stop_event.set()
+        if self._stats_sock is not None:
+            self._stats_sock.close()
+        if self._writer is not None:
+            self._writer.join()
+            dropped = self._queued - self._written
+            if dropped > 0:
+                print("Trace {}: dropped {} spans because the writer fell behind".format(self.path, dropped))
+
+
+def format_stats(title, histograms):
+    """
+    :param histograms: dict of the Histograms of durations in ns by stage
+    :return: summary of the histograms, one line per stage, in ms
+    """
+    lines = ["# " + title,
+             "{:24} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9}".format("stage", "count", "mean", "p50", "p90", "p99", "max")]
+    for stage, histogram in list(histograms.items()):
+        lines.append("{:24} {:>8} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}".format(
+            stage, histogram.count, histogram.mean() / ns_per_ms, histogram.percentile(50) / ns_per_ms,
+            histogram.percentile(90) / ns_per_ms, histogram.percentile(99) / ns_per_ms,
+            (histogram.max or 0) / ns_per_ms))
+    return "\n".join(lines) + "\n"
+
+
+# Tracer of the process, None while tracing is disabled
+_tracer = None
+
+
+def enable(name, path=None, port=None):
+    """
+    Enable tracing in this process
+    :param name: Name of the process in the stats and trace file
+    :param path: Path of the trace file, None not to write the spans
+    :param port: Port serving the stats, None not to serve them
+    :return: the Tracer
+    """
+    global _tracer
+    tracer = Tracer(name, path, metrics.registry)
+    if port is not None:
+        print("Serving latency stats of {} on {}:{}".format(name, *tracer.serve_stats(port)))
+    _tracer = tracer
+    return tracer
+
+
+def disable():
+    """
+    Disable tracing, after writing the pending spans
+    """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.close()
+
+
+def is_enabled():
+    return _tracer is not None
+
+
+def get_tracer():
+    return _tracer
+
+
+def add_arguments(parser):
+    """
+    Add the options enabling tracing to an argparse parser, see from_arguments()
+    """
+    parser.add_argument('--trace', default=None, type=str, help='file to write the latency spans to')
+    parser.add_argument('--trace-port', default=None, type=int, help='local port serving the latency stats')
+
+
+def from_arguments(name, args):
+    """
+    Enable tracing if requested by the options added by add_arguments()
+    """
+    if args.trace is not None or args.trace_port is not None:
+        enable(name, args.trace, args.trace_port)
+
+
+def span(stage, frame_id=None):
+    """
+    :return: context manager recording the duration of its block as a span of the stage, a no-op while disabled
+    """
+    tracer = _tracer
+    if tracer is None:
+        return _null_span
+    return _Span(tracer, stage, frame_id)
+
+
+def record(stage, frame_id, start, end=None):
+    """
+    Record a span measured by the caller with now()
+    """
+    tracer = _tracer
+    if tracer is not None:
+        tracer.record(stage, frame_id, start, end)
+
+
+def begin(stage, frame_id):
+    tracer = _tracer
+    if tracer is not None:
+        tracer.begin(stage, frame_id)
+
+
+def end(stage, frame_id):
+    tracer = _tracer
+    if tracer is not None:
+        tracer.end(stage, frame_id)
+
+
+def load_events(path):
+    """
+    :return: list of the span events of a trace file, which may not be closed
+    """
+    with open(path) as f:
+        text = f.read().rstrip().rstrip(',')
+    if not text.endswith(']'):
+        text += ']'
+    return [event for event in json.loads(text) if event.get("ph") == "X"]
+
+
+def report(paths, budget_ms=33.0, top=5):
+    """
+    Print the latency of every stage, and of the frames from their first to their last span across the files
+    :param paths: Trace files, e.g. of a recognizer and of fusion
+    :param budget_ms: Latency budget of a frame
+    :param top: Number of the slowest frames detailed
+    """
+    stages = OrderedDict()
+    frames = {}
+    for path in paths:
+        for event in load_events(path):
+            start, duration = int(event["ts"] * 1000), int(event["dur"] * 1000)
+            stages.setdefault(event["name"], Histogram()).record(duration)
+            frame_id = event.get("args", {}).get("frame")
+            if frame_id is not None:
+                frames.setdefault(frame_id, []).append((start, start + duration, event["name"]))
+
+    print(format_stats(", ".join(paths), stages), end='')
+
+    latencies = Histogram()
+    over = []
+    for frame_id, spans in frames.items():
+        latency = max(e for _, e, _ in spans) - min(s for s, _, _ in spans)
+        latencies.record(latency)
+        if latency > budget_ms * ns_per_ms:
+            over.append((latency, frame_id, spans))
+    print("{} frames, latency ms: p50 {:.3f} p90 {:.3f} p99 {:.3f} max {:.3f}, {} over the {} ms budget".format(
+        latencies.count, latencies.percentile(50) / ns_per_ms, latencies.percentile(90) / ns_per_ms,
+        latencies.percentile(99) / ns_per_ms, (latencies.max or 0) / ns_per_ms, len(over), budget_ms))
+    over.sort(reverse=True)
+    for latency, frame_id, spans in over[:top]:
+        first = min(s for s, _, _ in spans)
+        print("frame {}: {:.3f} ms | {}".format(frame_id, latency / ns_per_ms, " ".join(
+            "{}@{:.1f}+{:.1f}".format(name, (s - first) / ns_per_ms, (e - s) / ns_per_ms)
+            for s, e, name in sorted(spans))))
+
+
+if __name__ == '__main__':
+    # Summarizes trace files, or, without arguments, checks the spans and measures their cost
+    # Run as: python -m components.fusion.conf.trace [report FILE [FILE ...] [--budget MS]]
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', nargs='?', choices=['report'])
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('--budget', default=33.0, type=float, help='latency budget of a frame in ms')
+    args = parser.parse_args()
+
+    if args.command == 'report':
+        report(args.files, args.budget)
+    else:
+        count = 100000
+        start = time.perf_counter()
+        for i in range(count):
+            with span("disabled", i):
+                pass
+        disabled = time.perf_counter() - start
+
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "check.json")
+        tracer = enable("check", path, 0)
+        start = time.perf_counter()
+        for i in range(count):
+            with span("enabled", i):
+                pass
+        enabled = time.perf_counter() - start
+        for i in range(10):
+            begin("sync", i)
+            begin("sync", i)
+        end("sync", 3)
+        end("sync", 42)
+        with socket.create_connection(tracer._stats_sock.getsockname()) as sock:
+            stats = b""
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                stats += data
+        disable()
+        print(stats.decode('ascii'), end='')
+        events = load_events(path)
+        assert [e["name"] for e in events].count("sync") == 1 and len(events) <= count + 1
+        print("{} spans written, {} dropped".format(len(events), count + 1 - len(events)))
+        report([path], budget_ms=0.001, top=1)
+        os.remove(path)
+        os.rmdir(directory)
+        print("Span cost: disabled {:.2f} us, enabled {:.2f} us".format(disabled * 1e6 / count, enabled * 1e6 / count))
@@ -0,0 +1,295 @@
+import asyncio
+import struct
+
+from .conf import batch
+from .conf import shm
+from .conf import streams
+from .conf.endpoints import serve
+from .fusion_thread import Fusion
+
+_frame_size = struct.Struct("<i")
+
+
+class AsyncFusion(Fusion):
+    """
+    Fusion ingest server running an asyncio event loop in its own thread.
+    Every recognizer is read by its own StreamReader coroutine, so a slow or half-sent client only delays its own
+    stream, and the loop sleeps while no data arrives instead of waking up to poll the sockets.
+    Registration, decoding and synchronization are the same as in Fusion, so the two can be used interchangeably.
+    """
+
+    def __init__(self, synchronizer=None, poll_interval=0.01, ring_capacity=shm.default_capacity):
+        """
+        :param synchronizer: Synchronizer of the active streams deciding which messages are fused together,
+                             None to only sync messages with the exact same timestamp
+        :param poll_interval: Seconds between polls of the synchronizer while it holds data
+        :param ring_capacity: Size in bytes of the shared memory ring of each client on this machine asking for one,
+                              None to only accept messages over TCP
+        """
+        Fusion.__init__(self, synchronizer, ring_capacity)
+        # Keyed by the StreamWriter of each client
+        self._connected_clients = {}
+        self._poll_interval = poll_interval
+        self._loop = None
+        self._stopped = None
+        self._received = None
+
+    def stop(self):
+        Fusion.stop(self)
+        loop = self._loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._stopped.set)
+            except RuntimeError:
+                # The loop is already closed
+                pass
+
+    async def _read_frame(self, reader):
+        (frame_size,) = _frame_size.unpack(await reader.readexactly(_frame_size.size))
+        return await reader.readexactly(frame_size)
+
+    async def _handle_stream(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        try:
+            registration = await self._read_frame(reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print("Unable to receive registration data for stream. Ignoring the client")
+            writer.close()
+            return
+
+        registered = self._register_stream(registration, addr,
+                                           shm.is_local(writer.get_extra_info('sockname'), addr))
+        if registered is None:
+            writer.close()
+            return
+
+        stream_names, accepted_flags = registered
+        ring, accepted_flags = self._create_ring(accepted_flags)
+        writer.write(self._registration_reply(registration, accepted_flags, ring))
+        writer.write_eof()
+        self._connected_clients[writer] = stream_names
+        batched = accepted_flags & batch.BATCHED != 0
+        try:
+            if ring is not None:
+                await self._read_ring(reader, shm.RingReader(ring), stream_names, batched)
+            while ring is None:
+                for msg in self._decode_messages(await self._read_frame(reader), stream_names, batched):
+                    self._handle_message(msg)
+                self._received.set()
+        except (asyncio.IncompleteReadError, ConnectionError, EOFError, struct.error,
+                streams.InvalidStreamError) as ex:
+            print(ex)
+            print("Disconnecting client...")
+        finally:
+            self._connected_clients.pop(writer)
+            writer.close()
+            if ring is not None:
+                ring.close()
+            self._unset_sync()
+            print("Disconnected")
+
+    async def _read_ring(self, reader, ring_reader, stream_names, batched):
+        # The stream only carries notifications, sent when the ring was empty. As one may race with the end of the
+        # previous read, the ring is also checked every recheck_interval while the client is silent
+        while True:
+            try:
+                notifications = await asyncio.wait_for(reader.read(4096), shm.recheck_interval)
+            except asyncio.TimeoutError:
+                notifications = None
+            msgs = self._handle_ring(ring_reader, stream_names, batched, False)
+            for msg in msgs:
+                self._handle_message(msg)
+            if len(msgs) > 0:
+                self._received.set()
+            if notifications == b'':
+                raise EOFError("Client closed the connection")
+
+    async def _poll(self):
+        # Only poll while the synchronizer holds data, so that an idle server does not wake up
+        while True:
+            await self._received.wait()
+            self._received.clear()
+            while len(self._synchronizer) > 0:
+                await asyncio.sleep(self._poll_interval)
+                # Emit the data whose deadline passed while no data was received
+                self._put_synced(self._synchronizer.poll())
+
+    async def _serve(self):
+        self._stopped = asyncio.Event()
+        self._received = asyncio.Event()
+        # The running loop, asyncio.get_running_loop() needs Python 3.7
+        self._loop = asyncio.get_event_loop()
+        if self.is_stopped():
+            return
+
+        server = await asyncio.start_server(self._handle_stream, sock=serve('fusion'), backlog=5)
+        poller = asyncio.ensure_future(self._poll())
+        print("Waiting for clients to connect")
+
+        await self._stopped.wait()
+        poller.cancel()
+        for writer in list(self._connected_clients.keys()):
+            writer.close()
+        server.close()
+        await server.wait_closed()
+
+    def run(self):
+        # As asyncio.run(), which needs Python 3.7
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._serve())
+            # The handlers of the clients which have not noticed yet that they were closed
+            all_tasks = asyncio.all_tasks if hasattr(asyncio, 'all_tasks') else asyncio.Task.all_tasks
+            pending = [task for task in all_tasks(loop) if not task.done()]
+            for task in pending:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        finally:
+            loop.close()
+        print("Stopped network thread")
+
+
+if __name__ == '__main__':
+    # Benchmark of the thread and asyncio ingest servers with simulated clients. The clients run in a separate process,
+    # which sends the 5 active streams at 30 Hz, and N - 5 misbehaving clients trickling their registration frame
+    # Run as: python -m components.fusion.fusion_async [--help]
+    import argparse
+    import multiprocessing
+    import os
+    import queue
+    import random
+    import socket
+    import sys
+    import threading
+    import time
+
+    from .conf.endpoints import connect
+    from .conf.postures import right_hand_postures
+    from . import thread_sync
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', default=[5, 10, 20], type=int, nargs='+', help='numbers of clients to simulate')
+    parser.add_argument('--duration', default=5.0, type=float, help='seconds of data sent per run')
+    parser.add_argument('--rate', default=30.0, type=float, help='frame rate of the Kinect')
+    parser.add_argument('--trickle', default=0.02, type=float,
+                        help='seconds a misbehaving client waits in the middle of its registration frame')
+    parser.add_argument('--seed', default=0, type=int, help='random seed')
+    args = parser.parse_args()
+
+    ticks_per_sec = 10000000
+    recognizers = ["LH", "RH", "Body", "Speech", "Emotion"]
+
+    def payload(name, ts):
+        sid = streams.get_stream_id(name)
+        if name in ("LH", "RH"):
+            n = len(right_hand_postures)
+            return struct.pack("<iqi" + "f" * n, sid, ts, n - 1, *((0.0,) * (n - 1) + (1.0,)))
+        if name == "Body":
+            return struct.pack("<iqii" + "ffff" * 2 + "ff" * 8 + "i", sid, ts, 0, 0, *((0.5,) * 24), 1)
+        if name == "Speech":
+            return struct.pack("<iqi", sid, ts, 0)
+        if name == "Emotion":
+            return struct.pack("<iqif", sid, ts, 2, 1.0)
+
+    def trickle_client(stop, delay):
+        # Registers an already connected stream with the registration frame split in two, so it is always rejected
+        registration = struct.pack('<iBi', 5, 1, streams.get_stream_id("Body"))
+        while not stop.is_set():
+            try:
+                sock = socket.create_connection(('localhost', 9125))
+            except socket.error:
+                # The listen backlog is full while the server is stuck
+                time.sleep(delay)
+                continue
+            try:
+                sock.sendall(registration[:6])
+                time.sleep(delay)
+                sock.sendall(registration[6:])
+                sock.recv(1)
+            except socket.error:
+                pass
+            finally:
+                sock.close()
+
+    def run_clients(n_clients, ready, sent, done):
+        sys.stdout = open(os.devnull, 'w')
+        rng = random.Random(args.seed)
+        ready.wait()
+        socks = [connect('fusion', 'localhost', name, transport='tcp') for name in recognizers]
+        time.sleep(0.5)
+        stop = threading.Event()
+        tricklers = [threading.Thread(target=trickle_client, args=(stop, args.trickle), daemon=True)
+                     for _ in range(n_clients - len(recognizers))]
+        for t in tricklers:
+            t.start()
+
+        period = 1.0 / args.rate
+        next_frame = time.monotonic()
+        end = next_frame + args.duration
+        while next_frame < end:
+            ts = int(next_frame * ticks_per_sec)
+            # Recognizers finish in a random order, and send the size and the data separately like the clients do
+            for i in rng.sample(range(len(socks)), len(socks)):
+                data = payload(recognizers[i], ts)
+                socks[i].sendall(struct.pack("<i", len(data)))
+                socks[i].sendall(data)
+            next_frame += period
+            time.sleep(max(0.0, next_frame - time.monotonic()))
+
+        stop.set()
+        sent.set()
+        done.wait()
+        for sock in socks:
+            sock.close()
+
+    def run_server(ingest, results, ready, sent, done):
+        sys.stdout = open(os.devnull, 'w')
+        fusion = ingest()
+        fusion.start()
+        time.sleep(0.5)
+        # CPU used while nothing is connected
+        cpu_start, wall_start = time.process_time(), time.monotonic()
+        time.sleep(1.0)
+        idle_cpu = (time.process_time() - cpu_start) / (time.monotonic() - wall_start)
+        ready.set()
+
+        latencies = []
+        cpu_start = wall_start = None
+        # Collect until the clients are done and the synced messages are drained
+        while not sent.is_set() or not thread_sync.synced_msgs.empty():
+            try:
+                s_msg = thread_sync.synced_msgs.get(True, 0.1)
+            except queue.Empty:
+                continue
+            now = time.monotonic()
+            if cpu_start is None:
+                cpu_start, wall_start = time.process_time(), now
+            latencies.append(now - s_msg["LH"].header.timestamp / float(ticks_per_sec))
+        busy_cpu = (time.process_time() - cpu_start) / (time.monotonic() - wall_start) if latencies else 0.0
+        done.set()
+        fusion.stop()
+        results.put((idle_cpu, busy_cpu, sorted(latencies)))
+
+    print("{} s at {} Hz, misbehaving clients wait {} ms in their registration".format(
+        args.duration, args.rate, args.trickle * 1000))
+    for n_clients in args.clients:
+        for label, ingest in (('thread', Fusion), ('asyncio', AsyncFusion)):
+            results = multiprocessing.Queue()
+            ready, sent, done = multiprocessing.Event(), multiprocessing.Event(), multiprocessing.Event()
+            server = multiprocessing.Process(target=run_server, args=(ingest, results, ready, sent, done))
+            clients = multiprocessing.Process(target=run_clients, args=(n_clients, ready, sent, done))
+            server.start()
+            clients.start()
+            idle_cpu, busy_cpu, latencies = results.get()
+            server.join()
+            clients.join()
+            frames = int(args.duration * args.rate)
+            if len(latencies) == 0:
+                print("{:>2} clients {:8} nothing synced".format(n_clients, label))
+                continue
+            print("{:>2} clients {:8} CPU idle {:5.1f}% busy {:5.1f}% | {:>4}/{} synced | "
+                  "latency ms: p50 {:7.2f} p99 {:7.2f} max {:7.2f}".format(
+                      n_clients, label, idle_cpu * 100, busy_cpu * 100, len(latencies), frames,
+                      latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000,
+                      latencies[-1] * 1000))
@@ -2,22 +2,40 @@ import sys
 import time
 import argparse
 import struct
-import queue
 import csv
 
 import numpy as np
 
 from components.fusion.automata import machines as machines
 from components.fusion.fusion_thread import Fusion
-from components.fusion.remote_thread import Remote
+from components.fusion.fusion_async import AsyncFusion
+from components.fusion import sync
+from components.fusion.remote_thread import Remote, overflow_policies
 from components.fusion import thread_sync
 from components.fusion.conf import streams
 from components.fusion.conf import postures
+from components.fusion.conf import metrics
+from components.fusion.conf import trace
+from components.replay.session import SessionWriter
 
 
 class App:
 
-    def __init__(self, state_machines, debug, capture):
+    ingest_servers = {'thread': Fusion, 'asyncio': AsyncFusion}
+
+    def __init__(self, state_machines, debug, capture, sync_policy='exact', sync_options=None, ingest='thread',
+                 remote_options=None, session=None):
+        """
+        :param sync_policy: Name of the policy in sync.policies used to sync the streams
+        :param sync_options: Keyword arguments of the policy's synchronizer besides the stream names
+        :param ingest: Name of the server in App.ingest_servers receiving the streams
+        :param remote_options: Keyword arguments of the Remote output threads, e.g. max_queued and overflow
+        :param session: Path of a session directory to record the synced recognizer outputs in, None not to record
+        """
+        self.ingest = ingest
+        self.remote_options = remote_options if remote_options is not None else {}
+        self.sync_policy = sync_policy
+        self.sync_options = sync_options if sync_options is not None else {}
         self._start()
 
         # Initialize the state manager
@@ -26,6 +44,10 @@ class App:
         # For performance evaluation
         self.skipped = 0
         self.received = 0
+        self._received_metric = metrics.counter("synced_received")
+        self._skipped_metric = metrics.counter("synced_skipped")
+        self._backlog_metric = metrics.gauge("synced_backlog")
+        self._events_metric = metrics.counter("events")
         self.debug = debug
 
         if capture:
@@ -36,6 +58,11 @@ class App:
         if self.capture_csv is not None:
             self.capture_csv.writerow(['engaged', 'attentive', 'la', 'ra', 'lh', 'rh', 'head', 'speech'])
 
+        # Written from a background thread, so recording never slows down the loop
+        self.session = SessionWriter(session) if session is not None else None
+        if self.session is not None:
+            print("Recording session {}".format(session))
+
     def _stop(self):
         # Stop the fusion thread
         self.fusion.stop()
@@ -51,41 +78,48 @@ class App:
 
         # Clear sync queque in case resetting
         self._clear_synced_data()
+        thread_sync.synced_msgs.reset_stats()
 
         self.skipped = 0
         self.received = 0
 
     def _clear_synced_data(self):
-        not_empty = True
-        while not_empty:
-            try:
-                thread_sync.synced_msgs.get_nowait()
-            except queue.Empty:
-                not_empty = False
+        thread_sync.synced_msgs.clear()
 
     def _start(self):
         # Start fusion thread
-        self.fusion = Fusion()
+        synchronizer = sync.policies[self.sync_policy](streams.get_active_streams(), **self.sync_options)
+        self.fusion = App.ingest_servers[self.ingest](synchronizer)
         self.fusion.start()
         self.started = True
 
         # Start server thread for Brandeis
-        self.remote = Remote('Brandeis', 'brandeis', thread_sync.remote_events, thread_sync.remote_connected)
+        self.remote = Remote('Brandeis', 'brandeis', thread_sync.remote_events, thread_sync.remote_connected,
+                             **self.remote_options)
         self.remote.start()
         self.remote_started = True
 
         # Start server thread for GUI
-        self.gui = Remote('GUI', 'gui', thread_sync.gui_events, thread_sync.gui_connected)
+        self.gui = Remote('GUI', 'gui', thread_sync.gui_events, thread_sync.gui_connected, **self.remote_options)
         self.gui.start()
         self.gui_started = True
 
     def _print_summary(self):
         """
-        Prints a summary of skipped timestamps to keep up with the input rate
+        Prints a summary of skipped timestamps to keep up with the input rate, and of the messages dropped for
+        slow destinations
         :return: Nothing
         """
         if self.received > 0:
-            print("Skipped {:.2f}%".format(self.skipped * 100.0 / self.received))
+            print("Skipped {:.2f}%".format(self.skipped * 100.0 / (self.received + self.skipped)))
+        for name, q in (('Synced', thread_sync.synced_msgs), ('Brandeis', thread_sync.remote_events),
+                        ('GUI', thread_sync.gui_events)):
+            print("{} queue: {stats.put} put, {stats.dropped} dropped, high water mark {stats.high_water}/"
+                  "{stats.capacity}".format(name, stats=q.stats()))
+        for remote in (self.remote, self.gui):
+            for stats in remote.subscriber_stats():
+                print("{} destination {addr[0]}:{addr[1]}: sent {sent}, dropped {dropped}, queued {queued}".format(
+                    remote.name, **stats._asdict()))
 
     def _exit(self):
         """
@@ -96,6 +130,11 @@ class App:
         self._stop()
         if self.capture_file is not None:
             self.capture_file.close()
+        if self.session is not None:
+            self.session.close()
+        if trace.is_enabled():
+            print(trace.get_tracer().stats_text(), end='')
+            trace.disable()
         sys.exit(0)
 
     def run(self):
@@ -115,15 +154,20 @@ class App:
         self.latest_s_msg = thread_sync.synced_msgs.get(True)
         if self.debug:
             print("Latest synced message: {}".format(self.latest_s_msg), end='\n\n')
+        if self.session is not None:
+            self.session.append_synced(self.latest_s_msg)
 
         self._update_queues()
         self.received += 1
-        if thread_sync.synced_msgs.qsize() <= 15:
-            if self.debug:
-                print("Backlog queue size exceeded limit: {}".format(thread_sync.synced_msgs.qsize()))
-        else:
-            self.skipped += 1
-            print("Skipping because backlog too large: {}".format(thread_sync.synced_msgs.qsize()))
+        # The synced queue drops the oldest messages when the loop falls behind
+        self._received_metric.inc()
+        dropped = thread_sync.synced_msgs.stats().dropped
+        if dropped > self.skipped:
+            self._skipped_metric.inc(dropped - self.skipped)
+            self.skipped = dropped
+        self._backlog_metric.set(thread_sync.synced_msgs.qsize())
+        if self.debug:
+            print("Backlog queue size: {}".format(thread_sync.synced_msgs.qsize()))
 
     def _get_probs(self):
 
@@ -273,18 +317,23 @@ class App:
         :return: None
         """
 
-        raw_events_list = self._prepare_events()
-        raw_probs = self._prepare_probs()
+        # With exact sync, every stream of the synced message has the timestamp of the frame
+        frame_id = min(msg.header.timestamp for msg in self.latest_s_msg.values())
+        with trace.span("state_machines", frame_id):
+            raw_events_list = self._prepare_events()
+            raw_probs = self._prepare_probs()
+        self._events_metric.inc(len(raw_events_list))
 
-        # Include a check to see if the destination is connected or not
-        for e in raw_events_list:
-            if thread_sync.remote_connected.is_set():
-                thread_sync.remote_events.put(e)
+        with trace.span("remote_enqueue", frame_id):
+            # Include a check to see if the destination is connected or not
+            for e in raw_events_list:
+                if thread_sync.remote_connected.is_set():
+                    thread_sync.remote_events.put(e)
 
-        if thread_sync.gui_connected.is_set():
-            ev_count = struct.pack("<i", len(raw_events_list))
-            new_ev = ev_count + b''.join(raw_events_list) + raw_probs
-            thread_sync.gui_events.put(new_ev)
+            if thread_sync.gui_connected.is_set():
+                ev_count = struct.pack("<i", len(raw_events_list))
+                new_ev = ev_count + b''.join(raw_events_list) + raw_probs
+                thread_sync.gui_events.put(new_ev)
 
 
 def create_one_shot_learning_events(n):
@@ -327,6 +376,27 @@ if __name__ == '__main__':
                         help="the mode in which fusion server is run")
     parser.add_argument('-d', '--debug', dest='debug_mode', default=False, action='store_true', help='enable the debug mode')
     parser.add_argument('-c', '--capture', dest='capture_mode', default=False, action='store_true', help='captures incoming data')
+    parser.add_argument('--session', default=None, type=str,
+                        help="directory to record the synced recognizer outputs in, as a session readable with "
+                             "components.replay.session.SessionReader")
+    metrics.add_arguments(parser)
+    trace.add_arguments(parser)
+    parser.add_argument('--sync', choices=sorted(sync.policies.keys()), default='exact', type=str,
+                        help="sync streams with the exact same timestamp, with timestamps within a tolerance, "
+                             "or with the latest data of every stream")
+    parser.add_argument('--sync-tolerance', default=20.0, type=float,
+                        help="tolerance in ms between timestamps synced together in approximate mode")
+    parser.add_argument('--sync-max-latency', default=100.0, type=float,
+                        help="ms to wait for missing streams before marking them blind in approximate and latest "
+                             "modes, 0 to wait until they send newer data")
+    parser.add_argument('--sync-history', default=30, type=int,
+                        help="number of timestamps held while waiting for missing streams in exact and approximate modes")
+    parser.add_argument('--ingest', choices=sorted(App.ingest_servers.keys()), default='thread', type=str,
+                        help="receive the streams with a select() loop thread, or with an asyncio event loop")
+    parser.add_argument('--remote-overflow', choices=overflow_policies, default='drop_oldest', type=str,
+                        help="what to do with a destination whose output buffer is full")
+    parser.add_argument('--remote-max-queued', default=64, type=int,
+                        help="number of messages buffered for each destination")
     args = parser.parse_args()
 
     if args.mode == 'brandeis':
@@ -338,5 +408,20 @@ if __name__ == '__main__':
     else:
         event_set = None
 
-    a = App(event_set, args.debug_mode, args.capture_mode)
+    print("Syncing streams in {} mode".format(args.sync))
+    sync_max_latency = args.sync_max_latency / 1000.0 if args.sync_max_latency > 0 else None
+    if args.sync == 'approximate':
+        print("Approximate sync with tolerance {} ms".format(args.sync_tolerance))
+        sync_options = {'tolerance': args.sync_tolerance * sync.ticks_per_ms, 'max_latency': sync_max_latency,
+                        'history': args.sync_history}
+    elif args.sync == 'latest':
+        sync_options = {'max_latency': sync_max_latency}
+    else:
+        sync_options = {'history': args.sync_history}
+
+    metrics.from_arguments("fusion_server", args)
+    trace.from_arguments("fusion_server", args)
+    remote_options = {'max_queued': args.remote_max_queued, 'overflow': args.remote_overflow}
+
+    a = App(event_set, args.debug_mode, args.capture_mode, args.sync, sync_options, args.ingest, remote_options, args.session)
     a.run()
@@ -4,11 +4,22 @@ import struct
 import threading
 from collections import namedtuple
 
+from .conf import batch
+from .conf import codecs
+from .conf import shm
 from .conf import streams
-from .conf.postures import right_hand_postures, head_postures
+from .conf import trace
+from .conf.postures import left_hand_postures, right_hand_postures, head_postures, left_arm_motions
 from .conf.endpoints import serve
+from .conf.reader import FrameReader
+from .sync import ExactSynchronizer
 from .thread_sync import synced_msgs
 
+_body_codec = codecs.get_codec_by_name("Body")
+_head_codec = codecs.get_codec_by_name("Head")
+_speech_codec = codecs.get_codec_by_name("Speech")
+_emotion_codec = codecs.get_codec_by_name("Emotion")
+
 
 class Fusion(threading.Thread):
 
@@ -30,57 +41,48 @@ class Fusion(threading.Thread):
 
     Message = namedtuple('Message', ['header', 'data'])
 
-    def __init__(self):
+    def __init__(self, synchronizer=None, ring_capacity=shm.default_capacity):
+        """
+        :param synchronizer: Synchronizer of the active streams deciding which messages are fused together,
+                             None to only sync messages with the exact same timestamp
+        :param ring_capacity: Size in bytes of the shared memory ring of each client on this machine asking for one,
+                              None to only accept messages over TCP
+        """
         threading.Thread.__init__(self)
         self.daemon = True
-        self._msgs_received = {}
+        if synchronizer is None:
+            synchronizer = ExactSynchronizer(streams.get_active_streams())
+        self._synchronizer = synchronizer
+        self._ring_capacity = ring_capacity
+        self._last_data = {}
+        self._readers = {}
+        # Sockets of the clients sending batches
+        self._batched = set()
         self._stop = threading.Event()
         self._synced = False
 
-    def _recv_all(self, sock, size):
-        result = b''
-        while len(result) < size:
-            data = sock.recv(size - len(result))
-            if not data:
-                raise EOFError("Error: Received only {} bytes into {} byte message".format(len(data), size))
-            result += data
-        return result
-
-    def _read_stream_header(self, sock):
-        # Length, ID, Timestamp
-        header_format = "<iiq"
-        stream_header = self._recv_all(sock, struct.calcsize(header_format))
-        header_data = struct.unpack(header_format, stream_header)
-        _, header_id, ts = header_data
-        try:
-            stream_name = streams.get_stream_name(header_id)
-        except KeyError:
-            print("Invalid stream id: {}".format(header_id))
-            sock.close()
-            return
+    def _read_stream_header(self, frame):
+        # ID, Timestamp
+        # The length is consumed by the reader
+        header_id, ts = codecs.header.unpack_from(frame)
+        stream_name = streams.get_stream_name(header_id)
+        return Fusion.Header(header_id, ts, stream_name), codecs.header.size
 
-        header_data += (stream_name,)
-        return Fusion.Header(*header_data[1:])
-
-    def _read_body_data(self, sock):
+    def _read_body_data(self, frame, offset):
         # Left Max Index, Right Max Index
         # Left point x, y, var_x, var_y, Right point x, y, var_x, var_y
         # 8 probabilities for move left, right, up, down, front, back, still, servo * 2
         # Engage (1/0)
-        data_format = "<" + "ii" + "4f" * 2 + "8f" * 2 + "i"
-        raw_data = self._recv_all(sock, struct.calcsize(data_format))
-        body_data = struct.unpack(data_format, raw_data)
+        body_data = _body_codec.unpack_content_from(frame, offset)
         larm_probs = body_data[-17:-9]
         rarm_probs = body_data[-9:-1]
         engaged = body_data[-1] == 1
         body_data = body_data[:-17] + (larm_probs, rarm_probs, engaged)
         return Fusion.BodyData(*body_data)
 
-    def _read_hands_data(self, sock, hand):
+    def _read_hands_data(self, frame, offset, hand):
         # Max Index, Probabilities
-        data_format = "<" + "i" + "f" * len(right_hand_postures)
-        raw_data = self._recv_all(sock, struct.calcsize(data_format))
-        hand_data = struct.unpack(data_format, raw_data)
+        hand_data = codecs.get_codec_by_name(hand).unpack_content_from(frame, offset)
         if hand == 'LH':
             hand_type = 'left'
         elif hand == 'RH':
@@ -94,61 +96,144 @@ class Fusion(threading.Thread):
         #     print(right_hand_postures[max_idx], hand_data[1:][max_idx])
         return data
 
-    def _read_head_data(self, sock):
-        data_format = "<" + "i" + "f" * len(head_postures)
-        raw_data = self._recv_all(sock, struct.calcsize(data_format))
-        head_data = struct.unpack(data_format, raw_data)
+    def _read_head_data(self, frame, offset):
+        head_data = _head_codec.unpack_content_from(frame, offset)
         return Fusion.HeadData(head_data[0], head_data[1:])
 
-    def _read_speech_data(self, sock):
-        # Expect little endian byte order
-        endianness = "<"
-        command_length = struct.unpack(endianness + "i", self._recv_all(sock, 4))[0]
-        command_bytes = self._recv_all(sock, command_length)
-        command = struct.unpack(endianness + str(command_length) + "s", command_bytes)[0]
+    def _read_speech_data(self, frame, offset):
+        command, = _speech_codec.unpack_content_from(frame, offset)
         command = command.decode('ascii')
         return Fusion.SpeechData(command)
 
-    def _read_emotion_data(self, sock):
-        data_format = "<" + "i" + "f"
-        raw_data = self._recv_all(sock, struct.calcsize(data_format))
-        emotion_data = struct.unpack(data_format, raw_data)
+    def _read_emotion_data(self, frame, offset):
+        emotion_data = _emotion_codec.unpack_content_from(frame, offset)
         probabilities = emotion_data[1:]
         attentive = emotion_data[0]
         return Fusion.EmotionData(probabilities, attentive)
 
-    def _read_stream_data(self, sock, stream_id):
-        stream_name = streams.get_stream_name(stream_id)
+    def _read_stream_data(self, frame, offset, stream_name):
         if stream_name in ["LH", "RH"]:
-            return self._read_hands_data(sock, stream_name)
+            return self._read_hands_data(frame, offset, stream_name)
         elif stream_name == "Body":
-            return self._read_body_data(sock)
+            return self._read_body_data(frame, offset)
         elif stream_name == "Head":
-            return self._read_head_data(sock)
+            return self._read_head_data(frame, offset)
         elif stream_name == "Speech":
-            return self._read_speech_data(sock)
+            return self._read_speech_data(frame, offset)
         elif stream_name == "Emotion":
-            return self._read_emotion_data(sock)
+            return self._read_emotion_data(frame, offset)
 
-    def _handle_client(self, sock):
-        header = self._read_stream_header(sock)
-        data = self._read_stream_data(sock, header.id)
+    def _decode_message(self, frame):
+        header, offset = self._read_stream_header(frame)
+        data = self._read_stream_data(frame, offset, header.name)
         return Fusion.Message(header, data)
 
+    def _decode_messages(self, frame, stream_names, batched):
+        """
+        Decode a frame received from a client
+        :param frame: Frame excluding the size field
+        :param stream_names: Names of the streams registered by the client
+        :param batched: True if the client sends batches
+        :return: list of the decoded messages
+        """
+        if not batched:
+            return [self._decode_message(frame)]
+
+        try:
+            msgs = [self._decode_message(message) for message in batch.iter_messages(frame)]
+        except struct.error as ex:
+            raise streams.InvalidStreamError("Malformed batch: {}".format(ex))
+        for msg in msgs:
+            if msg.header.name not in stream_names:
+                raise streams.InvalidStreamError("Stream not registered by the client: {}".format(msg.header.name))
+        return msgs
+
+    def _handle_client(self, sock, notified=True):
+        reader = self._readers[sock]
+        if isinstance(reader, shm.RingReader):
+            return self._handle_ring(reader, self._connected_clients[sock], sock in self._batched, notified)
+        # The whole frame is received at once and decoded in place
+        return self._decode_messages(reader.read_frame(), self._connected_clients[sock], sock in self._batched)
+
+    def _handle_ring(self, reader, stream_names, batched, notified):
+        """
+        Decode the messages of a client sending them through shared memory
+        :param notified: True if the client notified new messages, False to only check the ring
+        :return: list of the decoded messages
+        """
+        connected = reader.recv_notifications() if notified else True
+        try:
+            # Each message is decoded in place before the next one is read, which releases it to the client
+            msgs = [msg for frame in reader.frames() for msg in self._decode_messages(frame, stream_names, batched)]
+        except struct.error as ex:
+            raise streams.InvalidStreamError(ex)
+        if not connected and len(msgs) == 0:
+            raise EOFError("Client closed the connection")
+        return msgs
+
+    def _connected_streams(self):
+        return frozenset().union(*self._connected_clients.values())
+
+    def _handle_message(self, msg):
+        # Read and discard data unless enough clients connect
+        if not streams.all_connected(self._connected_streams()):
+            return
+
+        self._last_data[msg.header.name] = msg.data
+
+        # From the first message of the frame until it is synced
+        trace.begin("sync", msg.header.timestamp)
+        self._put_synced(self._synchronizer.feed(msg.header.name, msg.header.timestamp, msg))
+
+    def _blind_message(self, stream_name, timestamp):
+        """
+        Create a message marking a stream as blind, used for the streams missing from a partially synced message
+        """
+        if stream_name in ["LH", "RH"]:
+            hand_postures = left_hand_postures if stream_name == "LH" else right_hand_postures
+            probabilities = (0.0,) * (len(hand_postures) - 1) + (1.0,)
+            data = Fusion.HandData(len(hand_postures) - 1, probabilities, 'left' if stream_name == "LH" else 'right')
+        elif stream_name == "Body":
+            # Engagement is a state rather than a per frame observation, so the last known value is kept
+            last_body = self._last_data.get("Body")
+            engaged = last_body.engaged if last_body is not None else False
+            arm_probs = (0.0,) * 7 + (1.0,)
+            data = Fusion.BodyData(len(left_arm_motions) - 1, len(left_arm_motions) - 1, *((0.0,) * 8),
+                                   p_l_arm=arm_probs, p_r_arm=arm_probs, engaged=engaged)
+        elif stream_name == "Head":
+            data = Fusion.HeadData(len(head_postures) - 1, (0.0,) * (len(head_postures) - 1) + (1.0,))
+        elif stream_name == "Speech":
+            data = Fusion.SpeechData("")
+        elif stream_name == "Emotion":
+            # Same as attention, keep the last known value, or report no face found
+            data = self._last_data.get("Emotion", Fusion.EmotionData((0.0,), 0))
+        else:
+            raise streams.InvalidStreamError("Invalid stream name: {}".format(stream_name))
+
+        return Fusion.Message(Fusion.Header(streams.get_stream_id(stream_name), timestamp, stream_name), data)
+
+    def _put_synced(self, synced):
+        for synced_data in synced:
+            self._set_sync(synced_data.timestamp)
+            # Shared data object representing the synced data, indexed by stream type
+            # Value is the entire decoded frame of that stream type
+            s_msg = synced_data.data
+            for msg in s_msg.values():
+                trace.end("sync", msg.header.timestamp)
+            for stream_name in synced_data.missing:
+                s_msg[stream_name] = self._blind_message(stream_name, synced_data.timestamp)
+            synced_msgs.put(s_msg)
+
     def _set_sync(self, sync_ts):
         if not self._synced:
             print("Synchronized at timestamp: {}".format(sync_ts))
             self._synced = True
-            # Remove all older timestamps the instant we find a sync timestamp
-            for t in list(self._msgs_received.keys()):
-                if t < sync_ts:
-                    self._msgs_received.pop(t)
 
     def _unset_sync(self):
+        self._synchronizer.reset()
         if self._synced:
             print("Synchronization lost")
             self._synced = False
-            self._msgs_received.clear()
 
     def _is_synced(self):
         return self._synced
@@ -159,37 +244,118 @@ class Fusion(threading.Thread):
     def is_stopped(self):
         return self._stop.is_set()
 
-    def _accept_stream(self, sock, addr):
+    def _register_stream(self, registration, addr, local=False):
+        """
+        Verify the registration frame of a new client
+        # client type (byte) | stream id (int) | flags (byte, optional)
+        A client asking for batched framing may register several streams at once, with the bitwise or of their ids
+        :param registration: registration frame, excluding the size field
+        :param addr: address of the client
+        :param local: True if the client runs on this machine, and can share memory
+        :return: (names of the streams, accepted flags) if the client can be accepted, None otherwise
+        """
         try:
-            stream_reg_len, = struct.unpack('<i', self._recv_all(sock, 4))
-            client_type, stream_id = struct.unpack('<Bi', self._recv_all(sock, stream_reg_len))
-        except Exception:
+            client_type, stream_id = struct.unpack_from('<Bi', registration)
+        except struct.error:
             print("Unable to receive registration data for stream. Ignoring the client")
-            return False
+            return None
+        flags = registration[5] if len(registration) > 5 else 0
 
         print("Received stream registration request. Verifying...")
         if client_type != 1:
             print("Only recognizers are allowed to connect to fusion. Here, client type is {0}. Rejecting the connection".format(client_type))
-            return False
+            return None
 
-        if streams.is_valid_id(stream_id):
+        accepted_flags = flags & (batch.BATCHED |
+                                  (shm.SHARED_MEMORY if local and self._ring_capacity and shm.is_available() else 0))
+        if accepted_flags & batch.BATCHED:
+            stream_ids = [1 << bit for bit in range(31) if stream_id & (1 << bit)] if stream_id > 0 else [stream_id]
+        else:
+            stream_ids = [stream_id]
+
+        stream_names = []
+        connected_streams = self._connected_streams()
+        for stream_id in stream_ids:
+            if not streams.is_valid_id(stream_id):
+                print("Rejecting invalid stream with id: {}".format(stream_id))
+                return None
             stream_name = streams.get_stream_name(stream_id)
-            if streams.is_active(stream_name):
-                print("Stream is valid and active: {}".format(stream_name))
-                print("Checking if stream is already connected...")
-                if stream_name not in self._connected_clients.values():
-                    print("New stream. Accepting the connection {}:{}".format(addr[0], addr[1]))
-                    sock.shutdown(socket.SHUT_WR)
-                    self._connected_clients[sock] = stream_name
-                    return True
-                else:
-                    print("Stream already exists. Rejecting the connection")
-            else:
+            if not streams.is_active(stream_name):
                 print("Rejecting inactive stream: {}".format(stream_name))
-        else:
-            print("Rejecting invalid stream with id: {}".format(stream_id))
+                return None
+            print("Stream is valid and active: {}".format(stream_name))
+            print("Checking if stream is already connected...")
+            if stream_name in connected_streams:
+                print("Stream already exists. Rejecting the connection")
+                return None
+            stream_names.append(stream_name)
+
+        print("New stream{}. Accepting the connection {}:{}{}{}".format(
+            "s" if len(stream_names) > 1 else "", addr[0], addr[1],
+            " with batched framing" if accepted_flags & batch.BATCHED else "",
+            " over shared memory" if accepted_flags & shm.SHARED_MEMORY else ""))
+        return frozenset(stream_names), accepted_flags
+
+    def _create_ring(self, accepted_flags):
+        """
+        :return: (Ring or None, accepted flags), without shared memory if the ring cannot be created
+        """
+        if not accepted_flags & shm.SHARED_MEMORY:
+            return None, accepted_flags
+        try:
+            return shm.Ring.create(self._ring_capacity), accepted_flags
+        except OSError as ex:
+            print("Unable to create shared memory, receiving over TCP: {}".format(ex))
+            return None, accepted_flags & ~shm.SHARED_MEMORY
+
+    def _registration_reply(self, registration, accepted_flags, ring=None):
+        """
+        # accepted flags (byte) | shared memory name length (byte) | shared memory name, if shared memory was accepted
+        :return: the reply to the registration, which only clients sending flags expect
+        """
+        if len(registration) <= 5:
+            return b''
+        if ring is None:
+            return bytes([accepted_flags])
+        name = ring.name.encode('ascii')
+        return bytes([accepted_flags, len(name)]) + name
 
-        return False
+    def _accept_stream(self, sock, addr):
+        reader = FrameReader(sock, size=1024)
+        try:
+            registration = reader.read_frame()
+        except Exception:
+            print("Unable to receive registration data for stream. Ignoring the client")
+            return False
+
+        registered = self._register_stream(registration, addr, shm.is_local(sock.getsockname(), addr))
+        if registered is None:
+            return False
+
+        stream_names, accepted_flags = registered
+        ring, accepted_flags = self._create_ring(accepted_flags)
+        try:
+            sock.sendall(self._registration_reply(registration, accepted_flags, ring))
+            sock.shutdown(socket.SHUT_WR)
+        except socket.error:
+            print("Unable to reply to the stream registration. Ignoring the client")
+            if ring is not None:
+                ring.close()
+            return False
+        self._connected_clients[sock] = stream_names
+        # The socket of a client using shared memory only carries notifications
+        self._readers[sock] = shm.RingReader(ring, sock) if ring is not None else reader
+        if accepted_flags & batch.BATCHED:
+            self._batched.add(sock)
+        return True
+
+    def _disconnect_client(self, sock):
+        self._connected_clients.pop(sock)
+        reader = self._readers.pop(sock)
+        if isinstance(reader, shm.RingReader):
+            reader.ring.close()
+        self._batched.discard(sock)
+        self._unset_sync()
 
     def run(self):
         serv_sock = serve('fusion')
@@ -211,11 +377,18 @@ class Fusion(threading.Thread):
                     except Exception:
                         print("Client disconnected")
                         inputs.remove(sock)
-                        self._connected_clients.pop(sock)
-                        self._unset_sync()
+                        self._disconnect_client(sock)
                 continue
 
-            for s in read_socks:
+            # Emit the data whose deadline passed while no data was received
+            self._put_synced(self._synchronizer.poll())
+
+            # Clients using shared memory only notify when their ring was empty, so also check the rings which were
+            # not notified, in case a notification raced with the end of the previous read
+            rings = [s for s, reader in self._readers.items()
+                     if isinstance(reader, shm.RingReader) and s not in read_socks]
+
+            for s in read_socks + rings:
                 if s is serv_sock:
                     client_sock, client_addr = s.accept()
                     # 1 is for the server socket
@@ -225,60 +398,23 @@ class Fusion(threading.Thread):
                         client_sock.close()
                 else:
                     try:
-                        msg = self._handle_client(s)
+                        with trace.span("receive"):
+                            msgs = self._handle_client(s, s in read_socks)
                     except (socket.error, EOFError, streams.InvalidStreamError) as ex:
                         print(ex)
                         print("Disconnecting client...")
                         inputs.remove(s)
-                        self._connected_clients.pop(s)
-                        self._unset_sync()
+                        self._disconnect_client(s)
                         print("Disconnected")
                         continue
 
-                    # Read and discard data unless enough clients connect
-                    if streams.all_connected(self._connected_clients.values()):
-                        cur_ts = msg.header.timestamp
-
-                        # Add data to appropriate timestamp bucket
-                        self._msgs_received.setdefault(cur_ts, []).append(msg)
-
-                        # Try to sync in presence of this new data
-                        # Will run every time until we are synced
-                        if not self._is_synced():
-                            # Try to find a sync point if it exists
-                            for ts in sorted(self._msgs_received.keys()):
-                                # Weak check for all data received
-                                if len(self._msgs_received[ts]) == streams.get_active_streams_count():
-                                    # This is the sync point
-                                    sync_ts = ts
-                                    self._set_sync(sync_ts)
-                                    break
-                        else:
-                            # Already synced
-                            sync_ts = min(self._msgs_received.keys())
-                            #print "Minimum timestamp: {0}".format(sync_ts)
-                            if len(self._msgs_received[sync_ts]) == streams.get_active_streams_count():
-                                # Create a shared data object representing the synced data
-                                # Indexed by stream type
-                                # Value is the entire decoded frame of that stream type
-                                #print "Timestamp contains all data"
-                                s_msg = {}
-                                for m in self._msgs_received[sync_ts]:
-                                    s_msg[m.header.name] = m
-                                #print "{0:d}, LH: {1:.2f}, {2:.2f}, RH: {3:.2f}, {4:.2f}".format(sync_ts,
-                                # s_msg["Body"].data.pos_l_x, s_msg["Body"].data.pos_l_y,
-                                # s_msg["Body"].data.pos_r_x, s_msg["Body"].data.pos_r_x)
-                                synced_msgs.put(s_msg)
-                                self._msgs_received.pop(sync_ts)
-                            """
-                            else:
-                                found_streams = []
-                                for m in self._msgs_received[sync_ts]:
-                                    found_streams += [m.header.name]
-                                print "Only " + str(len(found_streams)) + " streams were found: " + ",".join(found_streams)
-                            """
+                    for msg in msgs:
+                        self._handle_message(msg)
 
         print("Stopped network thread")
 
+        for reader in self._readers.values():
+            if isinstance(reader, shm.RingReader):
+                reader.ring.close()
         for s in inputs:
             s.close()
@@ -2,21 +2,75 @@ import threading
 import socket
 import selectors
 import queue
+from collections import deque, namedtuple
 
 from .conf.endpoints import serve
+from .conf import trace
+
+# Statistics of a connected destination
+# queued is the number of messages waiting to be sent, including a partially sent one
+SubscriberStats = namedtuple('SubscriberStats', ['addr', 'queued', 'queued_bytes', 'sent', 'dropped'])
+
+overflow_policies = ('drop_oldest', 'drop_newest', 'disconnect')
+
+
+class _Subscriber:
+    """
+    A connected destination with its own bounded output buffer
+    """
+    __slots__ = ('sock', 'addr', 'buffer', 'partial', 'queued_bytes', 'sent', 'dropped')
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        # memoryviews of the messages left to send, the first one is partially sent if partial is True
+        self.buffer = deque()
+        self.partial = False
+        self.queued_bytes = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def stats(self):
+        return SubscriberStats(self.addr, len(self.buffer), self.queued_bytes, self.sent, self.dropped)
 
 
 class Remote(threading.Thread):
+    """
+    Sends every message of the input queue to all the destinations connected to the target.
+    Sockets are non-blocking and each destination has a bounded output buffer, so a slow destination only delays
+    itself. When its buffer is full, the overflow policy decides between dropping its oldest message, dropping the new
+    message, or disconnecting it.
+    """
+
+    def __init__(self, name, target, input_queue, conn_event, max_queued=64, overflow='drop_oldest',
+                 poll_interval=0.01, flush_interval=0.001):
+        """
+        :param name: Name used in the logs
+        :param target: Host role to serve, as in endpoints
+        :param input_queue: Queue of the messages (bytes) to send
+        :param conn_event: Event set while at least one destination is connected
+        :param max_queued: Maximum number of messages buffered per destination
+        :param overflow: What to do when a destination's buffer is full [drop_oldest|drop_newest|disconnect]
+        :param poll_interval: Maximum seconds to wait for messages while no output is buffered
+        :param flush_interval: Maximum seconds to wait for messages while output is buffered, before retrying to send it
+        """
+        if overflow not in overflow_policies:
+            raise ValueError("overflow must be one of {}: {}".format(overflow_policies, overflow))
+        assert max_queued > 0
 
-    def __init__(self, name, target, input_queue, conn_event):
         threading.Thread.__init__(self)
         self.daemon = True
         self.name = name
         self.target = target
         self.input_queue = input_queue
+        self.max_queued = max_queued
+        self.overflow = overflow
+        self._poll_interval = poll_interval
+        self._flush_interval = flush_interval
         self._stop = threading.Event()
         self._connected = conn_event
         self._sel = selectors.DefaultSelector()
+        self._subscribers = {}
 
     def stop(self):
         self._stop.set()
@@ -24,6 +78,13 @@ class Remote(threading.Thread):
     def is_stopped(self):
         return self._stop.is_set()
 
+    def subscriber_stats(self):
+        """
+        Get the statistics of the connected destinations, safe to call from any thread
+        :return: list of SubscriberStats
+        """
+        return [subscriber.stats() for subscriber in list(self._subscribers.values())]
+
     def _log(self, text):
         print("[ {name:^10} ] {txt}".format(name=self.name, txt=text))
 
@@ -35,58 +96,240 @@ class Remote(threading.Thread):
             return
 
         self._log("Accepted destination {host[0]}:{host[1]}".format(host=addr))
+        conn.setblocking(False)
+        self._subscribers[conn] = _Subscriber(conn, addr)
+        # Destinations never send anything, so readability means they disconnected
+        self._sel.register(conn, selectors.EVENT_READ)
         self._connected.set()
-        self._sel.register(conn, selectors.EVENT_WRITE)
 
-    def _send(self, key, data):
-        conn = key.fileobj
-        try:
-            conn.sendall(data)
-        except (socket.error, EOFError):
-            self._sel.unregister(conn)
-            conn.close()
-            self._log("Client disconnected")
-            # Since listening socket is also registered in the selector
-            # length will be greater than or equal to 1
-            if len(self._sel.get_map()) == 1:
-                self._connected.clear()
+    def _disconnect(self, subscriber, reason):
+        self._sel.unregister(subscriber.sock)
+        subscriber.sock.close()
+        del self._subscribers[subscriber.sock]
+        self._log("Client {host[0]}:{host[1]} disconnected ({reason}), sent {sent}, dropped {dropped}".format(
+            host=subscriber.addr, reason=reason, sent=subscriber.sent, dropped=subscriber.dropped))
+        if len(self._subscribers) == 0:
+            self._connected.clear()
+
+    def _enqueue(self, subscriber, data):
+        """
+        Add a message to the buffer of a destination, applying the overflow policy
+        :return: False if the destination was disconnected, True otherwise
+        """
+        buf = subscriber.buffer
+        if len(buf) >= self.max_queued:
+            if self.overflow == 'disconnect':
+                self._disconnect(subscriber, "output buffer full")
+                return False
+            subscriber.dropped += 1
+            # Never drop a partially sent message, the destination would lose the framing
+            if self.overflow == 'drop_newest' or (subscriber.partial and len(buf) == 1):
+                return True
+            victim = 1 if subscriber.partial else 0
+            subscriber.queued_bytes -= len(buf[victim])
+            del buf[victim]
+
+        was_empty = len(buf) == 0
+        buf.append(data)
+        subscriber.queued_bytes += len(data)
+        if was_empty:
+            self._sel.modify(subscriber.sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        return True
+
+    def _flush(self, subscriber):
+        """
+        Send as much of the buffered data as the socket accepts without blocking
+        """
+        buf = subscriber.buffer
+        while len(buf) > 0:
+            data = buf[0]
+            try:
+                n = subscriber.sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket.error as ex:
+                self._disconnect(subscriber, ex)
+                return
+
+            subscriber.queued_bytes -= n
+            if n < len(data):
+                buf[0] = data[n:]
+                subscriber.partial = True
+                return
+            buf.popleft()
+            subscriber.partial = False
+            subscriber.sent += 1
+
+        self._sel.modify(subscriber.sock, selectors.EVENT_READ)
+
+    def _dispatch(self, data):
+        start = trace.now()
+        data = memoryview(data)
+        for subscriber in list(self._subscribers.values()):
+            if self._enqueue(subscriber, data):
+                self._flush(subscriber)
+        # The messages are not tied to a frame
+        trace.record("remote_send_" + self.name, None, start)
 
     def run(self):
         listen_sock = serve(self.target)
         listen_sock.listen(5)
 
         self._sel.register(listen_sock, selectors.EVENT_READ)
-        listen_key = self._sel.get_key(listen_sock)
 
         self._log("Waiting for the destination to connect\n")
 
-        data = None
-        handled = set()
         while not self.is_stopped():
+            # Wait for messages, only briefly while some output is waiting for a socket to become writable
+            pending = any(len(subscriber.buffer) > 0 for subscriber in self._subscribers.values())
+            try:
+                self._dispatch(self.input_queue.get(block=True,
+                                                    timeout=self._flush_interval if pending else self._poll_interval))
+            except queue.Empty:
+                pass
+            while True:
+                try:
+                    self._dispatch(self.input_queue.get_nowait())
+                except queue.Empty:
+                    break
 
-            while len(set(self._sel.get_map().values()) - handled) > 0:
-                handled.add(listen_key)
-                events = self._sel.select()
-                if data is None:
+            events = self._sel.select(0)
+            for key, mask in events:
+                if key.fileobj is listen_sock:
+                    self._accept(key)
+                    continue
+                subscriber = self._subscribers.get(key.fileobj)
+                if subscriber is None:
+                    # Disconnected while handling an earlier event
+                    continue
+                if mask & selectors.EVENT_READ:
                     try:
-                        data = self.input_queue.get(block=True, timeout=0.01)
-                    except queue.Empty:
-                        pass
-
-                for key, mask in events:
-                    if mask & selectors.EVENT_READ and key is listen_key:
-                        self._accept(key)
-                    elif mask & selectors.EVENT_WRITE and key not in handled:
-                        if data is not None:
-                            self._send(key, data)
-                            handled.add(key)
-            data = None
-            handled.clear()
+                        data = subscriber.sock.recv(1024)
+                    except (BlockingIOError, InterruptedError):
+                        data = None
+                    except socket.error:
+                        data = b''
+                    if data == b'':
+                        self._disconnect(subscriber, "closed by peer")
+                        continue
+                if mask & selectors.EVENT_WRITE:
+                    self._flush(subscriber)
 
         self._log("Stopped")
 
-        for conn in self._sel.get_map():
-            self._sel.unregister(conn)
-            conn.close()
+        for conn in list(self._sel.get_map().values()):
+            self._sel.unregister(conn.fileobj)
+            conn.fileobj.close()
+        self._subscribers.clear()
 
         self._connected.clear()
+
+
+if __name__ == '__main__':
+    # Benchmark of the fan-out with a fast and a slow destination, comparing the overflow policies with blocking
+    # sendall() to every destination in turn. Destinations check that the framing survives drops and partial writes.
+    # Run as: python -m components.fusion.remote_thread [--help]
+    import argparse
+    import contextlib
+    import io
+    import struct
+    import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', default=3000, type=int, help='number of messages')
+    parser.add_argument('--rate', default=1000.0, type=float, help='messages per second')
+    parser.add_argument('--size', default=8192, type=int, help='message size in bytes')
+    parser.add_argument('--slow-delay', default=0.005, type=float, help='seconds the slow destination sleeps per read')
+    args = parser.parse_args()
+
+    header = struct.Struct("<iid")  # size, sequence number, send time
+
+    def receive(sock, delay, received):
+        # Read whole messages, checking the size and sequence number of each one
+        buf = b''
+        last_seq = -1
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            buf += data
+            while len(buf) >= 4:
+                (size,) = struct.unpack_from("<i", buf)
+                if len(buf) < size + 4:
+                    break
+                _, seq, sent_time = header.unpack_from(buf)
+                assert size == args.size - 4 and seq > last_seq, "Corrupted stream"
+                last_seq = seq
+                received.append(time.perf_counter() - sent_time)
+                buf = buf[size + 4:]
+            if delay > 0:
+                time.sleep(delay)
+        sock.close()
+
+    def connect_destination(delay, received):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.connect(('localhost', 9127))
+        thread = threading.Thread(target=receive, args=(sock, delay, received), daemon=True)
+        thread.start()
+        return sock, thread
+
+    def legacy_fanout(input_queue, conn_event, stop):
+        # The previous behaviour: blocking sendall() to each destination in turn
+        listen_sock = serve('gui')
+        listen_sock.listen(5)
+        conns = []
+        for _ in range(2):
+            conns.append(listen_sock.accept()[0])
+        conn_event.set()
+        while not stop.is_set():
+            try:
+                data = input_queue.get(timeout=0.01)
+            except queue.Empty:
+                continue
+            for conn in conns:
+                conn.sendall(data)
+        for conn in conns:
+            conn.close()
+        listen_sock.close()
+
+    def run(label, overflow):
+        input_queue, conn_event, stop = queue.Queue(), threading.Event(), threading.Event()
+        if overflow is None:
+            server = threading.Thread(target=legacy_fanout, args=(input_queue, conn_event, stop), daemon=True)
+        else:
+            server = Remote('Bench', 'gui', input_queue, conn_event, overflow=overflow)
+        with contextlib.redirect_stdout(io.StringIO()):
+            server.start()
+            time.sleep(0.2)
+            fast, slow = [], []
+            destinations = [connect_destination(0.0, fast), connect_destination(args.slow_delay, slow)]
+            while not conn_event.is_set() or (overflow is not None and len(server.subscriber_stats()) < 2):
+                time.sleep(0.01)
+
+            padding = bytes(args.size - header.size)
+            period = 1.0 / args.rate
+            start = time.perf_counter()
+            for seq in range(args.count):
+                input_queue.put(header.pack(args.size - 4, seq, time.perf_counter()) + padding)
+                time.sleep(max(0.0, start + (seq + 1) * period - time.perf_counter()))
+            time.sleep(0.5)
+            stats = server.subscriber_stats() if overflow is not None else None
+            stop.set()
+            server.stop() if overflow is not None else None
+            time.sleep(0.1)
+            for sock, thread in destinations:
+                thread.join(2.0)
+
+        fast_lat = sorted(fast) or [float('nan')]
+        print("{:12} fast: {:>5}/{} received, p50 {:8.2f} ms, p99 {:8.2f} ms | slow: {:>5} received{}".format(
+            label, len(fast), args.count, fast_lat[len(fast_lat) // 2] * 1000,
+            fast_lat[int(len(fast_lat) * 0.99)] * 1000, len(slow),
+            "" if stats is None else " | " + ", ".join("queued {} dropped {}".format(s.queued, s.dropped)
+                                                      for s in stats)))
+
+    print("{} messages of {} B at {} Hz, slow destination sleeps {} ms per read".format(
+        args.count, args.size, args.rate, args.slow_delay * 1000))
+    run('sendall', None)
+    for policy in overflow_policies:
+        run(policy, policy)
@@ -1,221 +1,549 @@
 from __future__ import print_function
-from collections import deque, namedtuple
-from time import sleep
+import bisect
+import heapq
+from collections import namedtuple
+from time import monotonic
 
-# A named tuple for storing timestamp and data
-TimedData = namedtuple('TimedData', ['timestamp', 'data'])
+# A named tuple for data synchronized across sources
+# data is a dict containing data keyed by source names, missing is a frozenset of the names of sources without data
+SyncedData = namedtuple('SyncedData', ['timestamp', 'data', 'missing'])
+
+# Kinect timestamps are .NET DateTime ticks of 100ns
+ticks_per_ms = 10000
 
 
 class Synchronizer:
     """
     Synchronizes data received from multiple sources using timestamps associated with each datum.
-    Limitations: If some sources generate data faster than the others, eventually they will become out of sync.
-    This synchronizer makes no effort to restore synchronization in such a case.
+    This is the interface of the synchronization policies. Data is fed one datum at a time, and every call returns
+    the synchronized data which became ready, oldest first. Policies which emit data based on time also need poll() to
+    be called periodically.
+    Every policy keeps a bounded amount of data, so a stalled source cannot make memory grow.
     """
-    def __init__(self, names, history=10):
-        assert history > 0
-        self._max_len = history
-        self._qs = dict(zip(names, [deque() for i in range(len(names))]))
-
-        self._sync_point = None
-        self._stale_ts = None
+    def __init__(self, names):
+        self._names = frozenset(names)
 
     def _warn(self, message):
         print("WARNING: {}: {}".format(self.__class__.__name__, message))
 
-    def feed(self, name, timestamp, data):
-        if self._is_stale(timestamp):
-            self._warn("'{}' is lagging behind at timestamp {} but stale timestamp is {}".format(name, timestamp, self._stale_ts))
-            return
+    def feed(self, name, timestamp, data, now=None):
+        """
+        Add data from a source
+        :param name: name of the source
+        :param timestamp: timestamp associated with the data
+        :param data: data to store
+        :param now: monotonic time of arrival in seconds, current time if None
+        :return: list of SyncedData which became ready, oldest first
+        """
+        raise NotImplementedError
 
-        q = self._qs[name]
+    def poll(self, now=None):
+        """
+        Get the synchronized data which became ready with the passage of time
+        :param now: monotonic time in seconds, current time if None
+        :return: list of SyncedData which became ready, oldest first
+        """
+        return []
 
-        q.append(TimedData(timestamp, data))
+    def is_synced(self):
+        """
+        Check if synchronized data has been emitted since the last reset
+        :return: True if synced, else False
+        """
+        raise NotImplementedError
 
-        sync_lost_by_adding = False
-        sync_lost_by_removing = False
-        sync_lost_by_unavailable_data = False
+    def reset(self):
+        """
+        Resets the synchronizer
+        :return:
+        """
+        raise NotImplementedError
 
-        # If queue for name was empty before the append
-        if len(q) == 1:
-            sync_lost_by_adding = self._remove_stale_data_for_all_except(name, timestamp)
-            self._stale_ts = timestamp
-        elif len(q) > self._max_len:
-            q.popleft()
-            sync_lost_by_removing = self._remove_stale_data_for_all_except(name, q[0].timestamp)
-            self._stale_ts = q[0].timestamp
-        else:
-            sync_lost_by_unavailable_data = self._check_for_empty_queues()
+    def __len__(self):
+        """
+        :return: number of data items held by the synchronizer
+        """
+        raise NotImplementedError
 
-        sync_lost = sync_lost_by_adding or sync_lost_by_removing or sync_lost_by_unavailable_data
-        self._sync_point = None if sync_lost else q[0].timestamp
+    @property
+    def names(self):
+        """
+        Get names of sources as given in __init__()
+        :return: collection of sources' names
+        """
+        return self._names
 
-    def _is_stale(self, timestamp):
-        return self._stale_ts is not None and timestamp < self._stale_ts
 
-    def _remove_stale_data(self, name, timestamp):
+class SyncIndex:
+    """
+    Indexes data received from multiple sources by timestamp to find the timestamps for which all sources have
+    sent their data.
+    Each timestamp bucket keeps a bitmask of the sources that have arrived, so checking a bucket for completeness is
+    O(1) and a source sending the same timestamp twice is only counted once.
+    The oldest bucket and the oldest complete bucket are tracked with min-heaps, giving O(log n) retrieval.
+    """
+    def __init__(self, names):
+        self._bits = {name: 1 << i for i, name in enumerate(sorted(names))}
+        self._all_mask = (1 << len(self._bits)) - 1
+
+        # timestamp -> [bitmask of arrived sources, dict containing data keyed by source names]
+        self._buckets = {}
+        # Timestamps of all buckets and of complete buckets
+        # Removed buckets are dropped lazily from the heaps, when they reach the top
+        self._pending = []
+        self._complete = []
+
+    def add(self, name, timestamp, data):
         """
-        Remove all data in queue named 'name' which is strictly older than 'timestamp'
-        :param name: name of the queue
-        :param timestamp: timestamp to compare with
-        :return:
+        Add data from a source to the bucket of its timestamp
+        If the source already sent data for the timestamp, the new data replaces the old one
+        :param name: name of the source
+        :param timestamp: timestamp associated with the data
+        :param data: data to store
+        :return: True if the bucket became complete, else False
         """
-        q = self._qs[name]
-        while len(q) > 0 and q[0].timestamp < timestamp:
-            q.popleft()
-        return len(q) == 0
-
-    def _remove_stale_data_for_all_except(self, name, timestamp):
+        bucket = self._buckets.get(timestamp)
+        if bucket is None:
+            bucket = self._buckets[timestamp] = [0, {}]
+            heapq.heappush(self._pending, timestamp)
+
+        bit = self._bits[name]
+        bucket[1][name] = data
+        if bucket[0] & bit:
+            return False
+
+        bucket[0] |= bit
+        if bucket[0] == self._all_mask:
+            heapq.heappush(self._complete, timestamp)
+            return True
+        return False
+
+    def is_complete(self, timestamp):
         """
-        Remove data in all queues except the one named 'name' which is strictly older than 'timestamp'
-        :param name: name of the queue to be excluded
-        :param timestamp: timestamp to compare with
-        :return:
+        Check if all sources have sent data for a timestamp
+        :param timestamp: timestamp to check
+        :return: True if the bucket for timestamp is complete, else False
         """
-        sync_lost = False
-        for q_name, q in self._qs.items():
-            if q_name != name:
-                sync_lost_now = self._remove_stale_data(q_name, timestamp)
-                sync_lost = sync_lost or sync_lost_now
-        return sync_lost
+        bucket = self._buckets.get(timestamp)
+        return bucket is not None and bucket[0] == self._all_mask
 
-    def _check_for_empty_queues(self):
+    def oldest(self):
         """
-        Checks if there are any empty queues
-        :return: True if an empty queue is found, else False
+        :return: the oldest timestamp in the index, None if the index is empty
         """
-        for q in self._qs.values():
-            if len(q) == 0:
-                return True
+        while len(self._pending) > 0 and self._pending[0] not in self._buckets:
+            heapq.heappop(self._pending)
+        return self._pending[0] if len(self._pending) > 0 else None
 
-    def is_synced(self):
+    def oldest_complete(self):
         """
-        Check if the sync point has been found
-        :return: True if the sync point has been found, else False
+        :return: the oldest timestamp for which all sources have sent data, None if there is none
         """
-        return self._sync_point is not None
+        # A timestamp could have been removed and added again since it was pushed, so check it is still complete
+        while len(self._complete) > 0 and not self.is_complete(self._complete[0]):
+            heapq.heappop(self._complete)
+        return self._complete[0] if len(self._complete) > 0 else None
 
-    def get_synced_data(self):
+    def pop(self, timestamp):
         """
-        Get the latest synchronized data. The user must check beforehand using self.is_synced() before calling this.
-        :return: (synchronized timestamp, dict containing data keyed by source names)
+        Remove the bucket for a timestamp
+        :param timestamp: timestamp of the bucket
+        :return: dict containing data keyed by source names
         """
-        assert self.is_synced(), "get_synced_data() called when the Synchronizer is not synced"
-        # Records synced data
-        synced_data = {}
-
-        # Marks next sync timestamp, could be None if sync is lost during this operation
-        next_sync_point = None
+        data = self._buckets.pop(timestamp)[1]
+        # Drop the removed timestamp from the top of the heaps right away, so that they do not grow while buckets are
+        # removed in timestamp order
+        self.oldest()
+        self.oldest_complete()
+        return data
+
+    def discard_older(self, timestamp):
+        """
+        Remove all the buckets which are strictly older than timestamp
+        :param timestamp: timestamp to compare with
+        :return: None
+        """
+        while len(self._pending) > 0 and self._pending[0] < timestamp:
+            self._buckets.pop(heapq.heappop(self._pending), None)
+        self.oldest_complete()
 
-        for name, q in self._qs.items():
-            timestamp, data = q.popleft()
-            # next sync point is None if sync is lost
-            # Note that we relegate checking for the timestamp being common to next get_synced_data() operation
-            next_sync_point = None if len(q) == 0 else q[0].timestamp
-            synced_data[name] = data
-            # Timestamp for all oldest data should be the same
-            assert timestamp == self._sync_point, "Missing timestamp {} in {}".format(self._sync_point, name)
+    def clear(self):
+        self._buckets.clear()
+        del self._pending[:]
+        del self._complete[:]
 
-        cur_sync_point = self._sync_point
-        # Update sync point to the next one
-        self._sync_point = next_sync_point
-        return cur_sync_point, synced_data
+    def __len__(self):
+        return len(self._buckets)
 
     @property
-    def sync_point(self):
+    def names(self):
         """
-        Returns the timestamp corresponding to the sync point
-        :return: the timstamp of the sync point
+        Get names of sources as given in __init__()
+        :return: collection of sources' names
         """
-        return self._sync_point
+        return self._bits.keys()
 
-    @property
-    def stale_timestamp(self):
-        """
-        Returns the stale timestmap
-        :return: stale timestamp
-        """
-        return self._stale_ts
+
+class ExactSynchronizer(Synchronizer):
+    """
+    Synchronizes data for which every source sent the exact same timestamp.
+    Timestamps are emitted in order as soon as they are complete. Sources send their data in timestamp order, so once
+    a timestamp is complete the older incomplete ones never will be: they are dropped, which skips a timestamp that a
+    source never sent instead of stalling the newer ones. Data arriving for a timestamp already emitted or dropped is
+    ignored. If more than `history` timestamps are pending, the oldest ones are dropped.
+    """
+    def __init__(self, names, history=30):
+        assert history > 0
+        Synchronizer.__init__(self, names)
+        self._history = history
+        self._index = SyncIndex(names)
+        # Last emitted or dropped timestamp, older data is ignored, None if there is none
+        self._sync_point = None
+        self._synced = False
+
+    def feed(self, name, timestamp, data, now=None):
+        if self._sync_point is not None and timestamp <= self._sync_point:
+            return []
+
+        self._index.add(name, timestamp, data)
+
+        while len(self._index) > self._history:
+            self._sync_point = self._index.oldest()
+            self._index.pop(self._sync_point)
+
+        ready = []
+        sync_ts = self._index.oldest_complete()
+        while sync_ts is not None:
+            self._index.discard_older(sync_ts)
+            ready.append(SyncedData(sync_ts, self._index.pop(sync_ts), frozenset()))
+            self._sync_point = sync_ts
+            self._synced = True
+            sync_ts = self._index.oldest_complete()
+        return ready
+
+    def is_synced(self):
+        return self._synced
 
     def reset(self):
+        self._index.clear()
+        self._sync_point = None
+        self._synced = False
+
+    def __len__(self):
+        return len(self._index)
+
+
+class ApproximateSynchronizer(Synchronizer):
+    """
+    Synchronizes data received from multiple sources by grouping data whose timestamps are within a tolerance of each
+    other, instead of requiring the exact same timestamp from every source.
+    A group is emitted as soon as it is complete, or as a partial group once it can no longer be completed:
+    either every missing source has already sent newer data, or the group has waited longer than max_latency.
+    Groups are always emitted in timestamp order. At most `history` groups are kept open, further groups force the
+    oldest one out as partial.
+    """
+
+    class _Group:
+        __slots__ = ('timestamp', 'created', 'data')
+
+        def __init__(self, timestamp, created):
+            self.timestamp = timestamp
+            self.created = created
+            self.data = {}
+
+    def __init__(self, names, tolerance, max_latency=None, history=30):
         """
-        Resets the synchronizer
-        :return:
+        :param names: names of the sources
+        :param tolerance: maximum difference between the timestamp of a group and the timestamps of its data
+        :param max_latency: seconds to wait for a group to complete before emitting it as partial, None to wait until
+                            it can no longer be completed
+        :param history: maximum number of open groups
         """
-        for q in self._qs.values():
-            q.clear()
-        self._sync_point = None
-        self._stale_ts = None
-        self._reset_wait_times()
+        assert tolerance >= 0 and history > 0
+        Synchronizer.__init__(self, names)
+        self._tolerance = tolerance
+        self._max_latency = max_latency
+        self._history = history
+
+        # Open groups sorted by timestamp, and their timestamps for bisection
+        self._groups = []
+        self._timestamps = []
+        # Latest timestamp received from every source
+        self._latest = {}
+        # Timestamp and missing sources of the last emitted group, used to drop data arriving too late
+        self._emitted = None
+
+    def feed(self, name, timestamp, data, now=None):
+        now = monotonic() if now is None else now
+
+        if self._is_late(name, timestamp):
+            return self.poll(now)
+
+        self._latest[name] = max(timestamp, self._latest.get(name, timestamp))
+
+        # Join the closest open group within tolerance which has no data from this source yet
+        best = None
+        i = bisect.bisect_left(self._timestamps, timestamp - self._tolerance)
+        while i < len(self._groups) and self._timestamps[i] <= timestamp + self._tolerance:
+            group = self._groups[i]
+            if name not in group.data and \
+                    (best is None or abs(group.timestamp - timestamp) < abs(best.timestamp - timestamp)):
+                best = group
+            i += 1
+
+        if best is None:
+            best = ApproximateSynchronizer._Group(timestamp, now)
+            i = bisect.bisect_right(self._timestamps, timestamp)
+            self._groups.insert(i, best)
+            self._timestamps.insert(i, timestamp)
+
+        best.data[name] = data
+        return self.poll(now)
+
+    def _is_late(self, name, timestamp):
+        if self._emitted is None:
+            return False
+        emitted_ts, missing = self._emitted
+        # Older than what was already emitted, or belongs to the last group which was emitted without it
+        return timestamp <= emitted_ts or (name in missing and timestamp - emitted_ts <= self._tolerance)
+
+    def _is_final(self, group, now):
+        if len(group.data) == len(self._names) or len(self._groups) > self._history:
+            return True
+        if self._max_latency is not None and now - group.created >= self._max_latency:
+            return True
+        # Sources send data in timestamp order, so a source which already sent data too new to join the group
+        # will never complete it
+        for name in self._names:
+            if name not in group.data and self._latest.get(name, group.timestamp) <= group.timestamp + self._tolerance:
+                return False
+        return True
+
+    def poll(self, now=None):
+        # Should be called periodically so that deadlines are honored without new data
+        now = monotonic() if now is None else now
+        ready = []
+        while len(self._groups) > 0 and self._is_final(self._groups[0], now):
+            group = self._groups.pop(0)
+            self._timestamps.pop(0)
+            missing = self._names.difference(group.data)
+            self._emitted = (group.timestamp, missing)
+            ready.append(SyncedData(group.timestamp, group.data, missing))
+        return ready
 
-    @property
-    def names(self):
+    def is_synced(self):
+        return self._emitted is not None
+
+    def reset(self):
+        del self._groups[:]
+        del self._timestamps[:]
+        self._latest.clear()
+        self._emitted = None
+
+    def __len__(self):
+        return sum(len(group.data) for group in self._groups)
+
+
+class LatestSynchronizer(Synchronizer):
+    """
+    Synchronizes the latest data of every source, ignoring how timestamps line up.
+    Only the latest datum of each source is kept, older data is overwritten. The latest data is emitted as soon as
+    every source has sent new data since the previous emission, or once the first new datum has waited longer than
+    max_latency. Sources without new data are reported as missing.
+    """
+    def __init__(self, names, max_latency=None):
         """
-        Get names of sources as given in __init__()
-        :return: collection of sources' names
+        :param names: names of the sources
+        :param max_latency: seconds to wait for all sources to send new data, None to always wait for all of them
         """
-        return self._qs.keys()
+        Synchronizer.__init__(self, names)
+        self._max_latency = max_latency
+        # name -> (timestamp, data) received since the last emission
+        self._latest = {}
+        # name -> latest timestamp received, older data is ignored
+        self._timestamps = {}
+        # Time the first datum since the last emission was received
+        self._first_arrival = None
+        self._synced = False
+
+    def feed(self, name, timestamp, data, now=None):
+        now = monotonic() if now is None else now
+        if self._timestamps.get(name, timestamp) <= timestamp:
+            self._timestamps[name] = timestamp
+            self._latest[name] = (timestamp, data)
+            if self._first_arrival is None:
+                self._first_arrival = now
+        return self.poll(now)
+
+    def poll(self, now=None):
+        if self._first_arrival is None:
+            return []
+        now = monotonic() if now is None else now
+        if len(self._latest) < len(self._names) and \
+                (self._max_latency is None or now - self._first_arrival < self._max_latency):
+            return []
+
+        sync_ts = max(timestamp for timestamp, _ in self._latest.values())
+        synced = SyncedData(sync_ts, {name: data for name, (_, data) in self._latest.items()},
+                            self._names.difference(self._latest))
+        self._latest = {}
+        self._first_arrival = None
+        self._synced = True
+        return [synced]
 
-    def __repr__(self):
-        out = ""
-        names = sorted(self._qs.keys())
-        max_name_len = max(map(len, names))
-        fmt_str = "{:" + str(max_name_len) + "}: {} ... {}\n"
-        fmt_str_empty = "{:" + str(max_name_len) + "}: empty\n"
-        for name in names:
-            q = self._qs[name]
-            if len(q) == 0:
-                out += fmt_str_empty.format(name)
-            else:
-                out += fmt_str.format(name, q[0].timestamp, q[-1].timestamp if len(q) > 1 else '')
-        return out
+    def is_synced(self):
+        return self._synced
 
+    def reset(self):
+        self._latest.clear()
+        self._timestamps.clear()
+        self._first_arrival = None
+        self._synced = False
 
-if __name__ == '__main__':
-    from threading import Thread
-    from Queue import Queue
+    def __len__(self):
+        return len(self._latest)
 
-    class MockClients:
-        _shared_store = Queue()
 
-        class MockClient(Thread):
 
-            def __init__(self, name, frames_per_sec, init_ts=1, data_gen=None):
-                Thread.__init__(self)
-                self._name = name
-                self._wait = 1.0 / frames_per_sec
-                self._ts = init_ts - 1
-                self._data_gen = data_gen if data_gen is not None else lambda: None
-
-            def get_latest_data(self):
-                self._ts += 1
-                data = self._data_gen()
-                sleep(self._wait)
-                return self._name, self._ts, data
-
-            def run(self):
-                while True:
-                    named_data = self.get_latest_data()
-                    MockClients._shared_store.put(named_data)
-
-        def __init__(self, *clients):
-            self._clients = [self.MockClient(name, fps) for name, fps in clients]
-
-        def begin(self):
-            for client in self._clients:
-                client.start()
-
-        def get_data(self):
-            return self._shared_store.get(block=True)
-
-    s = Synchronizer(['body', 'rh', 'lh', 'head', 'speech'], history=10)
-    mcg = MockClients(('body', 29.0), ('rh', 25.0), ('lh', 25.0), ('head', 25.0), ('speech', 30.0))
-    mcg.begin()
-    while True:
-        name, ts, data = mcg.get_data()
-        s.feed(name, ts, data)
-        print(s)
-
-        if s.is_synced():
-            print(s.get_synced_data())
+# Synchronization policies selectable by name
+policies = {
+    'exact': ExactSynchronizer,
+    'approximate': ApproximateSynchronizer,
+    'latest': LatestSynchronizer,
+}
+
+
+if __name__ == '__main__':
+    # Reproducible benchmark of the synchronization policies with simulated clients
+    # Run as: python -m components.fusion.sync [--help]
+    import argparse
+    import random
+    import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', default=30.0, type=float, help='frame rate of the Kinect')
+    parser.add_argument('--duration', default=120.0, type=float, help='simulated seconds of data')
+    parser.add_argument('--latency', default=0.02, type=float, help='mean processing delay of clients in seconds')
+    parser.add_argument('--jitter', default=0.01, type=float, help='std. deviation of the delay in seconds')
+    parser.add_argument('--drop', default=0.01, type=float, help='probability of a client dropping a frame')
+    parser.add_argument('--lag', default=0, type=int, help='frames the last client lags behind at start')
+    parser.add_argument('--tolerance', default=20.0, type=float, help='approximate sync tolerance in ms')
+    parser.add_argument('--max-latency', default=100.0, type=float, help='deadline of partial syncs in ms')
+    parser.add_argument('--poll', default=0.01, type=float, help='poll interval of the fusion loop in seconds')
+    parser.add_argument('--seed', default=0, type=int, help='random seed')
+    args = parser.parse_args()
 
+    class MockClients:
+        """
+        Simulates recognizers which process every Kinect frame and deliver it after a random delay, or drop it
+        """
+        class MockClient:
+            def __init__(self, name, rng, latency, jitter, drop, lag=0):
+                self._name = name
+                self._rng = rng
+                self._latency = latency
+                self._jitter = jitter
+                self._drop = drop
+                self._lag = lag
+
+            def deliver(self, frame, capture_time, timestamp):
+                if frame < self._lag or self._rng.random() < self._drop:
+                    return None
+                delay = max(0.0, self._rng.gauss(self._latency, self._jitter))
+                return capture_time + delay, self._name, timestamp
+
+        def __init__(self, names, seed, latency, jitter, drop, lag):
+            rng = random.Random(seed)
+            self._clients = [self.MockClient(name, rng, latency, jitter, drop, lag if i == len(names) - 1 else 0)
+                             for i, name in enumerate(names)]
+
+        def arrivals(self, rate, duration):
+            """
+            :return: list of (arrival time, name, timestamp) sorted by arrival time
+            """
+            period = 1.0 / rate
+            ticks_per_frame = int(round(1000.0 * ticks_per_ms / rate))
+            arrivals = []
+            for frame in range(int(duration * rate)):
+                for client in self._clients:
+                    arrival = client.deliver(frame, frame * period, frame * ticks_per_frame)
+                    if arrival is not None:
+                        arrivals.append(arrival)
+            arrivals.sort()
+            return arrivals
+
+    def legacy_feed(names):
+        """
+        The sync logic which used to be in Fusion.run(), with timestamp buckets kept as lists in an unbounded dict
+        """
+        msgs_received = {}
+        synced = [False]
+
+        def feed(name, timestamp, data, now):
+            msgs_received.setdefault(timestamp, []).append(name)
+            if not synced[0]:
+                for t in sorted(msgs_received.keys()):
+                    if len(msgs_received[t]) == len(names):
+                        synced[0] = True
+                        for old in list(msgs_received.keys()):
+                            if old < t:
+                                msgs_received.pop(old)
+                        break
+                return []
+            sync_ts = min(msgs_received.keys())
+            if len(msgs_received[sync_ts]) == len(names):
+                msgs_received.pop(sync_ts)
+                return [SyncedData(sync_ts, None, frozenset())]
+            return []
+
+        feed.poll = lambda now: []
+        feed.size = lambda: sum(len(v) for v in msgs_received.values())
+        return feed
+
+    def policy_feed(sync):
+        def feed(name, timestamp, data, now):
+            return sync.feed(name, timestamp, data, now)
+
+        feed.poll = sync.poll
+        feed.size = lambda: len(sync)
+        return feed
+
+    def run(label, feed, arrivals, rate, poll_interval):
+        emitted = []
+        max_size = 0
+        next_poll = 0.0
+        ticks_per_sec = 1000.0 * ticks_per_ms
+        start = time.perf_counter()
+        for arrival, name, timestamp in arrivals:
+            # Poll like the fusion loop does when select() times out
+            while next_poll < arrival:
+                emitted.extend((synced, next_poll) for synced in feed.poll(next_poll))
+                next_poll += poll_interval
+            emitted.extend((synced, arrival) for synced in feed(name, timestamp, None, arrival))
+            max_size = max(max_size, feed.size())
+        elapsed = time.perf_counter() - start
+
+        frames = int(args.duration * rate)
+        if len(emitted) == 0:
+            print("{:12} nothing synced".format(label))
+            return
+        # Latency from the capture of a frame to the moment its synced message is emitted
+        latencies = sorted((emit_time - synced.timestamp / ticks_per_sec) * 1000.0 for synced, emit_time in emitted)
+        partial = sum(1 for synced, _ in emitted if len(synced.missing) > 0)
+        print("{:12} {:>8.2f} us/msg {:>6} synced ({:5.1f}% of frames, {:>5} partial) max held {:>6} | "
+              "latency ms: p50 {:7.2f} p99 {:7.2f} max {:8.2f}".format(
+                  label, elapsed * 1e6 / len(arrivals), len(emitted), 100.0 * len(emitted) / frames, partial,
+                  max_size, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)], latencies[-1]))
+
+    names = ['Body', 'LH', 'RH', 'Speech', 'Emotion']
+    clients = MockClients(names, args.seed, args.latency, args.jitter, args.drop, args.lag)
+    arrivals = clients.arrivals(args.rate, args.duration)
+    print("{} messages from {} clients at {} Hz, drop {:.1%}, seed {}".format(
+        len(arrivals), len(names), args.rate, args.drop, args.seed))
+
+    max_latency = args.max_latency / 1000.0 if args.max_latency > 0 else None
+    run('legacy', legacy_feed(names), arrivals, args.rate, args.poll)
+    run('exact', policy_feed(ExactSynchronizer(names)), arrivals, args.rate, args.poll)
+    run('approximate', policy_feed(ApproximateSynchronizer(names, args.tolerance * ticks_per_ms, max_latency)),
+        arrivals, args.rate, args.poll)
+    run('latest', policy_feed(LatestSynchronizer(names, max_latency)), arrivals, args.rate, args.poll)
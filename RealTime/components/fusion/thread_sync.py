@@ -1,13 +1,187 @@
 import queue
+import struct
 import threading
+from collections import deque, namedtuple
 
-# Setup a FIFO queue for sharing received data across threads
-synced_msgs = queue.Queue()
+# Statistics of a RingQueue
+# high_water is the largest size reached since the last reset, dropped the number of items overwritten
+QueueStats = namedtuple('QueueStats', ['capacity', 'size', 'high_water', 'put', 'dropped'])
 
-remote_events = queue.Queue()
+
+class RingQueue:
+    """
+    A FIFO queue with a fixed capacity, shared across threads.
+    put() never blocks: when the queue is full the oldest item is dropped, so that consumers which fall behind get
+    recent data instead of an ever growing backlog. In latest only mode, the queue holds only the newest item.
+    Items which only carry state can instead be replaced by the next item, see superseded, while the others are kept.
+    Implements the subset of queue.Queue used here, get() raises queue.Empty on timeout.
+    """
+
+    def __init__(self, capacity, latest_only=False, superseded=None):
+        """
+        :param capacity: Maximum number of items held
+        :param latest_only: True to hold only the newest item, regardless of capacity
+        :param superseded: Function of an item, True if the next item replaces it, None to only drop the oldest items
+        """
+        if latest_only:
+            capacity = 1
+        assert capacity > 0
+        self.capacity = capacity
+        self.latest_only = latest_only
+        self.superseded = superseded
+        self._items = deque()
+        self._not_empty = threading.Condition(threading.Lock())
+        self._high_water = 0
+        self._put = 0
+        self._dropped = 0
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Add an item, replacing the newest one if it is superseded, else dropping the oldest one if the queue is full.
+        Never blocks, block and timeout are ignored.
+        :param item: Item to add
+        :return: True if an item was dropped, False otherwise
+        """
+        with self._not_empty:
+            if self.superseded is not None and len(self._items) > 0 and self.superseded(self._items[-1]):
+                self._items.pop()
+                dropped = True
+            else:
+                dropped = len(self._items) >= self.capacity
+                if dropped:
+                    self._items.popleft()
+            if dropped:
+                self._dropped += 1
+            self._items.append(item)
+            self._put += 1
+            if len(self._items) > self._high_water:
+                self._high_water = len(self._items)
+            self._not_empty.notify()
+        return dropped
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return the oldest item
+        :param block: True to wait for an item, False to raise queue.Empty right away
+        :param timeout: Maximum seconds to wait when blocking, None to wait forever
+        :return: The oldest item
+        """
+        with self._not_empty:
+            if block:
+                if not self._not_empty.wait_for(lambda: len(self._items) > 0, timeout):
+                    raise queue.Empty
+            elif len(self._items) == 0:
+                raise queue.Empty
+            return self._items.popleft()
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return len(self._items)
+
+    def empty(self):
+        return len(self._items) == 0
+
+    def full(self):
+        return len(self._items) >= self.capacity
+
+    def clear(self):
+        """
+        Remove all the items, without counting them as dropped
+        """
+        with self._not_empty:
+            self._items.clear()
+
+    def stats(self):
+        """
+        :return: QueueStats of the queue
+        """
+        with self._not_empty:
+            return QueueStats(self.capacity, len(self._items), self._high_water, self._put, self._dropped)
+
+    def reset_stats(self):
+        with self._not_empty:
+            self._high_water = len(self._items)
+            self._put = 0
+            self._dropped = 0
+
+
+# Setup bounded FIFO queues for sharing received data across threads
+# Synced messages older than the last few are stale, the fusion loop skips them to stay real-time
+synced_msgs = RingQueue(4)
+
+remote_events = RingQueue(256)
 
 remote_connected = threading.Event()
 
-gui_events = queue.Queue()
+
+def _probabilities_only(msg):
+    """
+    :param msg: Message to the GUI, the number of events, the events, then the probabilities
+    :return: True if the message carries no event
+    """
+    return msg[:4] == struct.pack("<i", 0)
+
+
+# The GUI displays the current probabilities, which the next message replaces, but must receive every event
+gui_events = RingQueue(64, superseded=_probabilities_only)
 
 gui_connected = threading.Event()
+
+
+if __name__ == '__main__':
+    # Compares the latency of an unbounded queue with the ring queue when the consumer is slower than the producer
+    # Run as: python -m components.fusion.thread_sync [--help]
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', default=30.0, type=float, help='items produced per second')
+    parser.add_argument('--cost', default=0.04, type=float, help='seconds the consumer spends on each item')
+    parser.add_argument('--duration', default=5.0, type=float, help='seconds of production')
+    args = parser.parse_args()
+
+    def run(label, q):
+        latencies = []
+
+        def consume():
+            while True:
+                produced = q.get()
+                if produced is None:
+                    break
+                latencies.append(time.perf_counter() - produced)
+                time.sleep(args.cost)
+
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        count = int(args.duration * args.rate)
+        start = time.perf_counter()
+        for i in range(count):
+            q.put(time.perf_counter())
+            time.sleep(max(0.0, start + (i + 1) / args.rate - time.perf_counter()))
+        # Wait for the consumer to catch up
+        while not q.empty():
+            time.sleep(0.01)
+        q.put(None)
+        consumer.join()
+        stats = q.stats() if isinstance(q, RingQueue) else None
+        print("{:12} consumed {:>4}/{} | latency ms: p50 {:8.1f} max {:8.1f}{}".format(
+            label, len(latencies), count, sorted(latencies)[len(latencies) // 2] * 1000, max(latencies) * 1000,
+            "" if stats is None else " | high water {}, dropped {}".format(stats.high_water, stats.dropped)))
+
+    # Between two polls of the GUI, the probabilities replace each other but the events are kept
+    gui = RingQueue(64, superseded=_probabilities_only)
+    probs, event = struct.pack("<i", 0) + b'P', struct.pack("<i", 1) + b'G'
+    for msg in (probs, event, probs, probs, event, probs):
+        gui.put(msg)
+    assert [gui.get_nowait() for _ in range(gui.qsize())] == [event, event, probs]
+
+    print("Producing at {} Hz, consuming in {} ms".format(args.rate, args.cost * 1000))
+    run('Queue', queue.Queue())
+    run('RingQueue 4', RingQueue(4))
+    run('RingQueue 16', RingQueue(16))
+    run('latest only', RingQueue(1, latest_only=True))
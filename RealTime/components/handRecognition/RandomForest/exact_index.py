@@ -0,0 +1,156 @@
+from .flat_forest import FlatForest, _grow, nearest_labels
+from .forest import feature_dim, normalize_samples
+
+import copy
+import time
+import numpy as np
+
+
+class ExactIndex:
+    """
+    Nearest neighbor search over every sample rather than the leaves of the trees of a forest, which may miss the
+    nearest sample, for the negative dot product distance (parameters.distance_metric_type 2): the distances to all the
+    samples are one matrix multiply with the matrix of the samples, one per row, as stored by FlatForest.
+    Same interface as Forest and FlatForest for the one-shot classifier: find_nn(), add_new() and next_ind.
+    """
+
+    def __init__(self, sample_shape, dtype=np.float32):
+        """
+        :param sample_shape: Shape of a sample, (feature_dim,) for frames, (frame_per_clip, feature_dim) for clips
+        :param dtype: Type of the samples
+        """
+        self.sample_shape = tuple(sample_shape)
+        self.sample_dim = len(self.sample_shape)
+        self.next_ind = None  # what will be the next index of novel sample
+
+        # The arrays have room for more rows than used, counted by n_samples, and double when full
+        self.samples = np.empty((0, int(np.prod(self.sample_shape))), dtype=dtype)
+        self.labels = np.empty(0, dtype=np.int64)
+        self.norms = np.empty(0, dtype=np.float64)  # euclidean norm of each sample, see nearest_labels()
+        self.n_samples = 0
+
+    def copy(self):
+        """
+        :return: a copy to add samples to while this index is searched, as FlatForest.copy(): the samples are shared,
+        add_new() only writes the rows after n_samples
+        """
+        return copy.copy(self)
+
+    def add_new(self, samples, labels=None):
+        """
+        This function is used to add a GROUP of or a SINGLE new samples, as Forest.add_new()
+        :param samples: New samples, with dimension: nSamples*feature_dim or feature_dim
+        :param labels:  Labels of new samples, with dimension: nSamples
+        :return:        None
+        """
+        samples_norm = normalize_samples(samples, self.sample_dim)
+
+        # if labels are not supplied, use internal next_ind
+        if labels is None:
+            labels = [self.next_ind] * samples_norm.shape[0]
+
+        start, end = self.n_samples, self.n_samples + samples_norm.shape[0]
+        self.samples = _grow(self.samples, end)
+        self.labels = _grow(self.labels, end)
+        self.norms = _grow(self.norms, end)
+        self.samples[start:end] = samples_norm.reshape((samples_norm.shape[0], -1))
+        self.labels[start:end] = labels
+        self.norms[start:end] = np.linalg.norm(self.samples[start:end], axis=1)
+        self.n_samples = end
+
+    def find_nn(self, samples):
+        """
+        :param samples: A set of samples that need to find their labels
+        :return:        The predicted label and distance for each sample, the first nearest sample in the order they
+                        were added
+        """
+        if self.n_samples == 0:
+            raise RuntimeError('No matching label in database!')
+        samples_norm = normalize_samples(samples, self.sample_dim)
+        queries = samples_norm.reshape((samples_norm.shape[0], -1))
+        approx = -(queries @ self.samples[:self.n_samples].T)
+        return nearest_labels(queries, self.samples, self.labels, np.arange(self.n_samples)[None, :], approx,
+                              self.norms[None, :self.n_samples])
+
+    @staticmethod
+    def from_forest(forest):
+        """
+        :param forest: FlatForest, whose samples are shared rather than copied
+        :return: ExactIndex of the samples of the forest
+        """
+        if forest.distance_metric_type != 2:
+            raise ValueError("Exact search is for the negative dot product distance, not type {}".format(
+                forest.distance_metric_type))
+        index = ExactIndex(forest.sample_shape, forest.samples.dtype)
+        index.next_ind = forest.next_ind
+        index.samples = forest.samples[:forest.n_samples]
+        index.labels = forest.labels[:forest.n_samples]
+        index.norms = forest.norms[:forest.n_samples]
+        index.n_samples = forest.n_samples
+        return index
+
+
+if __name__ == '__main__':
+    # Compares the exact search with the trees of a forest, on samples drawn around one center per label: how often
+    # the forest finds the nearest sample, or at least its label, and the time to find one sample, as each frame
+    # Run as: python -m components.handRecognition.RandomForest.exact_index [--sizes 10000 30000] [--help]
+    # The defaults take about 8 minutes on one core, the forest of 50 trees taking 110 s to build for 10000 samples and
+    # 370 s for 30000. Larger sizes are run separately: --sizes 100000 takes about half an hour, and a forest of 1000000
+    # samples needs more than 4 GB and hours, run --sizes 1000000 --trees 0 for the exact search only
+    import argparse
+    import random
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 30000], help='Numbers of samples')
+    parser.add_argument('--trees', type=int, default=50, help='Trees of the forest, 0 for the exact search only')
+    parser.add_argument('--queries', type=int, default=200, help='Samples to find')
+    parser.add_argument('--labels', type=int, default=32, help='Labels of the samples')
+    parser.add_argument('--spread', type=float, default=1.0, help='Deviation of the samples around their center')
+    args = parser.parse_args()
+
+    random.seed(0)
+    rng = np.random.RandomState(0)
+    centers = rng.standard_normal((args.labels, feature_dim)).astype(np.float32)
+
+    def draw(n):
+        labels = rng.randint(0, args.labels, n)
+        samples = centers[labels] + rng.standard_normal((n, feature_dim)).astype(np.float32) * args.spread
+        return samples, labels
+
+    def per_sample_ms(find_nn, queries):
+        start = time.perf_counter()
+        results = [find_nn(query) for query in queries]
+        return (time.perf_counter() - start) * 1000 / len(queries), \
+            [result[0][0] for result in results], [result[1][0] for result in results]
+
+    print("{:>9} {:>6}  {:>10} {:>10}  {:>11} {:>10}  {:>9}".format(
+        "samples", "trees", "exact ms", "forest ms", "same sample", "same label", "build s"))
+    for size in args.sizes:
+        forest = FlatForest((feature_dim,))
+        index = ExactIndex((feature_dim,))
+        start = time.perf_counter()
+        # Added in parts, as the one-shot classifier adds the gestures it learns
+        for part in range(0, size, 10000):
+            samples, labels = draw(min(10000, size - part))
+            if not args.trees:
+                index.add_new(samples, labels)
+            elif part == 0:
+                forest.build_forest(samples, labels, args.trees)
+            else:
+                forest.add_new(samples, labels)
+        build_s = time.perf_counter() - start
+        if args.trees:
+            # The index shares the samples of the forest
+            index = ExactIndex.from_forest(forest)
+
+        queries, _ = draw(args.queries)
+        exact_ms, labels, dists = per_sample_ms(index.find_nn, queries)
+        columns = "{:>10} {:>11} {:>10}".format("-", "-", "-")
+        if args.trees:
+            forest_ms, forest_labels, forest_dists = per_sample_ms(forest.find_nn, queries)
+            # Both find the same distance for the same sample, the forest never a smaller one
+            assert all(forest_dist >= dist for forest_dist, dist in zip(forest_dists, dists))
+            same_sample = np.mean([forest_dist == dist for forest_dist, dist in zip(forest_dists, dists)])
+            same_label = np.mean([forest_label == label for forest_label, label in zip(forest_labels, labels)])
+            columns = "{:>10.2f} {:>11.1%} {:>10.1%}".format(forest_ms, same_sample, same_label)
+        print("{:>9} {:>6}  {:>10.2f} {}  {:>9.1f}".format(size, args.trees, exact_ms, columns, build_s))
@@ -0,0 +1,531 @@
+from . import parameters
+from .forest import feature_dim, normalize_samples
+from .node import distance_metric
+
+import copy
+import os
+import random
+import sys
+import time
+import numpy as np
+
+
+def _grow(array, size):
+    """
+    :return: the array if it holds size rows, else a copy of it with at least twice as many rows
+    """
+    if len(array) >= size:
+        return array
+    grown = np.empty((max(size, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def nearest_labels(queries, samples, labels, items, approx, norms):
+    """
+    Find the nearest of the candidate samples of each query, for the negative dot product distance, from the distances
+    computed with a matrix multiply. Its rounding differs from distance_metric(), by less than its error bound: the
+    candidates which are the nearest within that bound, few unless there are ties, get their distance from
+    distance_metric() again, to find the same nearest sample and distance as comparing the distances of
+    distance_metric() in order, i.e. the first one of the smallest distance.
+    :param queries: normalized samples, (n_queries, sample size)
+    :param samples: matrix of the samples, one per row
+    :param labels: label of each row of samples
+    :param items: row of each candidate of each query, (n_queries, n_candidates) or broadcast to it
+    :param approx: distance of each candidate computed with the matrix multiply, inf for no candidate
+    :param norms: euclidean norm of each candidate, 0 for no candidate
+    :return: The predicted label and distance for each query, as Forest.find_nn()
+    """
+    items = np.broadcast_to(items, approx.shape)
+    # Bound of the rounding error of both sums, with |x.y| <= |x| |y| and a margin for the rounding of the norms
+    dtype = np.result_type(queries, samples)
+    unit = np.finfo(dtype).eps / 2
+    gamma = (queries.shape[1] + 2) * unit / (1 - (queries.shape[1] + 2) * unit)
+    error = 2.01 * gamma * np.linalg.norm(queries, axis=1)[:, None] * norms
+
+    maybe = approx - error <= np.min(approx + error, axis=1)[:, None]
+    rows, cols = np.nonzero(maybe)
+    exact = np.full(approx.shape, np.inf)
+    # Summed row by row, as distance_metric() sums each sample, for the same rounding
+    exact[rows, cols] = -np.sum(queries[rows] * samples[items[rows, cols]], axis=1)
+    nearest = np.argmin(exact, axis=1)
+
+    best_labels = []
+    closest_dists = []
+    for i, j in enumerate(nearest):
+        dist = dtype.type(exact[i, j])
+        # (feature_dim*10)  is used as upper bound of distance, actual distance could be smaller
+        if dist < feature_dim*10:
+            best_labels.append(labels[items[i, j]])
+            closest_dists.append(dist)
+        else:
+            best_labels.append(2)  # 2 is gesture 'other'
+            closest_dists.append(feature_dim*10)
+    return best_labels, closest_dists
+
+
+class FlatForest:
+    """
+    The trees of a Forest stored in flat arrays rather than in Node objects, with the same results.
+    The samples of all the trees are stored once, as the rows of a matrix, each with its label. The nodes of all the
+    trees are indices into the arrays of nodes, the roots being in roots:
+      - an internal node has a pivot, the row of its pivot sample, a threshold, and left and right children
+      - a leaf node has a leaf, whose samples are the rows leaf_items[leaf, :leaf_size[leaf]], in the order of the
+        items of the Node
+    A leaf has room for one sample more than item_cnt_cap, the sample which makes it split.
+    """
+
+    def __init__(self, sample_shape, item_cnt_cap=None, distance_metric_type=None, dtype=np.float32):
+        """
+        :param sample_shape: Shape of a sample, (feature_dim,) for frames, (frame_per_clip, feature_dim) for clips
+        :param item_cnt_cap: The maximum number of items in a leaf before splitting, see parameters
+        :param distance_metric_type: The type of distance metric, see parameters
+        :param dtype: Type of the samples
+        """
+        self.sample_shape = tuple(sample_shape)
+        self.sample_dim = len(self.sample_shape)  # the dimensionality of the samples, as Forest.sample_dim
+        self.item_cnt_cap = parameters.item_cnt_cap if item_cnt_cap is None else item_cnt_cap
+        self.distance_metric_type = parameters.distance_metric_type if distance_metric_type is None \
+            else distance_metric_type
+        self.next_ind = None  # what will be the next index of novel sample
+        self.roots = []
+
+        # The arrays have room for more rows than used, counted by n_samples, n_nodes and n_leaves
+        self.samples = np.empty((0, int(np.prod(self.sample_shape))), dtype=dtype)
+        self.labels = np.empty(0, dtype=np.int64)
+        self.norms = np.empty(0, dtype=np.float64)  # euclidean norm of each sample, see _find_nn_batch()
+        self.n_samples = 0
+
+        self.pivot = np.empty(0, dtype=np.int32)  # -1 for a leaf node
+        self.threshold = np.empty(0, dtype=np.float64)
+        self.left = np.empty(0, dtype=np.int32)
+        self.right = np.empty(0, dtype=np.int32)
+        self.leaf = np.empty(0, dtype=np.int32)  # -1 for an internal node
+        self.n_nodes = 0
+
+        self.leaf_items = np.empty((0, self.item_cnt_cap + 1), dtype=np.int32)
+        self.leaf_size = np.empty(0, dtype=np.int32)
+        self.n_leaves = 0
+
+    def _new_sample(self, sample, label):
+        index = self.n_samples
+        self.samples = _grow(self.samples, index + 1)
+        self.labels = _grow(self.labels, index + 1)
+        self.norms = _grow(self.norms, index + 1)
+        self.samples[index] = np.reshape(sample, -1)
+        self.labels[index] = label
+        self.norms[index] = np.linalg.norm(self.samples[index])
+        self.n_samples += 1
+        return index
+
+    def _new_node(self):
+        index = self.n_nodes
+        self.pivot = _grow(self.pivot, index + 1)
+        self.threshold = _grow(self.threshold, index + 1)
+        self.left = _grow(self.left, index + 1)
+        self.right = _grow(self.right, index + 1)
+        self.leaf = _grow(self.leaf, index + 1)
+        self.pivot[index] = self.left[index] = self.right[index] = self.leaf[index] = -1
+        self.threshold[index] = 0
+        self.n_nodes += 1
+        return index
+
+    def _new_leaf_node(self, leaf=None, node=None):
+        """
+        :param leaf: leaf to reuse, None for a new one
+        :param node: node to make a leaf node, None for a new one
+        :return: the leaf node, without samples
+        """
+        if node is None:
+            node = self._new_node()
+        if leaf is None:
+            leaf = self.n_leaves
+            self.leaf_items = _grow(self.leaf_items, leaf + 1)
+            self.leaf_size = _grow(self.leaf_size, leaf + 1)
+            self.n_leaves += 1
+        self.leaf_size[leaf] = 0
+        self.leaf[node] = leaf
+        return node
+
+    def _distance(self, a, b):
+        return distance_metric(a, b, self.distance_metric_type)
+
+    def _descend(self, node, sample):
+        """
+        :return: the leaf node of the tree starting at node where the sample belongs
+        """
+        while self.pivot[node] >= 0:
+            if self._distance(sample, self.samples[self.pivot[node]]) <= self.threshold[node]:
+                node = self.left[node]
+            else:
+                node = self.right[node]
+        return node
+
+    def _insert(self, node, index):
+        """
+        Adds a sample to the tree starting at node, as Node.add()
+        :param index: row of the sample
+        """
+        sample = self.samples[index]
+        node = self._descend(node, sample)
+        leaf = self.leaf[node]
+        size = self.leaf_size[leaf]
+        # first check if sample already exists; if so, do not add sample into tree again
+        for item in self.leaf_items[leaf, :size]:
+            if np.array_equal(self.samples[item], sample):
+                return
+        self.leaf_items[leaf, size] = index
+        self.leaf_size[leaf] = size + 1
+        if size + 1 > self.item_cnt_cap:
+            self._split(node)
+
+    def _split(self, node):
+        """
+        Splits a leaf node at the median distance to a random pivot, as Node._split_node()
+        """
+        leaf = self.leaf[node]
+        items = self.leaf_items[leaf, :self.leaf_size[leaf]].copy()
+
+        # pick a random pivot
+        pivot = items[random.randint(0, len(items) - 1)]
+
+        # calculate all the distances and choose median distance as splitting threshold
+        distances = [self._distance(self.samples[i], self.samples[pivot]) for i in items]
+        threshold = np.median(distances)
+
+        # The left child reuses the leaf
+        left = self._new_leaf_node(leaf)
+        right = self._new_leaf_node()
+        self.pivot[node] = pivot
+        self.threshold[node] = threshold
+        self.left[node] = left
+        self.right[node] = right
+        self.leaf[node] = -1
+
+        for i, dist in zip(items, distances):
+            self._insert(left if dist <= threshold else right, i)
+
+    def build_forest(self, samples, labels, n_trees=50):
+        """
+        Build the trees from the samples, as Forest.build_forest()
+        :param samples: Training samples to build trees, with dimension: nSamples*feature_dim (every frame),
+                        nSamples[*frame_per_clip]*feature_dim (every clip) (nSamples >= 2)
+        :param labels:  Labels of training samples, with dimension: nSamples
+        :param n_trees: Number of trees to be built, default to 50 trees
+        :return:        None
+        """
+        self.roots = [self._new_leaf_node() for _ in range(n_trees)]
+        self.add_new(samples, labels)
+        self.next_ind = np.max(labels) + 10  # set next index to be 10 larger than the maximum index of labels
+
+    def copy(self):
+        """
+        :return: a copy to add samples to while this forest is searched, e.g. by another thread, see
+        OneShotWorker.learn(). The nodes and leaves, which add_new() changes, are copied. The samples are shared:
+        add_new() only writes the rows after n_samples, which this forest does not read, or copies them when full, so
+        only one copy at a time may be added to.
+        """
+        forest = copy.copy(self)
+        for name in ('pivot', 'threshold', 'left', 'right', 'leaf', 'leaf_items', 'leaf_size'):
+            setattr(forest, name, getattr(self, name).copy())
+        forest.roots = list(self.roots)
+        return forest
+
+    def add_new(self, samples, labels=None):
+        """
+        This function is used to add a GROUP of or a SINGLE new samples into forest, as Forest.add_new()
+        :param samples: New training samples to build trees, with dimension: nSamples*15*1024 or 15*1024
+        :param labels:  Labels of new samples, with dimension: nSamples
+        :return:        None
+        """
+        samples_norm = normalize_samples(samples, self.sample_dim)
+
+        # if labels are not supplied, use internal next_ind
+        if labels is None:
+            labels = [self.next_ind] * samples_norm.shape[0]
+
+        # Each sample is stored once, for all the trees
+        indices = [self._new_sample(sample, label) for sample, label in zip(samples_norm, labels)]
+        for root in self.roots:
+            for i in random.sample(range(len(indices)), len(indices)):  # shuffled index, as Tree.add_new()
+                self._insert(root, indices[i])
+
+    def find_nn(self, samples):
+        """
+        :param samples: A set of samples that need to find their labels
+        :return:        The predicted label and distance for each sample
+        """
+        samples_norm = normalize_samples(samples, self.sample_dim)
+        queries = samples_norm.reshape((samples_norm.shape[0], -1))
+        if self.distance_metric_type != 2:
+            return self._find_nn_each(queries)
+        return self._find_nn_batch(queries)
+
+    def _find_nn_each(self, queries):
+        """
+        find_nn() one normalized sample and one tree at a time, as Forest.find_nn()
+        """
+        best_labels = [-2] * len(queries)
+        # (feature_dim*10)  is used as upper bound of distance, actual distance could be smaller
+        closest_dists = [feature_dim*10] * len(queries)
+        for i, s in enumerate(queries):
+            for root in self.roots:
+                leaf = self.leaf[self._descend(root, s)]
+                items = self.leaf_items[leaf, :self.leaf_size[leaf]]
+                if len(items) == 0:
+                    raise RuntimeError('No matching label in database!')
+                distances = [self._distance(s, self.samples[item]) for item in items]
+                nearest = np.argmin(distances)
+                if distances[nearest] < closest_dists[i]:
+                    best_labels[i] = self.labels[items[nearest]]
+                    closest_dists[i] = distances[nearest]
+            if best_labels[i] == -2:
+                best_labels[i] = 2  # 2 is gesture 'other'
+
+        return best_labels, closest_dists
+
+    def _route(self, queries):
+        """
+        Descend all the trees with all the normalized samples at once, one level at a time
+        :return: the leaf node of each sample in each tree, (n_samples, n_trees)
+        """
+        nodes = np.tile(np.array(self.roots, dtype=np.int32), len(queries))
+        query_of = np.repeat(np.arange(len(queries)), len(self.roots))
+        active = np.flatnonzero(self.pivot[nodes] >= 0)
+        while len(active):
+            current = nodes[active]
+            # Summed row by row, as distance_metric() sums each sample, for the same rounding
+            dists = -np.sum(queries[query_of[active]] * self.samples[self.pivot[current]], axis=1)
+            nodes[active] = np.where(dists <= self.threshold[current], self.left[current], self.right[current])
+            active = active[self.pivot[nodes[active]] >= 0]
+        return nodes.reshape((len(queries), len(self.roots)))
+
+    def _find_nn_batch(self, queries):
+        """
+        find_nn() all the normalized samples and all the trees at once, for the negative dot product distance
+        The distances to the samples of the leaves are computed with one matrix multiply, and the nearest one found
+        by nearest_labels(), for the same sample and distance as _find_nn_each(), i.e. the first one of the smallest
+        distance, in the order of the trees and of the samples in a leaf.
+        """
+        leaves = self.leaf[self._route(queries)]
+        if np.any(self.leaf_size[leaves] == 0):
+            raise RuntimeError('No matching label in database!')
+        # The samples of the leaves of each query, in order, as (n_samples, n_trees * leaf width) with -1 padding
+        items = self.leaf_items[leaves].reshape((len(queries), -1))
+        valid = (np.arange(self.leaf_items.shape[1]) < self.leaf_size[leaves][..., None]).reshape(items.shape)
+
+        # One matrix multiply with the samples of all the leaves, each once
+        rows, cols = np.nonzero(valid)
+        candidates, columns = np.unique(items[rows, cols], return_inverse=True)
+        approx = np.full(items.shape, np.inf)
+        approx[rows, cols] = -(queries @ self.samples[candidates].T)[rows, columns]
+        if not np.all(np.isfinite(approx[rows, cols])):
+            # NaN distances, e.g. of a blank sample, follow the comparisons of the loop
+            return self._find_nn_each(queries)
+
+        norms = np.zeros(items.shape)
+        norms[rows, cols] = self.norms[items[rows, cols]]
+        return nearest_labels(queries, self.samples, self.labels, items, approx, norms)
+
+    @staticmethod
+    def from_forest(forest):
+        """
+        :param forest: Forest, e.g. loaded from a pickle
+        :return: FlatForest with the same trees, each sample being stored once
+        """
+        first = forest.trees[0].head
+        sample_shape = np.shape(first._items[0][0])
+        flat = FlatForest(sample_shape, first._item_cnt_cap, first._distance_metric_type,
+                          np.asarray(first._items[0][0]).dtype)
+        flat.next_ind = forest.next_ind
+
+        # The pickled trees hold a copy of every sample each
+        rows = {}
+
+        def row(item):
+            sample, label = item
+            key = (np.asarray(sample, dtype=flat.samples.dtype).tobytes(), label)
+            if key not in rows:
+                rows[key] = flat._new_sample(sample, label)
+            return rows[key]
+
+        for tree in forest.trees:
+            root = flat._new_node()
+            flat.roots.append(root)
+            stack = [(tree.head, root)]
+            while stack:
+                node, index = stack.pop()
+                if node._item_cnt_cap != flat.item_cnt_cap or \
+                        node._distance_metric_type != flat.distance_metric_type:
+                    raise ValueError("The nodes of the forest have different parameters")
+                if node._internal_node:
+                    left = flat._new_node()
+                    right = flat._new_node()
+                    flat.pivot[index] = row(node._items[0])
+                    flat.threshold[index] = node._dist_threshold
+                    flat.left[index] = left
+                    flat.right[index] = right
+                    stack.append((node._left_child, left))
+                    stack.append((node._right_child, right))
+                else:
+                    if len(node._items) > flat.item_cnt_cap + 1:
+                        raise ValueError("A leaf holds {} items, more than {}".format(len(node._items),
+                                                                                   flat.item_cnt_cap))
+                    leaf = flat.leaf[flat._new_leaf_node(node=index)]
+                    for i, item in enumerate(node._items):
+                        flat.leaf_items[leaf, i] = row(item)
+                    flat.leaf_size[leaf] = len(node._items)
+        return flat
+
+    def save(self, path, dtype=None):
+        """
+        Save the forest as a .npz file, see load()
+        :param dtype: Type of the stored samples, e.g. np.float16 to halve their size, at the cost of exact results;
+                      None for the type of the samples
+        """
+        arrays = dict(
+            sample_shape=np.array(self.sample_shape, dtype=np.int64),
+            parameters=np.array([self.item_cnt_cap, self.distance_metric_type], dtype=np.int64),
+            samples=self.samples[:self.n_samples].astype(dtype or self.samples.dtype, copy=False),
+            labels=self.labels[:self.n_samples],
+            pivot=self.pivot[:self.n_nodes],
+            threshold=self.threshold[:self.n_nodes],
+            left=self.left[:self.n_nodes],
+            right=self.right[:self.n_nodes],
+            leaf=self.leaf[:self.n_nodes],
+            leaf_items=self.leaf_items[:self.n_leaves],
+            leaf_size=self.leaf_size[:self.n_leaves],
+            roots=np.array(self.roots, dtype=np.int32))
+        if self.next_ind is not None:
+            arrays['next_ind'] = np.array(self.next_ind, dtype=np.int64)
+        np.savez(path, **arrays)
+
+    @staticmethod
+    def load(path):
+        """
+        :param path: .npz file written by save()
+        :return: The loaded instance of FlatForest
+        """
+        with np.load(path) as data:
+            item_cnt_cap, distance_metric_type = (int(value) for value in data['parameters'])
+            samples = data['samples']
+            # Samples stored as float16 are compared as float32
+            flat = FlatForest(data['sample_shape'], item_cnt_cap, distance_metric_type,
+                              np.float32 if samples.dtype == np.float16 else samples.dtype)
+            flat.samples = samples.astype(flat.samples.dtype, copy=False)
+            flat.labels = data['labels']
+            flat.norms = np.linalg.norm(flat.samples, axis=1)
+            flat.n_samples = len(flat.labels)
+            for name in ('pivot', 'threshold', 'left', 'right', 'leaf'):
+                setattr(flat, name, data[name])
+            flat.n_nodes = len(flat.pivot)
+            flat.leaf_items = data['leaf_items']
+            flat.leaf_size = data['leaf_size']
+            flat.n_leaves = len(flat.leaf_size)
+            flat.roots = [int(root) for root in data['roots']]
+            if 'next_ind' in data:
+                flat.next_ind = int(data['next_ind'])
+        return flat
+
+
+def _file_size(path):
+    return os.path.getsize(path) / 1e6
+
+
+if __name__ == '__main__':
+    # Converts a pickled Forest, checks that both find the same labels and distances, and reports the size and load
+    # time of both. Without a pickle, checks a forest built from random samples, including adding samples.
+    # Run as: python -m components.handRecognition.RandomForest.flat_forest [./models/RH/forest.pickle] [--help]
+    import argparse
+    import pickle
+    import tempfile
+
+    from .forest import Forest
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pickle', nargs='?', default=None, help='Pickled Forest, e.g. ./models/RH/forest.pickle')
+    parser.add_argument('--output', default=None, help='Converted forest, by default forest.npz next to the pickle')
+    parser.add_argument('--dtype', default='float32', choices=('float32', 'float16'),
+                        help='Type of the stored samples; float16 halves their size but changes the distances')
+    parser.add_argument('--check', type=int, default=200, help='Number of queries compared between both forests')
+    args = parser.parse_args()
+
+    def check(forest, flat, queries):
+        labels, dists = forest.find_nn(queries)
+        flat_labels, flat_dists = flat.find_nn(queries)
+        assert [int(label) for label in labels] == [int(label) for label in flat_labels], "different labels"
+        assert np.array_equal(np.array(dists, dtype=np.float64), np.array(flat_dists, dtype=np.float64)), \
+            "different distances"
+
+    if args.pickle is None:
+        random.seed(0)
+        rng = np.random.RandomState(0)
+        samples = rng.standard_normal((3000, feature_dim)).astype(np.float32)
+        # Identical samples with different labels, whose distances tie
+        samples[-100:] = samples[:100]
+        forest = Forest()
+        forest.build_forest(samples, rng.randint(0, 32, len(samples)), n_trees=10, verbose=False)
+        directory = tempfile.mkdtemp()
+        pickle_path = os.path.join(directory, 'forest.pickle')
+        with open(pickle_path, 'wb') as f:
+            pickle.dump(forest, f)
+    else:
+        pickle_path = args.pickle
+        # The pickle refers to the package as RandomForest, see one_shot_classifier
+        sys.modules.setdefault('RandomForest', sys.modules[__package__])
+
+    start = time.perf_counter()
+    with open(pickle_path, 'rb') as f:
+        forest = pickle.load(f, encoding='latin1')
+    pickle_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    flat = FlatForest.from_forest(forest)
+    convert_time = time.perf_counter() - start
+    output = args.output or os.path.join(os.path.dirname(pickle_path), 'forest.npz')
+    flat.save(output, np.dtype(args.dtype))
+
+    start = time.perf_counter()
+    flat = FlatForest.load(output)
+    load_time = time.perf_counter() - start
+
+    stored = flat.samples[:flat.n_samples].reshape((-1,) + flat.sample_shape)
+    rng = np.random.RandomState(1)
+    picked = stored[rng.randint(0, len(stored), args.check)]
+    queries = picked + rng.standard_normal(picked.shape).astype(picked.dtype) * 0.5
+    # and stored samples, at the smallest distance of several samples
+    queries[:len(queries) // 4] = picked[:len(queries) // 4]
+    if args.dtype == 'float32':
+        check(forest, flat, queries)
+        print("checked {} queries: same labels and distances".format(len(queries)))
+    else:
+        agree = np.mean([int(a) == int(b) for a, b in zip(forest.find_nn(queries)[0], flat.find_nn(queries)[0])])
+        print("{:.1%} of {} queries with the same labels".format(agree, len(queries)))
+
+    # One sample at a time, as OneShotClassifier._find_label() for each frame
+    for name, find_nn in (("forest", forest.find_nn), ("flat", flat.find_nn)):
+        start = time.perf_counter()
+        for query in queries:
+            find_nn(query)
+        print("{:<10}find_nn in {:7.2f} ms per sample".format(name, (time.perf_counter() - start) * 1000 / len(queries)))
+    start = time.perf_counter()
+    flat.find_nn(queries)
+    print("{:<10}find_nn in {:7.2f} ms per sample, {} at once".format(
+        "flat", (time.perf_counter() - start) * 1000 / len(queries), len(queries)))
+
+    if args.pickle is None and args.dtype == 'float32':
+        # Adding samples to both, with the same random pivots
+        new_samples = rng.standard_normal((30, feature_dim)).astype(np.float32)
+        random.seed(1)
+        forest.add_new(new_samples, [40] * len(new_samples))
+        random.seed(1)
+        flat.add_new(new_samples, [40] * len(new_samples))
+        check(forest, flat, np.concatenate((queries, new_samples + rng.standard_normal(new_samples.shape).astype(
+            np.float32) * 0.5)))
+        print("checked adding {} samples".format(len(new_samples)))
+
+    print("{} trees, {} nodes, {} leaves, {} unique samples".format(len(flat.roots), flat.n_nodes, flat.n_leaves,
+                                                                   flat.n_samples))
+    print("pickle    {:9.1f} MB  loaded in {:7.2f} s".format(_file_size(pickle_path), pickle_time))
+    print("flat      {:9.1f} MB  loaded in {:7.2f} s  ({} samples, converted in {:.2f} s)".format(
+        _file_size(output), load_time, args.dtype, convert_time))
@@ -7,6 +7,23 @@ frame_per_clip = 15
 feature_dim = 1024
 
 
+def normalize_samples(samples, sample_dim):
+    """
+    :param samples: A set of samples, or a single sample
+    :param sample_dim: The dimensionality of a sample, 1 for frames, 2 for clips
+    :return: A copy of the samples, with a zero mean and a unit standard deviation each
+    """
+    samples_norm = np.copy(samples)
+    if len(samples_norm.shape) == sample_dim:
+        # only one sample, add one extra dimension to dim 0
+        samples_norm = np.expand_dims(samples_norm, axis=0)
+    for i in range(samples_norm.shape[0]):
+        samples_norm[i] -= np.mean(samples_norm[i])
+        samples_norm[i] /= np.std(samples_norm[i])
+
+    return samples_norm
+
+
 class Forest:
     def __init__(self):
         self.trees = []  # trees in forest
@@ -110,15 +127,7 @@ class Forest:
         return best_labels, closest_dists
 
     def _normalize_sample(self, samples):
-        samples_norm = np.copy(samples)
-        if len(samples_norm.shape) == self.sample_dim:
-            # only one sample, add one extra dimension to dim 0
-            samples_norm = np.expand_dims(samples_norm, axis=0)
-        for i in range(samples_norm.shape[0]):
-            samples_norm[i] -= np.mean(samples_norm[i])
-            samples_norm[i] /= np.std(samples_norm[i])
-
-        return samples_norm
+        return normalize_samples(samples, self.sample_dim)
 
     def trace(self, sample, tree_no=0):
         """
@@ -5,6 +5,23 @@ import numpy as np
 from scipy.stats import pearsonr
 
 
+def distance_metric(a, b, distance_metric_type):
+    """
+    :param a: One item
+    :param b: Another item
+    :param distance_metric_type: see parameters.distance_metric_type
+    :return: Distance between items a and b
+    """
+    if distance_metric_type == 0:
+        return -pearsonr(a.flatten(), b.flatten())[0]  # to match with euclidean distance measure, negate
+    elif distance_metric_type == 1:
+        return np.linalg.norm(a.flatten()-b.flatten())
+    elif distance_metric_type == 2:
+        return -np.sum(a.flatten() * b.flatten())
+    else:
+        raise ValueError('Unrecognized distance metric type')
+
+
 class Node:
     def __init__(self, item_per_node=None):
         self._left_child = None
@@ -80,14 +97,7 @@ class Node:
         :param b: Another item
         :return: Distance between items a and b
         """
-        if self._distance_metric_type == 0:
-            return -pearsonr(a.flatten(), b.flatten())[0]  # to match with euclidean distance measure, negate
-        elif self._distance_metric_type == 1:
-            return np.linalg.norm(a.flatten()-b.flatten())
-        elif self._distance_metric_type == 2:
-            return -np.sum(a.flatten() * b.flatten())
-        else:
-            raise ValueError('Unrecognized distance metric type')
+        return distance_metric(a, b, self._distance_metric_type)
 
     def print_node(self, level=0):
         """
@@ -1,3 +1,4 @@
 item_cnt_cap = 21  # The maximum number of items in a node before splitting
 split_mehod = 0  # The choice of splitting criteria. 0 means median splitting
-distance_metric_type = 2  # The type of distance metric. 0 - feature vector with correlation; 1 - feature vector with euclidean distance
\ No newline at end of file
+distance_metric_type = 2  # The type of distance metric. 0 - feature vector with correlation; 1 - feature vector with euclidean distance
+nn_search = 'forest'  # The nearest neighbor search of the one-shot classifier. 'forest' - the trees of the forest; 'exact' - every sample, see exact_index
\ No newline at end of file
@@ -0,0 +1,111 @@
+from .exact_index import ExactIndex
+
+import time
+import numpy as np
+
+
+class SessionForest:
+    """
+    The samples added during a session, e.g. the gestures learned from a user, searched alongside a base forest which
+    is never changed, so that it can be shared, e.g. by the one-shot workers of both hands, and the session forgotten
+    without loading the base forest again, see reset().
+    The added samples are few, they are searched exactly, with an ExactIndex.
+    Same interface as Forest for the one-shot classifier: find_nn(), add_new() and next_ind.
+    """
+
+    def __init__(self, base, overlay=None):
+        """
+        :param base: FlatForest or ExactIndex, which is only searched
+        :param overlay: ExactIndex of the samples added, None for none
+        """
+        self.base = base
+        if overlay is None:
+            overlay = ExactIndex(base.sample_shape, base.samples.dtype)
+            overlay.next_ind = base.next_ind
+        self.overlay = overlay
+
+    @property
+    def next_ind(self):
+        return self.overlay.next_ind
+
+    def reset(self):
+        """
+        :return: the session forest of the base forest, without the samples added
+        """
+        return SessionForest(self.base)
+
+    def copy(self):
+        """
+        :return: a copy to add samples to while this one is searched, sharing the base forest, see ExactIndex.copy()
+        """
+        return SessionForest(self.base, self.overlay.copy())
+
+    def add_new(self, samples, labels=None):
+        """
+        This function is used to add a GROUP of or a SINGLE new samples to the session, as Forest.add_new()
+        :param samples: New samples, with dimension: nSamples*feature_dim or feature_dim
+        :param labels:  Labels of new samples, with dimension: nSamples
+        :return:        None
+        """
+        self.overlay.add_new(samples, labels)
+
+    def find_nn(self, samples):
+        """
+        :param samples: A set of samples that need to find their labels
+        :return:        The predicted label and distance for each sample, from the samples added if they are nearer
+                        than the ones of the base forest
+        """
+        best_labels, closest_dists = self.base.find_nn(samples)
+        if self.overlay.n_samples:
+            for i, (label, dist) in enumerate(zip(*self.overlay.find_nn(samples))):
+                if dist < closest_dists[i]:
+                    best_labels[i] = label
+                    closest_dists[i] = dist
+        return best_labels, closest_dists
+
+
+if __name__ == '__main__':
+    # Checks that the gestures learned in a session are found, that both hands share the base forest without seeing
+    # the gestures of each other, and that resetting forgets them without changing the base forest, compared to
+    # loading it again
+    # Run as: python -m components.handRecognition.RandomForest.session_forest
+    import os
+    import random
+    import tempfile
+
+    from .flat_forest import FlatForest
+    from .forest import feature_dim
+
+    random.seed(0)
+    rng = np.random.RandomState(0)
+    base = FlatForest((feature_dim,))
+    samples = rng.standard_normal((3000, feature_dim)).astype(np.float32)
+    base.build_forest(samples, rng.randint(0, 32, len(samples)), 10)
+    # Near samples of the base forest
+    queries = samples[:50] + rng.standard_normal((50, feature_dim)).astype(np.float32) * 0.1
+    base_result = base.find_nn(queries)
+
+    right = SessionForest(base)
+    left = SessionForest(base)
+    gesture = rng.standard_normal((30, feature_dim)).astype(np.float32)
+    learned = right.copy()
+    learned.add_new(gesture, [32] * len(gesture))
+    right = learned
+    taught = gesture + rng.standard_normal(gesture.shape).astype(np.float32) * 0.1
+    assert all(label == 32 for label in right.find_nn(taught)[0])
+    assert all(label != 32 for label in left.find_nn(taught)[0])
+    assert right.find_nn(queries) == base_result
+
+    start = time.perf_counter()
+    right = right.reset()
+    reset_ms = (time.perf_counter() - start) * 1000
+    assert all(label != 32 for label in right.find_nn(taught)[0])
+    assert base.find_nn(queries) == base_result and base.n_samples == 3000
+
+    path = os.path.join(tempfile.mkdtemp(), 'forest.npz')
+    base.save(path)
+    start = time.perf_counter()
+    FlatForest.load(path)
+    load_ms = (time.perf_counter() - start) * 1000
+    print("reset in {:.3f} ms, loading the base forest again in {:.1f} ms ({:.1f} MB)".format(
+        reset_ms, load_ms, os.path.getsize(path) / 1e6))
@@ -6,20 +6,65 @@ import queue
 import os
 import time
 
-from components.handRecognition.depth_client import is_gesture, is_bright
+# depth_client imports this module through one_shot_classifier, its functions are looked up when called
+import components.handRecognition.depth_client as depth_client
+from . import parameters
+from .flat_forest import FlatForest
+from .exact_index import ExactIndex
+from .session_forest import SessionForest
+
+# The base forests, loaded once and shared by the workers of both hands, which never change them, see SessionForest
+_base_forests = {}
+_base_forests_lock = threading.Lock()  # held by the workers only while loading, for each forest to be loaded once
+
+
+def read_forest(hand_type, nn_search):
+    """
+    :param hand_type: hand of the forest, "RH" or "LH"
+    :param nn_search: the nearest neighbor search, 'forest' or 'exact', see parameters.nn_search
+    :return: the forest of the hand, read from ./models
+    """
+    # The forest converted by flat_forest loads much faster than the pickle, which is the fallback
+    load_path = './models/%s/forest.npz' % hand_type
+    if not os.path.exists(load_path):
+        load_path = './models/%s/forest.pickle' % hand_type
+    print('Loading random forest checkpoint: %s' % load_path)
+
+    if load_path.endswith('.npz'):
+        forest = FlatForest.load(load_path)
+    else:
+        with open(load_path, 'rb') as f:
+            # find_nn() of FlatForest classifies each frame faster, with the same results
+            forest = FlatForest.from_forest(pickle.load(f, encoding='latin1'))
+    if nn_search == 'exact':
+        forest = ExactIndex.from_forest(forest)
+    return forest
+
+
+def base_forest(hand_type, nn_search):
+    """
+    :return: the forest of the hand, read by the first worker asking for it, which the others wait for
+    """
+    with _base_forests_lock:
+        if (hand_type, nn_search) not in _base_forests:
+            _base_forests[hand_type, nn_search] = read_forest(hand_type, nn_search)
+        return _base_forests[hand_type, nn_search]
 
 
 class OneShotWorker(threading.Thread):
     def __init__(self, hand_type, forest_status, event_vars, one_shot_queue,
-                 global_lock, is_flipped, blacklist, is_test=False):
+                 global_lock, is_flipped, blacklist, is_test=False, nn_search=None):
         threading.Thread.__init__(self)
         self.hand_type = hand_type
         self.forest_status = forest_status
         self.event_vars = event_vars
         self.one_shot_queue = one_shot_queue
         self.new_gesture_index = 32  # the first new gesture, increment when a new gesture is learned
+        # The forest is replaced rather than changed, see learn(), the lock shared with the frames is not taken
         self.global_lock = global_lock
         self.is_test = is_test  # whether it is testing; should save reference images if is_test
+        # the nearest neighbor search, 'forest' or 'exact', see parameters.nn_search
+        self.nn_search = nn_search if nn_search is not None else parameters.nn_search
 
         # Find out the corresponding kinect v2 joint index of the hand
         if self.hand_type == 'RH':
@@ -77,7 +122,7 @@ class OneShotWorker(threading.Thread):
             self.receiving_frames = True
         if not self.receiving_frames:
             return
-        if is_gesture(self.hand_type, skeleton_arr, 0, 0) and is_bright(depth_frame):
+        if depth_client.is_gesture(self.hand_type, skeleton_arr, 0, 0) and depth_client.is_bright(depth_frame):
             if not self.skip_frame:
                 self.ref_frames.append(feature)
                 self.palm_centers.append(skeleton_arr[self.palm_coordinates_ind_start:self.palm_coordinates_ind_end])
@@ -100,15 +145,7 @@ class OneShotWorker(threading.Thread):
                         self.ref_frames = []
                         self.palm_centers = []
                         # add reference features to forest
-                        self.global_lock.acquire()
-                        print('ADDING...')
-                        self.forest_status.is_fresh = False
-                        self.forest.add_new(new_features, [self.new_gesture_index] * len(new_features))
-                        print('ADDING FINISHED...')
-                        self.forest_status.is_ready = True
-                        self.new_gesture_index += 1
-                        self.event_vars.learn_complete_event.set()
-                        self.global_lock.release()
+                        self.learn(new_features)
                     else:
                         pass#print(self.hand_type, 'waiting for palm to stabilize')
 
@@ -123,16 +160,31 @@ class OneShotWorker(threading.Thread):
                 self.receiving_frames = False
                 self.continous_no_gesture_frame_count = 0
 
-                self.global_lock.acquire()
                 self.forest_status.is_ready = True
                 self.event_vars.learn_no_action_event.set()
-                self.global_lock.release()
 
             self.ref_frames = []
             self.palm_centers = []
 
         self.skip_frame = (self.skip_frame + 1) % 3  # skip every 2 frames to maximize variance in learning input
 
+    def learn(self, new_features):
+        """
+        Add the features of a new gesture to a copy of the forest, and publish it by replacing the forest: the frames
+        keep being classified with the previous forest meanwhile, without waiting for a lock
+        :param new_features: reference features of the new gesture
+        :return: None
+        """
+        print('ADDING...')
+        forest = self.forest.copy()
+        forest.add_new(new_features, [self.new_gesture_index] * len(new_features))
+        print('ADDING FINISHED...')
+        self.forest = forest
+        self.forest_status.is_fresh = False
+        self.forest_status.is_ready = True
+        self.new_gesture_index += 1
+        self.event_vars.learn_complete_event.set()
+
     def _palm_center_buffer_variance(self):
         """
         This method calculates the variance of distances of palm centers between two consecutive frames.
@@ -150,22 +202,108 @@ class OneShotWorker(threading.Thread):
         pass
 
     def load_forest(self):
-        self.global_lock.acquire()
-
+        """
+        Forget the gestures learned, by replacing the forest with the base forest alone, which is only loaded the first
+        time, see base_forest()
+        """
         if self.is_flipped:
             load_hand_type = "RH"
         else:
             load_hand_type = self.hand_type
-        load_path = './models/%s/forest.pickle' % load_hand_type
-        print('Loading random forest checkpoint: %s' % load_path)
 
-        with open(load_path, 'rb') as f:
-            self.forest = pickle.load(f, encoding='latin1')
+        # The forest is published by replacing the previous one, as in learn(), without blocking the frames
+        # A reload requested while loading loads the forest again
+        self.event_vars.load_forest_event.clear()
+        if self.forest is None:
+            self.forest = SessionForest(base_forest(load_hand_type, self.nn_search))
+        else:
+            self.forest = self.forest.reset()
         self.forest_status.is_fresh = True  # whether the forest is a fresh copy
         self.forest_status.is_ready = True  # whether the forest is ready to be used for classification
         self.new_gesture_index = 32  # reset the index
-        self.event_vars.load_forest_event.clear()
-
-        self.global_lock.release()
+        self.event_vars.forest_loaded_event.set()
 
         print('%s forest loaded!' % load_hand_type)
+
+if __name__ == '__main__':
+    # Measures the time of the frames of a hand while gestures are learned: a frame loop searches the forest 30 times
+    # per second while the worker adds the features of gestures, with learn(), which replaces the session forest, then
+    # as before, adding them to the trees of the forest itself while holding the lock which the frames take
+    # Run as: python -m components.handRecognition.RandomForest.threaded_one_shot [--help]
+    import argparse
+    import random
+    import types
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--samples', type=int, default=3000, help='Samples of the forest')
+    parser.add_argument('--trees', type=int, default=50, help='Trees of the forest')
+    parser.add_argument('--gestures', type=int, default=5, help='Gestures learned, 30 features each')
+    args = parser.parse_args()
+
+    random.seed(0)
+    rng = np.random.RandomState(0)
+    feature_dim = 1024
+    forest = FlatForest((feature_dim,))
+    forest.build_forest(rng.standard_normal((args.samples, feature_dim)).astype(np.float32),
+                        rng.randint(0, 32, args.samples), args.trees)
+    frames = rng.standard_normal((90, feature_dim)).astype(np.float32)
+    gestures = [rng.standard_normal((30, feature_dim)).astype(np.float32) for _ in range(args.gestures)]
+
+    def measure(locked):
+        """
+        :param locked: whether the frames and the learning take the lock, as before
+        :return: the worker, the time of each frame in ms, the time to learn each gesture in ms
+        """
+        worker = OneShotWorker('RH', types.SimpleNamespace(is_fresh=True, is_ready=True),
+                               types.SimpleNamespace(learn_complete_event=threading.Event()), queue.Queue(),
+                               threading.Lock(), False, set())
+        # Before, the gestures were added to the trees of the forest
+        worker.forest = forest.copy() if locked else SessionForest(forest)
+        random.seed(1)
+        frame_ms = []
+        learn_ms = []
+        done = threading.Event()
+
+        def frame_loop():
+            next_frame = time.perf_counter()
+            while not done.is_set():
+                start = time.perf_counter()
+                if locked:
+                    with worker.global_lock:
+                        worker.forest.find_nn(frames[len(frame_ms) % len(frames)])
+                else:
+                    worker.forest.find_nn(frames[len(frame_ms) % len(frames)])
+                frame_ms.append((time.perf_counter() - start) * 1000)
+                next_frame += 1 / 30
+                time.sleep(max(0.0, next_frame - time.perf_counter()))
+
+        frame_thread = threading.Thread(target=frame_loop)
+        frame_thread.start()
+        time.sleep(0.5)
+        for features in gestures:
+            start = time.perf_counter()
+            if locked:
+                with worker.global_lock:
+                    worker.forest.add_new(features, [worker.new_gesture_index] * len(features))
+                    worker.new_gesture_index += 1
+            else:
+                worker.learn(features)
+            learn_ms.append((time.perf_counter() - start) * 1000)
+            time.sleep(0.3)
+        done.set()
+        frame_thread.join()
+        return worker, frame_ms, learn_ms
+
+    print("{:<10}{:>8} {:>8} {:>8} {:>8} {:>10} {:>10}".format(
+        "", "frames", "p50 ms", "p99 ms", "max ms", "> 33 ms", "learn ms"))
+    workers = []
+    for name, locked in (("lock", True), ("replace", False)):
+        worker, frame_ms, learn_ms = measure(locked)
+        workers.append(worker)
+        print("{:<10}{:>8} {:>8.2f} {:>8.2f} {:>8.2f} {:>10} {:>10.1f}".format(
+            name, len(frame_ms), np.percentile(frame_ms, 50), np.percentile(frame_ms, 99), np.max(frame_ms),
+            sum(ms > 1000 / 30 for ms in frame_ms), np.mean(learn_ms)))
+
+    # The gestures were learned, and the forest shared by the session is unchanged
+    assert all(label == 32 + len(gestures) - 1 for label in workers[1].forest.find_nn(gestures[-1])[0])
+    assert forest.n_samples == args.samples
@@ -1,7 +1,6 @@
-import struct
-
-import numpy as np
-from skimage.transform import resize
+from components.fusion.conf import codecs
+from components.fusion.conf import metrics
+from components.handRecognition.preprocess import preprocess_hand
 
 class BaseClassifier:
     def __init__(self, hand, lock, blacklist, is_flipped=False):
@@ -9,6 +8,10 @@ class BaseClassifier:
         self.num_gestures = 32  # this is the number of gestures trained with ResNet
         self.probs = None  # probs sent to fusion, recalculate for each frame
         self.hand = hand
+        self._encoder = None  # created for the stream id of the first message
+        # Printed by the metrics reporter rather than for every frame
+        self._gesture = metrics.gauge("gesture", hand=hand)
+        self._probability = metrics.gauge("probability", hand=hand)
 
     def get_bytes(self, timestamp, writer_data_hand, engaged, frame_pieces, gestures, stream_id, probs, feature, blind, frame):
         self.probs = [0 for i in range(len(gestures))]
@@ -16,11 +19,14 @@ class BaseClassifier:
 
         max_index = self._process(feature, writer_data_hand, engaged, frame_pieces, probs, gestures, blind, frame)
 
-        print('{:<20}'.format(gestures[max_index]), '{:.1}'.format(float(self.probs[max_index])), end='\t')
+        self._gesture.set(gestures[max_index])
+        self._probability.set(float(self.probs[max_index]))
 
-        pack_list = [stream_id, timestamp, max_index] + list(self.probs)
+        if self._encoder is None:
+            self._encoder = codecs.get_codec(stream_id).encoder()
 
-        return struct.pack("<iqi" + "f" * len(self.probs), *pack_list)
+        # The message is prefixed by its size, and valid until the next call
+        return self._encoder.encode(stream_id, timestamp, max_index, *self.probs)
 
     def _process(self, feature, writer_data_hand, engaged, frame_pieces, probs, gestures, blind, frame):
         if blind:
@@ -34,13 +40,4 @@ class BaseClassifier:
         return max_index
 
     def _preprocess_hand_arr(self, depth_data, posx, posy, height, width):
-        hand_arr = np.array(depth_data, dtype=np.float32).reshape((height, width))
-        posz = hand_arr[int(posx), int(posy)]
-        hand_arr -= posz
-        hand_arr /= 150
-        hand_arr = np.clip(hand_arr, -1, 1)
-        hand_arr = resize(hand_arr, (168, 168))
-        hand_arr = hand_arr[20:-20, 20:-20]
-        hand_arr = hand_arr.reshape((1, 128, 128, 1))
-
-        return hand_arr
+        return preprocess_hand(depth_data, posx, posy, height, width)
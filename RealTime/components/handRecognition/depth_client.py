@@ -1,20 +1,27 @@
 import struct
 import threading
-import time
 import argparse
+import functools
 import numpy as np
-from skimage.transform import resize
 import sys
 
 from components.fusion.conf import postures
-from components.handRecognition.realtime_hand_recognition import RealTimeHandRecognition, RealTimeHandRecognitionOneShot
+from components.handRecognition.realtime_hand_recognition import RealTimeHandRecognition, RealTimeHandRecognitionOneShot, \
+    RemoteHandRecognition, RemoteHandRecognitionOneShot, FrozenHandRecognition, FrozenHandRecognitionOneShot
 from components.skeletonRecognition.skeleton_client import decode_content as decode_content_body
 from components.handRecognition.base_classifier import BaseClassifier
+from components.handRecognition.preprocess import HandPreprocessor
 import components.handRecognition.one_shot_classifier
-from components.fusion.conf.endpoints import connect
+from components.fusion.conf.endpoints import connect, connect_batched
+from components.fusion.conf.batch import BatchWriter
 from components.fusion.conf import streams
 from components.fusion.conf import decode
+from components.fusion.conf import metrics
+from components.fusion.conf import trace
+from components.fusion.conf import startup as startup_conf
+from components.fusion.conf.reader import FrameReader
 from components.handRecognition.blacklist import get_blacklist
+from components.inference import client as inference
 
 active_arm_threshold = 0.16
 pixel_intensity_threshold = 0.4
@@ -27,22 +34,9 @@ def decode_content_hand(raw_frame, offset):
     # right_hand_height (int) | right_hand_width (int)| left_hand_pos_x (float) | left_hand_pos_y (float) | ... |
     # left_hand_depth_data ([left_hand_width * left_hand_height]) |
     # right_hand_depth_data ([right_hand_width * right_hand_height])
+    The depth data is a read-only uint16 array viewing raw_frame, see decode.decode_content_depth()
     """
-    endianness = "<"
-
-    content_header_format = "iiff"  # width, height, posx, posy
-    content_header_size = struct.calcsize(endianness + content_header_format)
-    content_header = struct.unpack_from(endianness + content_header_format, raw_frame, offset)
-
-    width, height, posx, posy = content_header
-    # print(width, height, posx, posy)
-
-    depth_data_format = str(width * height) + "H"
-    depth_data = struct.unpack_from(endianness + depth_data_format, raw_frame, offset + content_header_size)
-
-    offset = offset + content_header_size + struct.calcsize(
-        endianness + depth_data_format)  # new offset from where tail starts
-    return (width, height, posx, posy, list(depth_data)), offset
+    return decode.decode_content_depth(raw_frame, offset)
 
 
 def parse_argument():
@@ -51,41 +45,40 @@ def parse_argument():
     parser.add_argument('--kinect-host', help='Host name of the machine running Kinect Server', default="localhost")
     parser.add_argument('--fusion-host', help='Host name of the machine running Fusion Server', default="localhost")
     parser.add_argument('--disable-one-shot', help='Disable one-shot learning mode', action='store_true', default=False)
+    parser.add_argument('--nn-search', choices=('forest', 'exact'), default=None,
+                        help='Nearest neighbor search of one-shot learning: the trees of the forest, or every sample')
+    parser.add_argument('--batched', help='Send both hands to fusion in a single write over one connection (BOTH only)',
+                        action='store_true', default=False)
+    metrics.add_arguments(parser)
+    trace.add_arguments(parser)
+    inference.add_arguments(parser)
+    startup_conf.add_arguments(parser)
 
     return parser.parse_args()
 
 
-def get_frame(kinect_socket):
-    return decode.read_frame(kinect_socket, decode_content_hand)
+def get_frame(kinect_reader):
+    return decode.read_frame(kinect_reader, decode_content_hand)
 
 
 def read_process_send(fusion_socket, classifier, gestures, stream_id, engaged, frame_pieces, timestamp, writer_data_hand, probs, classified, blind, frame):
     try:
-        bytes = classifier.get_bytes(timestamp, writer_data_hand, engaged, frame_pieces, gestures,
-                                     stream_id, probs, classified, blind, frame)
-
-        if fusion_socket is not None:
-            fusion_socket.sendall(struct.pack("<i", len(bytes)))
-            fusion_socket.sendall(bytes)
+        with trace.span("get_bytes", timestamp):
+            bytes = classifier.get_bytes(timestamp, writer_data_hand, engaged, frame_pieces, gestures,
+                                         stream_id, probs, classified, blind, frame)
+
+        with trace.span("send", timestamp):
+            if isinstance(fusion_socket, BatchWriter):
+                # Sent when the batch is flushed
+                fusion_socket.add(bytes)
+            elif fusion_socket is not None:
+                fusion_socket.sendall(bytes)
     except KeyboardInterrupt:
         return False
 
     return True
 
 
-def _preprocess_hand_arr(depth_data, posx, posy, height, width):
-    hand_arr = np.array(depth_data, dtype=np.float32).reshape((height, width))
-    posz = hand_arr[int(posx), int(posy)]
-    hand_arr -= posz
-    hand_arr /= 150
-    hand_arr = np.clip(hand_arr, -1, 1)
-    hand_arr = resize(hand_arr, (168, 168))
-    hand_arr = hand_arr[20:-20, 20:-20]
-    hand_arr = hand_arr.reshape((1, 128, 128, 1))
-
-    return hand_arr
-
-
 def is_gesture(hand, frame_pieces, posx, posy):
     """we don't want to process frames when user is not engaged or hands are resting (at/near spine base y or z)"""
 
@@ -118,33 +111,74 @@ def is_bright(depth_frame):
     return bright_corners >= 3
 
 
+def wait_forests(startup, classifiers):
+    """
+    Report when the forests of the one-shot classifiers are loaded, which the hands are not waiting for
+    """
+    for classifier in classifiers:
+        if isinstance(classifier, components.handRecognition.one_shot_classifier.OneShotClassifier):
+            startup.task(classifier.hand + " forest", classifier.wait_forest, required=False)
+
+
 def main(args):
-    start_time = time.time()
-    frame_count = 0  # To calculate the fps
+    metrics.from_arguments("depth_client_" + args.hand, args)
+    trace.from_arguments("depth_client_" + args.hand, args)
+    frames = metrics.counter("frames")
+    # From the end of reading a frame until the hands are sent
+    frame_time = metrics.histogram("frame_time_ns")
 
     blacklist = set()
 
     lock = threading.Lock()
 
+    inference_address, inference_shm = inference.from_arguments(args)
+
     if args.disable_one_shot:
         print('running base classifier')
-        HandModel = RealTimeHandRecognition
+        HandModels = RealTimeHandRecognition, RemoteHandRecognition, FrozenHandRecognition
         Classifier = BaseClassifier
     else:
         print('running one-shot classifier')
-        HandModel = RealTimeHandRecognitionOneShot
-        Classifier = components.handRecognition.one_shot_classifier.OneShotClassifier
+        HandModels = RealTimeHandRecognitionOneShot, RemoteHandRecognitionOneShot, FrozenHandRecognitionOneShot
+        Classifier = functools.partial(components.handRecognition.one_shot_classifier.OneShotClassifier,
+                                       nn_search=args.nn_search)
+
+    if inference_address is not None:
+        # The model is loaded once by the inference server
+        HandModel = functools.partial(HandModels[1], address=inference_address, shared_memory=inference_shm)
+    elif args.frozen is not None:
+        HandModel = functools.partial(HandModels[2], directory=args.frozen)
+    else:
+        HandModel = HandModels[0]
+
+    startup = startup_conf.from_arguments("depth_client_" + args.hand, args)
 
     if args.hand == "BOTH":
         print('tracking both hands')
-        RH_model = HandModel("RH", 32, 2)
+        model = startup.warm_up("warm-up", startup.task("model", HandModel, "RH", 32, 2), 2)
+        # Kinect streams the frames right away, so it is connected once they can be processed
+        kinect = startup.connect("kinect", connect, 'kinect', args.kinect_host, ("RH", "LH", "Body"), after=(model,))
+        if args.fusion_host is not None and args.batched:
+            # Both hands share a connection, and are sent together
+            RH_fusion = LH_fusion = startup.connect("fusion", connect_batched, args.fusion_host, ["LH", "RH"])
+        elif args.fusion_host is not None:
+            RH_fusion = startup.connect("fusion RH", connect, 'fusion', args.fusion_host, "RH")
+            LH_fusion = startup.connect("fusion LH", connect, 'fusion', args.fusion_host, "LH")
+        else:
+            RH_fusion = LH_fusion = None
+
         blacklist = get_blacklist()
         RH_classifier = Classifier("RH", lock, blacklist)
         LH_classifier = Classifier("LH", lock, blacklist, is_flipped=True)
+        wait_forests(startup, (RH_classifier, LH_classifier))
+        startup.wait()
 
-        kinect_socket = connect('kinect', args.kinect_host, ("RH", "LH", "Body"))
-        RH_fusion_socket = connect('fusion', args.fusion_host, "RH") if args.fusion_host is not None else None
-        LH_fusion_socket = connect('fusion', args.fusion_host, "LH") if args.fusion_host is not None else None
+        RH_model = model.result()
+        kinect_socket = kinect.result()
+        # Body, LH and RH frames are read before the hand crops are preprocessed, keep all three views valid
+        kinect_reader = FrameReader(kinect_socket, slots=3)
+        RH_fusion_socket = RH_fusion.result() if RH_fusion is not None else None
+        LH_fusion_socket = LH_fusion.result() if LH_fusion is not None else None
 
         RH_gestures = postures.right_hand_postures
         LH_gestures = postures.left_hand_postures
@@ -152,60 +186,82 @@ def main(args):
         RH_stream_id = streams.get_stream_id("RH")
         LH_stream_id = streams.get_stream_id("LH")
 
+        # LH is preprocessed into slot 0 and RH into slot 1
+        preprocessor = HandPreprocessor(batch_size=2)
+        # Passed to the classifiers for the blind hands, which are not classified
+        blind_frame = np.zeros((1, 128, 128, 1), dtype=np.float32)
+
         while True:
             RH_blind = False
             LH_blind = False
 
+            # Includes waiting for the frame
+            read_start = trace.now()
             _, (_, engaged, frame_pieces), _ = \
-                decode.read_frame(kinect_socket, decode_content_body)
+                decode.read_frame(kinect_reader, decode_content_body)
 
-            (LH_timestamp, LH_frame_type), (LH_width, LH_height, LH_posx, LH_posy, LH_depth_data), (LH_writer_data_hand,) = get_frame(kinect_socket)
-            (RH_timestamp, RH_frame_type), (RH_width, RH_height, RH_posx, RH_posy, RH_depth_data), (RH_writer_data_hand,) = get_frame(kinect_socket)
+            (LH_timestamp, LH_frame_type), (LH_width, LH_height, LH_posx, LH_posy, LH_depth_data), (LH_writer_data_hand,) = get_frame(kinect_reader)
+            (RH_timestamp, RH_frame_type), (RH_width, RH_height, RH_posx, RH_posy, RH_depth_data), (RH_writer_data_hand,) = get_frame(kinect_reader)
+            read_end = trace.now()
+            trace.record("read_frame", RH_timestamp, read_start, read_end)
 
+            preprocess_start = read_end
+            LH_hand = RH_hand = None
             if is_gesture("LH", frame_pieces, LH_posx, LH_posy):
-                if LH_blind:
-                    RH_model.past_probs_L = None  # reset smoothing
-                LH_frame = _preprocess_hand_arr(LH_depth_data, LH_posx, LH_posy, LH_height, LH_width)
+                LH_hand = (LH_depth_data, LH_posx, LH_posy, LH_height, LH_width)
+                LH_frame = preprocessor.frame(0)
             else:
-                LH_frame = np.empty((1,128,128,1))  # to facilitate forward pass
+                LH_frame = blind_frame
                 LH_blind = True
 
             if is_gesture("RH", frame_pieces, RH_posx, RH_posy):
-                if RH_blind:
-                    RH_model.past_probs_R = None  # reset smoothing
-                RH_frame = _preprocess_hand_arr(RH_depth_data, RH_posx, RH_posy, RH_height, RH_width)
+                RH_hand = (RH_depth_data, RH_posx, RH_posy, RH_height, RH_width)
+                RH_frame = preprocessor.frame(1)
             else:
-                RH_frame = np.empty((1,128,128,1))  # to facilitate forward pass
+                RH_frame = blind_frame
                 RH_blind = True
 
-            (LH_probs, LH_out), (RH_probs, RH_out) = RH_model.classifyLR(LH_frame, RH_frame)
+            preprocessor.process_batch((LH_hand, RH_hand))
+            trace.record("preprocess", RH_timestamp, preprocess_start)
+
+            with trace.span("inference", RH_timestamp):
+                # Only the active hands are classified, the smoothing of the blind hands is reset
+                (LH_probs, LH_out), (RH_probs, RH_out) = RH_model.classifyLR(preprocessor.output,
+                                                                             (not LH_blind, not RH_blind))
 
             if not read_process_send(LH_fusion_socket, LH_classifier, LH_gestures, LH_stream_id, engaged,
                                      frame_pieces, LH_timestamp, LH_writer_data_hand, LH_probs, LH_out, LH_blind, LH_frame) \
                     or not read_process_send(RH_fusion_socket, RH_classifier, RH_gestures, RH_stream_id, engaged,
                                              frame_pieces, RH_timestamp, RH_writer_data_hand, RH_probs, RH_out, RH_blind, RH_frame):
                 break
+            if isinstance(RH_fusion_socket, BatchWriter):
+                with trace.span("send", RH_timestamp):
+                    RH_fusion_socket.flush()
 
-            print()
-
-            frame_count += 1
-            if frame_count == 100:
-                print("\n", "=" * 100, "FPS", 100 / (time.time() - start_time))
-                start_time = time.time()
-                frame_count = 0
+            frames.inc()
+            frame_time.record(trace.now() - read_end)
 
         kinect_socket.close()
         if RH_fusion_socket is not None:
             RH_fusion_socket.close()
-        if LH_fusion_socket is not None:
+        if LH_fusion_socket is not None and LH_fusion_socket is not RH_fusion_socket:
             LH_fusion_socket.close()
     else:
         print('tracking single hand--', args.hand)
-        model = HandModel(args.hand, 32, 1)
+        model = startup.warm_up("warm-up", startup.task("model", HandModel, args.hand, 32, 1), 1)
+        kinect = startup.connect("kinect", connect, 'kinect', args.kinect_host, (args.hand, "Body"), after=(model,)) \
+            if args.kinect_host is not None else None
+        fusion = startup.connect("fusion", connect, 'fusion', args.fusion_host, args.hand) \
+            if args.fusion_host is not None else None
+
         classifier = Classifier(args.hand, lock, blacklist)
+        wait_forests(startup, (classifier,))
+        startup.wait()
 
-        kinect_socket = connect('kinect', args.kinect_host, (args.hand, "Body")) if args.kinect_host is not None else None
-        fusion_socket = connect('fusion', args.fusion_host, args.hand) if args.fusion_host is not None else None
+        model = model.result()
+        kinect_socket = kinect.result() if kinect is not None else None
+        kinect_reader = FrameReader(kinect_socket, slots=2)
+        fusion_socket = fusion.result() if fusion is not None else None
 
         if args.hand == "LH":
             gestures = postures.left_hand_postures
@@ -213,42 +269,49 @@ def main(args):
             gestures = postures.right_hand_postures
 
         stream_id = streams.get_stream_id(args.hand)
+        # The hand is preprocessed into its slot of classifyLR(), LH 0 and RH 1, the other hand is never classified
+        slot = 0 if args.hand == "LH" else 1
+        preprocessor = HandPreprocessor(batch_size=2)
+        hand_frame = preprocessor.frame(slot)
+        # Passed to the classifier when the hand is blind, and not classified
+        blind_frame = np.zeros((1, 128, 128, 1), dtype=np.float32)
 
         while True:
-            out = None
-            blind = False
-
+            # Includes waiting for the frame
+            read_start = trace.now()
             _, (_, engaged, frame_pieces), _ = \
-                decode.read_frame(kinect_socket, decode_content_body)
-
-            (timestamp, frame_type), (width, height, posx, posy, depth_data), (writer_data_hand,) = get_frame(kinect_socket)
+                decode.read_frame(kinect_reader, decode_content_body)
 
-            if is_gesture(args.hand, frame_pieces, posx, posy):
-                frame = _preprocess_hand_arr(depth_data, posx, posy, height, width)
-                model.past_probs = None
-            else:
-                blind = True
-                frame = np.empty((1,128,128,1))
+            (timestamp, frame_type), (width, height, posx, posy, depth_data), (writer_data_hand,) = get_frame(kinect_reader)
+            read_end = trace.now()
+            trace.record("read_frame", timestamp, read_start, read_end)
 
-            probs, out = model.classify(frame)
+            with trace.span("preprocess", timestamp):
+                blind = not is_gesture(args.hand, frame_pieces, posx, posy)
+                if blind:
+                    frame = blind_frame
+                else:
+                    preprocessor.process(slot, depth_data, posx, posy, height, width)
+                    frame = hand_frame
 
+            with trace.span("inference", timestamp):
+                # Only classified if active, the smoothing of a blind hand is reset
+                active = (slot == 0 and not blind, slot == 1 and not blind)
+                probs, out = model.classifyLR(preprocessor.output, active)[slot]
 
             if not read_process_send(fusion_socket, classifier, gestures, stream_id, engaged,
                                      frame_pieces, timestamp, writer_data_hand, probs, out, blind, frame):
                 break
 
-            print()
-
-            frame_count += 1
-            if frame_count == 100:
-                print("\n", "=" * 40, "FPS", 100 / (time.time() - start_time))
-                start_time = time.time()
-                frame_count = 0
+            frames.inc()
+            frame_time.record(trace.now() - read_end)
 
         kinect_socket.close()
         if fusion_socket is not None:
             fusion_socket.close()
 
+    trace.disable()
+
 
 if __name__ == "__main__":
     args = parse_argument()
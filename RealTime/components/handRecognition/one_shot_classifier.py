@@ -1,5 +1,6 @@
 import threading
 import queue
+import numpy as np
 import sys
 
 from .base_classifier import BaseClassifier
@@ -18,10 +19,12 @@ class ForestStatus:
 
 
 class EventVars:
-    __slots__ = ('load_forest_event', 'learn_no_action_event', 'learn_initialize_event', 'learn_complete_event')
+    __slots__ = ('load_forest_event', 'forest_loaded_event', 'learn_no_action_event', 'learn_initialize_event',
+                 'learn_complete_event')
 
     def __init__(self):
         self.load_forest_event = threading.Event()  # signals whether to reload a fresh copy of forest
+        self.forest_loaded_event = threading.Event()  # set once the forest is loaded for the first time
         self.learn_no_action_event = threading.Event()  # whether learning process exits due to no valid gestures
         self.learn_initialize_event = threading.Event()  # whether learning process is initiated
         self.learn_complete_event = threading.Event()  # whether learning process is finished
@@ -29,7 +32,10 @@ class EventVars:
 
 class OneShotClassifier(BaseClassifier):
 
-    def __init__(self, hand, lock, blacklist, is_flipped=False):
+    def __init__(self, hand, lock, blacklist, is_flipped=False, nn_search=None):
+        """
+        :param nn_search: the nearest neighbor search, 'forest' or 'exact', None for RandomForest.parameters.nn_search
+        """
         BaseClassifier.__init__(self, hand, lock, blacklist, is_flipped)
 
         self.global_lock = lock
@@ -40,26 +46,30 @@ class OneShotClassifier(BaseClassifier):
         self.taught_gesture_index = 36  # refers to 'taught gesture 1', increments after every new gesture is learned
 
         self.one_shot_worker = OneShotWorker(hand, self.forest_status, self.event_vars,
-                                             self.one_shot_queue, self.global_lock, blacklist, is_flipped, is_test=False)
+                                             self.one_shot_queue, self.global_lock, blacklist, is_flipped, is_test=False,
+                                             nn_search=nn_search)
         self.one_shot_worker.start()
         self.event_vars.load_forest_event.set()
         self.learning = False  # whether the system is learning gesture
 
+    def wait_forest(self, timeout=None):
+        """
+        Wait for the forest to be loaded for the first time; the hand is classified as blind until then
+        :return: True if the forest is loaded, False after timeout
+        """
+        return self.event_vars.forest_loaded_event.wait(timeout)
+
     def _process(self, feature, writer_data_hand, engaged, frame_pieces, probs, gestures, blind, frame):
 
         if not engaged:
             if not self.forest_status.is_fresh:
-                self.global_lock.acquire()
                 self.taught_gesture_index = 36
                 self.forest_status.is_ready = False
                 self.forest_status.is_fresh = True
                 self.event_vars.load_forest_event.set()
-                self.global_lock.release()
 
         if writer_data_hand == b'learn':
-            self.global_lock.acquire()
             self.forest_status.is_ready = False
-            self.global_lock.release()
             self.learning = True  # start learning mode
 
 
@@ -67,7 +77,8 @@ class OneShotClassifier(BaseClassifier):
             max_index = len(self.probs) - 1  # max_index refers to 'blind'
             self.probs[max_index] = 1
         else:
-            self.one_shot_queue.put((feature, frame_pieces, writer_data_hand == b'learn', probs, frame))
+            # The frame is a view of the preprocessing buffer, overwritten by the next frame
+            self.one_shot_queue.put((feature, frame_pieces, writer_data_hand == b'learn', probs, np.array(frame)))
             max_index, dist = self._find_label(feature, gestures, blind)
             self.probs[max_index] = dist
 
@@ -88,6 +99,8 @@ class OneShotClassifier(BaseClassifier):
             self.learning = False
             self.event_vars.learn_no_action_event.clear()
         if self.forest_status.is_ready and not blind:
+            # The worker replaces the forest rather than changing it, see OneShotWorker.learn(), so it is searched
+            # without a lock
             max_index, dist = self.one_shot_worker.forest.find_nn(feature)
             max_index = max_index[0]
             # feature vector has a dimension of 1024, so dist[0]/1023/2 is the probability
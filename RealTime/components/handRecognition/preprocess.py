@@ -0,0 +1,210 @@
+"""
+Preprocessing of the depth hand crops for the ResNet hand model.
+
+A crop is normalized around the depth of the hand joint, resized to 168x168 and the centre 128x128 is kept.
+The crop size depends on the distance to the Kinect, but the output geometry is fixed, so the bilinear
+interpolation of every output pixel only depends on the size of the crop. The source rows/columns and weights
+are computed once per crop size and cached, and only the 128x128 pixels that are kept are interpolated.
+
+The interpolation matches skimage.transform.resize(hand_arr, (168, 168)) with the defaults of scikit-image 0.14, as
+pinned in requirements.txt: bilinear, pixel centres aligned, no anti-aliasing, 'constant' edges (0 outside the crop) and
+the output clipped to the range of the crop. The edges are only reached by crops of 4 pixels or less.
+"""
+import functools
+import numpy as np
+
+resize_size = 168
+border = 20
+size = resize_size - 2 * border
+# Depth difference (mm) mapped to [-1, 1]
+depth_range = 150
+
+
+@functools.lru_cache(maxsize=128)
+def axis_weights(in_size, out_size=resize_size, start=border, stop=resize_size - border):
+    """
+    Bilinear interpolation of the output pixels [start, stop) of an axis resized from in_size to out_size
+    :param in_size: number of input pixels
+    :return: (indices, weights, outside): the indices of the 2 input pixels of each output pixel, concatenated,
+    the weight of the second one, and the positions in indices of the pixels outside of the input, which are 0,
+    None if there are none; the arrays are read-only as they are shared through the cache
+    """
+    coords = (np.arange(start, stop) + 0.5) * (in_size / out_size) - 0.5
+    low = np.floor(coords)
+    weights = (coords - low).astype(np.float32)
+
+    indices = np.concatenate((low, low + 1)).astype(np.intp)
+    # As the 'constant' mode of skimage, the pixels outside are 0, they are read from the edge then set to 0
+    outside = np.flatnonzero((indices < 0) | (indices >= in_size))
+    indices = np.clip(indices, 0, in_size - 1)
+    if outside.size == 0:
+        outside = None
+    else:
+        outside.flags.writeable = False
+
+    indices.flags.writeable = False
+    weights.flags.writeable = False
+    return indices, weights, outside
+
+
+class HandPreprocessor:
+    """
+    Preprocesses hand crops into a preallocated (batch_size, 128, 128, 1) float32 buffer.
+    The returned frames are views of the buffer, valid until the slot is preprocessed again.
+    """
+
+    def __init__(self, batch_size=2):
+        """
+        :param batch_size: number of hands preprocessed together
+        """
+        self.batch_size = batch_size
+        self.output = np.zeros((batch_size, size, size, 1), dtype=np.float32)
+        # The 2 source rows of every output row, reshaped to the width of the crop
+        self._rows = np.empty(2 * size * 512, dtype=np.float32)
+
+    def frame(self, slot):
+        """
+        :return: the (1, 128, 128, 1) frame of the slot
+        """
+        return self.output[slot:slot + 1]
+
+    def process(self, slot, depth_data, posx, posy, height, width):
+        """
+        Preprocesses a hand crop into a slot of the buffer
+        :param slot: index of the hand in the batch
+        :param depth_data: height * width depth values (mm), e.g. from decode.decode_content_depth()
+        :param posx: position of the hand joint in the crop, the first index of the depth of the hand
+        :param posy: position of the hand joint in the crop, the second index of the depth of the hand
+        :return: the (1, 128, 128, 1) frame of the slot
+        """
+        hand_arr = np.asarray(depth_data).reshape((height, width))
+        posz = np.float32(hand_arr[int(posx), int(posy)])
+        row_indices, row_weights, row_outside = axis_weights(height)
+        column_indices, column_weights, column_outside = axis_weights(width)
+
+        # Only the source rows are normalized; contiguous rows are cheaper to gather than columns
+        if self._rows.size < 2 * size * width:
+            self._rows = np.empty(2 * size * width, dtype=np.float32)
+        rows = self._rows[:2 * size * width].reshape((2 * size, width))
+        np.subtract(hand_arr[row_indices], posz, out=rows, dtype=np.float32)
+        rows /= depth_range
+        np.clip(rows, -1, 1, out=rows)
+        if row_outside is not None:
+            rows[row_outside] = 0
+
+        # low + (high - low) * weight, along the rows then the columns
+        low, high = rows[:size], rows[size:]
+        high -= low
+        high *= row_weights[:, None]
+        low += high
+
+        columns = low[:, column_indices]
+        if column_outside is not None:
+            columns[:, column_outside] = 0
+        low, high = columns[:, :size], columns[:, size:]
+        high -= low
+        high *= column_weights
+        frame = self.output[slot, :, :, 0]
+        np.add(low, high, out=frame)
+
+        if row_outside is not None or column_outside is not None:
+            # skimage clips to the range of the crop, which includes the 0 outside as the hand joint is 0
+            np.clip(frame, np.clip((np.float32(hand_arr.min()) - posz) / depth_range, -1, 1),
+                    np.clip((np.float32(hand_arr.max()) - posz) / depth_range, -1, 1), out=frame)
+
+        return self.frame(slot)
+
+    def process_batch(self, hands):
+        """
+        Preprocesses several hand crops in one call
+        :param hands: a (depth_data, posx, posy, height, width) tuple for each slot, None for the slots to skip
+        :return: the (batch_size, 128, 128, 1) buffer
+        """
+        for slot, hand in enumerate(hands):
+            if hand is not None:
+                self.process(slot, *hand)
+        return self.output
+
+
+_default = None
+
+
+def preprocess_hand(depth_data, posx, posy, height, width):
+    """
+    Preprocesses a single hand crop into a new array, for callers that keep the frame
+    :return: a (1, 128, 128, 1) float32 frame
+    """
+    global _default
+    if _default is None:
+        _default = HandPreprocessor(batch_size=1)
+    return _default.process(0, depth_data, posx, posy, height, width).copy()
+
+
+if __name__ == '__main__':
+    # Compares against the skimage resize, and benchmarks: python -m components.handRecognition.preprocess
+    import time
+    import warnings
+    import skimage
+    from skimage.transform import resize
+
+    def reference(depth_data, posx, posy, height, width, **kwargs):
+        # _preprocess_hand_arr() of depth_client before HandPreprocessor
+        hand_arr = np.array(depth_data, dtype=np.float32).reshape((height, width))
+        posz = hand_arr[int(posx), int(posy)]
+        hand_arr -= posz
+        hand_arr /= 150
+        np.clip(hand_arr, -1, 1, out=hand_arr)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            hand_arr = resize(hand_arr, (168, 168), **kwargs)
+        return hand_arr[20:-20, 20:-20].reshape((1, 128, 128, 1))
+
+    def crop(height, width, rng):
+        # A hand in front of a background, with sensor noise and holes
+        y, x = np.mgrid[:height, :width]
+        hand = ((y - height / 2) ** 2 + (x - width / 2) ** 2) < (min(height, width) / 3) ** 2
+        depth = np.where(hand, 900 + 40 * np.sin(x / 7.0), 1400) + rng.normal(0, 8, (height, width))
+        depth[rng.random_sample((height, width)) < 0.02] = 0
+        depth = depth.astype(np.uint16).ravel()
+        depth.flags.writeable = False  # as decoded from the frame
+        return depth, height // 2, width // 2, height, width
+
+    rng = np.random.RandomState(0)
+    preprocessor = HandPreprocessor()
+    # With the pinned scikit-image 0.14, the resize call of depth_client as is, otherwise the defaults of 0.14
+    pinned = skimage.__version__.startswith("0.14")
+    defaults = {} if pinned else dict(order=1, mode='constant', cval=0, clip=True, anti_aliasing=False)
+    sizes = [(1, 1), (2, 3), (4, 90), (5, 5), (57, 57), (100, 120), (168, 168), (230, 230), (231, 229), (400, 380)]
+
+    max_error = 0
+    for height, width in sizes:
+        hand = crop(height, width, rng)
+        for slot in range(preprocessor.batch_size):
+            error = np.abs(preprocessor.process(slot, *hand) - reference(*hand, **defaults)).max()
+            assert np.array_equal(preprocess_hand(*hand), preprocessor.frame(slot))
+            max_error = max(max_error, error)
+    assert max_error < 1e-5, max_error
+    print("max error {:.2e} against skimage {} resize{}".format(
+        max_error, skimage.__version__, "" if pinned else " with the defaults of 0.14 {}".format(defaults)))
+
+    if not pinned:
+        hand = crop(230, 230, rng)
+        error = np.abs(preprocessor.process(0, *hand) - reference(*hand)).max()
+        print("max error {:.2e} against the skimage {} defaults (anti-aliasing when downsampling)"
+              .format(error, skimage.__version__))
+
+    def benchmark(name, process, n):
+        process()
+        start = time.perf_counter()
+        for _ in range(n):
+            process()
+        elapsed = (time.perf_counter() - start) / n
+        print("{:<36}{:>10.1f} us".format(name, elapsed * 1e6))
+        return elapsed
+
+    for height, width in [(100, 100), (230, 230)]:
+        LH, RH = crop(height, width, rng), crop(height, width, rng)
+        print("LH + RH, {}x{} crops".format(height, width))
+        before = benchmark("  skimage resize", lambda: (reference(*LH), reference(*RH)), 200)
+        after = benchmark("  HandPreprocessor.process_batch", lambda: preprocessor.process_batch((LH, RH)), 2000)
+        print("  speedup {:.1f}x".format(before / after))
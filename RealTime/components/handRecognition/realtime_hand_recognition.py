@@ -1,15 +1,26 @@
 import os
+from collections import namedtuple
 
-import tensorflow as tf
 import numpy as np
 
-from . import hands_resnet_model
+from components.inference.client import InferenceClient
+from components.inference.frozen import FrozenModel
 
 
 class RealTimeHandRecognition:
-    def __init__(self, hands, gestures, batch_size):
+    def __init__(self, hands, gestures, batch_size, config=None):
+        """
+        :param hands: name of the model directory in ./models
+        :param gestures: number of gestures the model was trained with
+        :param batch_size: largest number of frames classified together; the graph accepts any batch size,
+        so that only the active hands are classified
+        :param config: tf.ConfigProto of the session, None for the default of a recognizer process
+        """
+        # Only loaded by the processes running the model, see RemoteHandRecognition
+        import tensorflow as tf
+        from . import hands_resnet_model
 
-        hps = hands_resnet_model.HParams(batch_size=batch_size,
+        hps = hands_resnet_model.HParams(batch_size=None,
                                          num_classes=gestures,
                                          min_lrn_rate=0.0001,
                                          lrn_rate=0.1,
@@ -23,10 +34,12 @@ class RealTimeHandRecognition:
         model.build_graph()
         saver = tf.train.Saver()
 
-        gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.4)
-        self.config = tf.ConfigProto(gpu_options=gpu_options)
-        self.config.gpu_options.allow_growth = True
-        self.config.allow_soft_placement = True
+        if config is None:
+            gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.4)
+            config = tf.ConfigProto(gpu_options=gpu_options)
+            config.gpu_options.allow_growth = True
+            config.allow_soft_placement = True
+        self.config = config
 
         sess = tf.Session(config=self.config)
         tf.train.start_queue_runners(sess)
@@ -43,12 +56,51 @@ class RealTimeHandRecognition:
         self.past_probs_L = None
         self.past_probs_R = None
 
+        # Returned for the hands that are not classified
+        self.blind_probs = _blind(gestures)
+        self.blind_feature = _blind(model.fc_x.get_shape().as_list()[1])
+
+    def run(self, fetches, data):
+        """
+        Runs the model on a batch of frames
+        :param fetches: graph elements to evaluate, as for Session.run()
+        :param data: (n, 128, 128, 1) frames
+        :return: the evaluated fetches
+        """
+        return self.sess.run(fetches, feed_dict={self.model._images: data})
+
+    def _run_active(self, fetches, data, active):
+        """
+        Runs the model on the active frames of the batch only
+        :param fetches: graph elements to evaluate, as for Session.run()
+        :param data: (n, 128, 128, 1) frames, e.g. HandPreprocessor.output
+        :param active: whether each frame is classified
+        :return: the evaluated fetches for each frame, None for the inactive frames
+        """
+        indices = [i for i, is_active in enumerate(active) if is_active]
+        if not indices:
+            return [None] * len(active)
+
+        # Consecutive frames are fed as a view, without a copy
+        if indices[-1] - indices[0] == len(indices) - 1:
+            batch = data[indices[0]:indices[-1] + 1]
+        else:
+            batch = data[indices]
+        values = self.run(fetches, batch)
+
+        results = [None] * len(active)
+        for row, i in enumerate(indices):
+            if isinstance(fetches, list):
+                results[i] = [value[row] for value in values]
+            else:
+                results[i] = values[row]
+        return results
+
     def classify(self, data, flip):
         if flip:
             data = np.flipud(data)
-        (predictions) = self.sess.run(self.model.predictions, feed_dict={self.model._images: data})
+        (predictions) = self.run(self.model.predictions, data)
         probs = predictions[0]
-        print('SHAPE', predictions.shape)
 
         if self.past_probs is None:
             self.past_probs = probs
@@ -58,59 +110,169 @@ class RealTimeHandRecognition:
         max_prediction = np.argmax(self.past_probs)
         return self.past_probs, max_prediction
 
-    def classifyLR(self, data_L, data_R):
-        input_shape = list(data_L.shape)
-        input_shape[0] = 2
-        input = np.empty(input_shape)
-        input[0] = np.flipud(data_L)
-        input[1] = data_R
-        (predictions) = self.sess.run(self.model.predictions, feed_dict={self.model._images: input})
-        LH_probs = predictions[0]
-        RH_probs = predictions[1]
-
-        if self.past_probs_L is None:
-            self.past_probs_L = LH_probs
-        else:
-            self.past_probs_L = (self.past_probs_L + LH_probs) / 2
+    def classifyLR(self, data, active=(True, True)):
+        """
+        Classifies both hands, skipping the blind ones
+        :param data: (2, 128, 128, 1) frames, LH first
+        :param active: whether LH and RH are classified
+        :return: (smoothed probs, max_prediction) for LH and RH, as classify(); (blind_probs, None) for a blind hand,
+        whose smoothing is reset
+        """
+        LH_probs, RH_probs = self._run_active(self.model.predictions, data, active)
 
-        max_prediction_LH = np.argmax(self.past_probs_L)
+        if LH_probs is None:
+            self.past_probs_L = None
+            LH_result = (self.blind_probs, None)
+        else:
+            if self.past_probs_L is None:
+                self.past_probs_L = LH_probs
+            else:
+                self.past_probs_L = (self.past_probs_L + LH_probs) / 2
+            LH_result = (self.past_probs_L, np.argmax(self.past_probs_L))
 
-        if self.past_probs_R is None:
-            self.past_probs_R = RH_probs
+        if RH_probs is None:
+            self.past_probs_R = None
+            RH_result = (self.blind_probs, None)
         else:
-            self.past_probs_R = (self.past_probs_R+RH_probs)/2
+            if self.past_probs_R is None:
+                self.past_probs_R = RH_probs
+            else:
+                self.past_probs_R = (self.past_probs_R+RH_probs)/2
+            RH_result = (self.past_probs_R, np.argmax(self.past_probs_R))
 
-        max_prediction_RH = np.argmax(self.past_probs_R)
+        return LH_result, RH_result
 
-        return (max_prediction_LH, self.past_probs_L), (max_prediction_RH, self.past_probs_R)
+
+    def warm_up(self, batch_size):
+        """
+        Runs the model on blank frames, as classifyLR() will, for the first frame not to pay for the initialization
+        of the graph; the smoothing is then reset
+        :param batch_size: largest number of frames classified together
+        """
+        frames = np.zeros((2, 128, 128, 1), dtype=np.float32)
+        if batch_size > 1:
+            # Both hands, then a single one
+            self.classifyLR(frames)
+        self.classifyLR(frames, (False, True))
+        self.past_probs = None
+        self.past_probs_L = None
+        self.past_probs_R = None
 
 
 class RealTimeHandRecognitionOneShot(RealTimeHandRecognition):
     """
     Overloaded class specific for one-shot learning. Only generate feature vectors.
     """
-    def __init__(self, hands, gestures, batch_size):
-        RealTimeHandRecognition.__init__(self, hands, gestures, batch_size)
+    def __init__(self, hands, gestures, batch_size, config=None):
+        RealTimeHandRecognition.__init__(self, hands, gestures, batch_size, config)
 
     def classify(self, data, flip=False):
         if flip:
             data = np.flipud(data)
-        (feature, predictions) = self.sess.run([self.model.fc_x, self.model.predictions], feed_dict={self.model._images: data})
+        (feature, predictions) = self.run([self.model.fc_x, self.model.predictions], data)
 
         return predictions, feature
 
-    def classifyLR(self, data_L, data_R):
-        input_shape = list(data_L.shape)
-        input_shape[0] = 2
-        input = np.empty(input_shape)
-        input[0] = np.flipud(data_L)
-        input[1] = data_R
-        (features, predictions) = self.sess.run([self.model.fc_x, self.model.predictions], feed_dict={self.model._images: input})
-        LH_feature = features[0]
-        LH_probs = predictions[0]
-        RH_feature = features[1]
-        RH_probs = predictions[1]
+    def classifyLR(self, data, active=(True, True)):
+        """
+        Classifies both hands, skipping the blind ones
+        :param data: (2, 128, 128, 1) frames, LH first
+        :param active: whether LH and RH are classified
+        :return: (probs, feature) for LH and RH; (blind_probs, blind_feature) for a blind hand
+        """
+        results = self._run_active([self.model.fc_x, self.model.predictions], data, active)
+
+        hands = []
+        for result in results:
+            if result is None:
+                hands.append((self.blind_probs, self.blind_feature))
+            else:
+                feature, probs = result
+                hands.append((probs, feature))
+        return tuple(hands)
+
+
+def _blind(size):
+    blind = np.zeros(size, dtype=np.float32)
+    blind.flags.writeable = False
+    return blind
+
+
+# Names of the outputs of the inference server or of the frozen model, in place of the graph elements
+RemoteOutputs = namedtuple('RemoteOutputs', 'predictions,fc_x')
+
+
+class RemoteHandRecognition(RealTimeHandRecognition):
+    """
+    Classifies the hands with the model loaded by the inference server, see components.inference.server
+    """
+    def __init__(self, hands, gestures, batch_size, address=None, shared_memory=False):
+        """
+        :param hands: name of the model directory in ./models, the server serves it as hands_<hands>
+        :param gestures: number of gestures the model was trained with
+        :param batch_size: largest number of frames classified together
+        :param address: address of the inference server, see InferenceClient
+        :param shared_memory: True to send the frames over shared memory
+        """
+        self.client = InferenceClient("hands_" + hands, address, shared_memory)
+        outputs = dict(self.client.info.outputs)
+        if outputs["predictions"] != (gestures,):
+            raise ValueError("hands_{} has {} gestures, expected {}".format(hands, outputs["predictions"][0], gestures))
+        self.model = RemoteOutputs("predictions", "feature")
+
+        self.past_probs = None
+        self.past_probs_L = None
+        self.past_probs_R = None
+
+        self.blind_probs = _blind(gestures)
+        self.blind_feature = _blind(outputs["feature"])
 
-        return (LH_probs, LH_feature), (RH_probs, RH_feature)
+    def run(self, fetches, data):
+        outputs, _ = self.client.run(data)
+        if isinstance(fetches, list):
+            return [outputs[name] for name in fetches]
+        return outputs[fetches]
 
 
+class RemoteHandRecognitionOneShot(RemoteHandRecognition, RealTimeHandRecognitionOneShot):
+    """
+    RealTimeHandRecognitionOneShot with the model loaded by the inference server
+    """
+    pass
+
+
+class FrozenHandRecognition(RealTimeHandRecognition):
+    """
+    Classifies the hands with the frozen model exported by components.inference.export, which neither builds the
+    training graph nor restores the checkpoint
+    """
+    def __init__(self, hands, gestures, batch_size, directory=None, config=None):
+        """
+        :param hands: name of the model directory in ./models, exported as hands_<hands>
+        :param gestures: number of gestures the model was trained with
+        :param batch_size: largest number of frames classified together
+        :param directory: directory of the frozen models, see FrozenModel
+        :param config: tf.ConfigProto of the session, see FrozenModel
+        """
+        self.frozen = FrozenModel("hands_" + hands, directory, config)
+        if self.frozen.output_shape("predictions") != (gestures,):
+            raise ValueError("hands_{} has {} gestures, expected {}".format(
+                hands, self.frozen.output_shape("predictions")[0], gestures))
+        self.model = RemoteOutputs("predictions", "feature")
+
+        self.past_probs = None
+        self.past_probs_L = None
+        self.past_probs_R = None
+
+        self.blind_probs = _blind(gestures)
+        self.blind_feature = _blind(self.frozen.output_shape("feature"))
+
+    def run(self, fetches, data):
+        return self.frozen.run(fetches, {"images": data})
+
+
+class FrozenHandRecognitionOneShot(FrozenHandRecognition, RealTimeHandRecognitionOneShot):
+    """
+    RealTimeHandRecognitionOneShot with the frozen model
+    """
+    pass
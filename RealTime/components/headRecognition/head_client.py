@@ -7,10 +7,15 @@ import argparse
 import numpy as np
 from collections import deque
 from skimage.transform import resize
-from .realtime_head_recognition import RealTimeHeadRecognition
+from .realtime_head_recognition import RealTimeHeadRecognition, RemoteHeadRecognition, FrozenHeadRecognition
 from ..fusion.conf.endpoints import connect
 from ..fusion.conf import streams
+from ..fusion.conf import codecs
 from ..fusion.conf import decode
+from ..fusion.conf import metrics
+from ..fusion.conf import startup as startup_conf
+from ..fusion.conf.reader import FrameReader
+from ..inference import client as inference
 
 # Timestamp | frame type | width | height | depth_data
 
@@ -18,21 +23,9 @@ def decode_content(raw_frame, offset):
     """
     raw_frame: frame starting from 4 to end (4 for length field)
     offset: index where header ends; header is header_l, timestamp, frame_type
+    The depth data is a read-only uint16 array viewing raw_frame, see decode.decode_content_depth()
     """
-    endianness = "<"
-
-    content_header_format = "iiff"  # width, height, posx, posy
-    content_header_size = struct.calcsize(endianness + content_header_format)
-    content_header = struct.unpack_from(endianness + content_header_format, raw_frame, offset)
-
-    width, height, posx, posy = content_header
-    #print(width, height, posx, posy)
-
-    depth_data_format = str(width * height) + "H"
-    depth_data = struct.unpack_from(endianness + depth_data_format, raw_frame, offset + content_header_size)
-    
-    offset = offset + content_header_size + struct.calcsize(endianness + depth_data_format)  # new offset from where tail starts
-    return (width, height, posx, posy, list(depth_data)), offset
+    return decode.decode_content_depth(raw_frame, offset)
     
 
 if __name__ == '__main__':
@@ -40,23 +33,44 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--kinect_host', help='Host name of the machine running Kinect Server', default='127.0.0.1')
     parser.add_argument('--fusion-host', help='Host name of the machine running Kinect Server', default='127.0.0.1')
+    metrics.add_arguments(parser)
+    inference.add_arguments(parser)
+    startup_conf.add_arguments(parser)
 
     args = parser.parse_args()
+    metrics.from_arguments("head_client", args)
 
     stream_id = streams.get_stream_id("Head")
+    head_encoder = codecs.get_codec_by_name("Head").encoder()
 
     gesture_list = ["nod", "shake", "other"]
     num_gestures = len(gesture_list)
 
-    head_classifier = RealTimeHeadRecognition(num_gestures)
+    startup = startup_conf.from_arguments("head_client", args)
+    inference_address, inference_shm = inference.from_arguments(args)
+    if inference_address is not None:
+        model = startup.task("model", RemoteHeadRecognition, num_gestures, inference_address, inference_shm)
+    elif args.frozen is not None:
+        model = startup.task("model", FrozenHeadRecognition, num_gestures, args.frozen)
+    else:
+        model = startup.task("model", RealTimeHeadRecognition, num_gestures)
+    model = startup.warm_up("warm-up", model)
+    # Kinect streams the frames right away, so it is connected once they can be processed
+    kinect = startup.connect("kinect", connect, 'kinect', args.kinect_host, 'Head', after=(model,))
+    fusion = startup.connect("fusion", connect, 'fusion', args.fusion_host, 'Head') \
+        if args.fusion_host is not None else None
+    startup.wait()
+    head_classifier = model.result()
 
     gesture_list += ['blind']
 
-    kinect_socket = connect('kinect', args.kinect_host, 'Head')
+    kinect_socket = kinect.result()
     if kinect_socket is None:
         sys.exit(0)
 
-    fusion_socket = connect('fusion', args.fusion_host, 'Head') if args.fusion_host is not None else None
+    kinect_reader = FrameReader(kinect_socket)
+
+    fusion_socket = fusion.result() if fusion is not None else None
 
 
     i = 0
@@ -65,7 +79,10 @@ if __name__ == '__main__':
 
 
     index = 0
-    start_time = time.time()
+    frames = metrics.counter("frames")
+    # Printed by the metrics reporter rather than for every frame
+    head_gesture = metrics.gauge("head_gesture")
+    head_movement_gauge = metrics.gauge("head_movement")
     window = deque(maxlen=30)
     euclidean_skeleton = deque(maxlen=29)
     prev_skeleton = None
@@ -73,13 +90,13 @@ if __name__ == '__main__':
     while True:
         try:
             t_begin = time.time()
-            (timestamp, frame_type), (width, height, posx, posy, depth_data), (writer_data,) = decode.read_frame(kinect_socket, decode_content)
+            (timestamp, frame_type), (width, height, posx, posy, depth_data), (writer_data,) = decode.read_frame(kinect_reader, decode_content)
             t_end = time.time()
         except:
             break
         #print "Time taken for this frame: {}".format(t_end - t_begin)
         avg_frame_time += (t_end - t_begin)
-        print(timestamp, frame_type, width, height, end=' ')
+        frames.inc()
 
         curr_skeleton = np.array([posx, posy])
 
@@ -88,7 +105,7 @@ if __name__ == '__main__':
             posz = head[int(posx), int(posy)]
             head -= posz
             head /= 150
-            head = np.clip(head, -1, 1)
+            np.clip(head, -1, 1, out=head)
             head = resize(head, (168, 168))
             head = head[20:-20, 20:-20]
             head += 1
@@ -111,29 +128,26 @@ if __name__ == '__main__':
                 gesture_index, probs = head_classifier.classify(new_window)
                 head_movement = np.sum(euclidean_skeleton)
                 probs = list(probs)+[0]
-                print(gesture_list[gesture_index], probs[gesture_index], head_movement, end=' ')
+                head_movement_gauge.set(float(head_movement))
 
                 if head_movement>13: #0.03
                     gesture_index = 2
                     probs = [0,0,1,0]
-                    print(gesture_list[gesture_index], end=' ')
-                print("\n")
+                head_gesture.set(gesture_list[gesture_index])
 
                 pack_list = [stream_id, timestamp, gesture_index] + list(probs)
 
-                raw_data = struct.pack("<iqi" + "f" * (num_gestures+1), *pack_list)
+                raw_data = head_encoder.encode(*pack_list)
 
                 if fusion_socket is not None:
-                    fusion_socket.sendall(struct.pack("<i", len(raw_data)))
                     fusion_socket.sendall(raw_data)
 
             else:
                 pack_list = [stream_id, timestamp, num_gestures] + [0] * num_gestures + [1]
-                print('Buffer not full')
-                raw_data = struct.pack("<iqi" + "f" * (num_gestures + 1), *pack_list)
+                head_gesture.set('buffering')
+                raw_data = head_encoder.encode(*pack_list)
 
                 if fusion_socket is not None:
-                    fusion_socket.sendall(struct.pack("<i", len(raw_data)))
                     fusion_socket.sendall(raw_data)
 
 
@@ -141,17 +155,12 @@ if __name__ == '__main__':
 
         else:
             pack_list = [stream_id, timestamp, num_gestures] + [0] * num_gestures + [1]
-            print('blind')
-            raw_data = struct.pack("<iqi" + "f" * (num_gestures + 1), *pack_list)
+            head_gesture.set('blind')
+            raw_data = head_encoder.encode(*pack_list)
 
             if fusion_socket is not None:
-                fusion_socket.sendall(struct.pack("<i", len(raw_data)))
                 fusion_socket.sendall(raw_data)
 
-        if index % 100==0:
-            print("="*100, "FPS", 100/(time.time()-start_time))
-            start_time = time.time()
-
     kinect_socket.close()
     if fusion_socket is not None:
         fusion_socket.close()
@@ -1,12 +1,23 @@
-from . import resnet_model_half_weights
-import tensorflow as tf
+from collections import namedtuple
+
 import numpy as np
 
+from components.inference.client import InferenceClient
+from components.inference.frozen import FrozenModel
+
 
 class RealTimeHeadRecognition():
-    def __init__(self, gestures):
+    def __init__(self, gestures, config=None):
+        """
+        :param gestures: number of gestures the model was trained with
+        :param config: tf.ConfigProto of the session, None for the default of a recognizer process
+        """
+        # Only loaded by the processes running the model, see RemoteHeadRecognition
+        import tensorflow as tf
+        from . import resnet_model_half_weights
 
-        hps = resnet_model_half_weights.HParams(batch_size=1,
+        # Any batch size, for the inference server
+        hps = resnet_model_half_weights.HParams(batch_size=None,
                                                 num_classes=gestures,
                                                 min_lrn_rate=0.0001,
                                                 lrn_rate=0.1,
@@ -20,10 +31,12 @@ class RealTimeHeadRecognition():
         model.build_graph()
         saver = tf.train.Saver()
 
-        gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.3)
-        self.config = tf.ConfigProto(gpu_options=gpu_options)
-        self.config.gpu_options.allow_growth = True
-        self.config.allow_soft_placement = True
+        if config is None:
+            gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.3)
+            config = tf.ConfigProto(gpu_options=gpu_options)
+            config.gpu_options.allow_growth = True
+            config.allow_soft_placement = True
+        self.config = config
 
         sess = tf.Session(config=self.config)
         tf.train.start_queue_runners(sess)
@@ -38,8 +51,17 @@ class RealTimeHeadRecognition():
 
         self.past_probs = None
 
+    def run(self, fetches, data):
+        """
+        Runs the model on a batch of windows
+        :param fetches: graph elements to evaluate, as for Session.run()
+        :param data: (n, 128, 128, 30) windows of frame differences
+        :return: the evaluated fetches
+        """
+        return self.sess.run(fetches, feed_dict={self.model._images: data})
+
     def classify(self, data):
-        (predictions) = self.sess.run([self.model.predictions], feed_dict={self.model._images: data})
+        (predictions) = self.run([self.model.predictions], data)
         probs = predictions[0][0]
 
         if self.past_probs is None:
@@ -56,3 +78,61 @@ class RealTimeHeadRecognition():
 
         return max_prediction, self.past_probs
 
+    def warm_up(self):
+        """
+        Runs the model on a blank window, for the first frame not to pay for the initialization of the graph; the
+        smoothing is then reset
+        """
+        self.classify(np.zeros((1, 128, 128, 30), dtype=np.float32))
+        self.past_probs = None
+
+
+
+# Names of the outputs of the inference server or of the frozen model, in place of the graph elements
+RemoteOutputs = namedtuple('RemoteOutputs', 'predictions')
+
+
+class RemoteHeadRecognition(RealTimeHeadRecognition):
+    """
+    Classifies the head with the model loaded by the inference server, see components.inference.server
+    """
+    def __init__(self, gestures, address=None, shared_memory=False):
+        """
+        :param gestures: number of gestures the model was trained with
+        :param address: address of the inference server, see InferenceClient
+        :param shared_memory: True to send the windows over shared memory
+        """
+        self.client = InferenceClient("head", address, shared_memory)
+        outputs = dict(self.client.info.outputs)
+        if outputs["predictions"] != (gestures,):
+            raise ValueError("head has {} gestures, expected {}".format(outputs["predictions"][0], gestures))
+        self.model = RemoteOutputs("predictions")
+
+        self.past_probs = None
+
+    def run(self, fetches, data):
+        outputs, _ = self.client.run(data)
+        return [outputs[name] for name in fetches]
+
+
+class FrozenHeadRecognition(RealTimeHeadRecognition):
+    """
+    Classifies the head with the frozen model exported by components.inference.export, which neither builds the
+    training graph nor restores the checkpoint
+    """
+    def __init__(self, gestures, directory=None, config=None):
+        """
+        :param gestures: number of gestures the model was trained with
+        :param directory: directory of the frozen models, see FrozenModel
+        :param config: tf.ConfigProto of the session, see FrozenModel
+        """
+        self.frozen = FrozenModel("head", directory, config)
+        if self.frozen.output_shape("predictions") != (gestures,):
+            raise ValueError("head has {} gestures, expected {}".format(self.frozen.output_shape("predictions")[0],
+                                                                       gestures))
+        self.model = RemoteOutputs("predictions")
+
+        self.past_probs = None
+
+    def run(self, fetches, data):
+        return self.frozen.run(fetches, {"images": data})
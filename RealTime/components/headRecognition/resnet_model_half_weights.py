@@ -277,7 +277,8 @@ class ResNet(object):
 
     def _fully_connected(self, x, out_dim):
         """FullyConnected layer for final output."""
-        x = tf.reshape(x, [self.hps.batch_size, -1])
+        # The batch size may be None, for a variable batch
+        x = tf.reshape(x, [-1, int(np.prod(x.get_shape().as_list()[1:]))])
         w = tf.get_variable(
             'DW', [x.get_shape()[1], out_dim],
             initializer=tf.uniform_unit_scaling_initializer(factor=1.0))
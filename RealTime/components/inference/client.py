@@ -0,0 +1,314 @@
+"""
+Client of the inference server, see components.inference.server
+"""
+import os
+import select
+import socket
+import tempfile
+import time
+
+import numpy as np
+
+from ..fusion.conf import endpoints
+from ..fusion.conf import metrics
+from ..fusion.conf import shm
+from ..fusion.conf import trace
+from . import frozen
+from . import protocol
+from .protocol import request_header, response_fields
+
+# Where the server listens by default, None where Unix sockets are not available
+default_unix_path = os.path.join(tempfile.gettempdir(), "realtime_inference.sock") if hasattr(socket, 'AF_UNIX') \
+    else None
+
+
+def add_arguments(parser):
+    parser.add_argument('--inference', default=None,
+                        help='Address of the inference server running the models: path of its Unix socket, or '
+                             'host[:port]; "default" for {}. By default the models are loaded in this process'
+                        .format(default_unix_path or "localhost"))
+    parser.add_argument('--inference-shm', action='store_true', default=False,
+                        help='Send the requests to the inference server over shared memory')
+    parser.add_argument('--frozen', nargs='?', default=None, const=frozen.default_directory,
+                        help='Load the frozen models exported by components.inference.export in this process, from '
+                             'this directory or {}, rather than the checkpoints'.format(frozen.default_directory))
+
+
+def from_arguments(args):
+    """
+    :return: (address, shared memory) of the inference server, address is None to load the models in this process
+    """
+    address = args.inference
+    if address == "default":
+        address = default_unix_path or "localhost"
+    return address, args.inference_shm
+
+
+def connect(address=None):
+    """
+    :param address: path of the Unix socket of the server, or host[:port] for TCP, None for the default
+    :return: connected socket
+    """
+    if address is None:
+        address = default_unix_path or "localhost"
+
+    if hasattr(socket, 'AF_UNIX') and (os.sep in address or '/' in address):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+        return sock
+
+    host, _, port = address.partition(':')
+    sock = socket.create_connection((host, int(port) if port else endpoints.get_port('inference')))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+class InferenceClient:
+    """
+    Runs a model loaded by the inference server. Requests are synchronous, one at a time.
+    """
+
+    def __init__(self, model, address=None, shared_memory=False):
+        """
+        :param model: name of the model, see models.loaders
+        :param address: address of the server, see connect()
+        :param shared_memory: True to send the requests and receive the responses over shared memory, when the server
+        is on the same machine
+        """
+        if shared_memory and not shm.is_available():
+            print("Shared memory needs Python 3.8 or later, sending the requests for {} over the socket".format(model))
+            shared_memory = False
+        self.sock = connect(address)
+        self.sock.settimeout(10)
+        name = model.encode('ascii')
+        self.sock.sendall(protocol.registration.pack(protocol.registration.size - protocol.size_field.size + len(name),
+                                                     protocol.SHARED_MEMORY if shared_memory else 0) + name)
+        try:
+            self.info = protocol.decode_info(protocol.recv_message(self.sock))
+        except (OSError, EOFError, ValueError):
+            self.sock.close()
+            raise
+        self.sock.settimeout(None)
+
+        self._writer = self._reader = None
+        if self.info.rings is not None:
+            request_ring, response_ring = self.info.rings
+            self._reader = shm.RingReader(shm.Ring.attach(response_ring))
+            # The socket is non-blocking from then on, it only carries notifications
+            self._writer = shm.RingWriter(self.sock, shm.Ring.attach(request_ring))
+
+        self._sample_size = protocol.sample_size(self.info.input_shape)
+        self._request = bytearray(request_header.size + self.info.max_batch * self._sample_size * 4)
+        self._request_id = 0
+        self._round_trip = metrics.histogram("inference_round_trip_ns", model=model)
+        print("Connected to the inference server for {}{}".format(model, " over shared memory"
+                                                                   if self._writer is not None else ""))
+
+    def run(self, batch):
+        """
+        Run the model
+        :param batch: (n, *input_shape) samples, split in requests of at most max_batch samples
+        :return: (outputs, Latency): an (n, *shape) float32 array for each output, by name, and the time spent
+        """
+        batch = np.asarray(batch, dtype=np.float32)
+        if batch.shape[1:] != self.info.input_shape:
+            raise ValueError("Expected samples of shape {} for {}, got {}".format(self.info.input_shape, self.info.name,
+                                                                                  batch.shape[1:]))
+        max_batch = self.info.max_batch
+        if len(batch) <= max_batch:
+            return self._run(batch)
+
+        results = [self._run(batch[start:start + max_batch]) for start in range(0, len(batch), max_batch)]
+        outputs = {name: np.concatenate([result[0][name] for result in results]) for name, _ in self.info.outputs}
+        latencies = [result[1] for result in results]
+        return outputs, protocol.Latency(sum(latency.queued_ns for latency in latencies),
+                                         sum(latency.run_ns for latency in latencies),
+                                         max(latency.batch_size for latency in latencies),
+                                         sum(latency.round_trip_ns for latency in latencies))
+
+    def _run(self, batch):
+        count = len(batch)
+        size = request_header.size + count * self._sample_size * 4
+        self._request_id = (self._request_id + 1) & 0xffffffff
+        request_header.pack_into(self._request, 0, size - protocol.size_field.size, self._request_id, count)
+        np.frombuffer(self._request, np.float32, count * self._sample_size, request_header.size)[:] = batch.ravel()
+
+        start = trace.now()
+        request = memoryview(self._request)[:size]
+        if self._writer is not None:
+            self._writer.sendall(request)
+            response = self._receive_ring()
+        else:
+            self.sock.sendall(request)
+            response = self._decode(protocol.recv_message(self.sock), False)
+        round_trip = trace.now() - start
+        self._round_trip.record(round_trip)
+
+        outputs, (queued, run, batch_size) = response
+        return outputs, protocol.Latency(queued, run, batch_size, round_trip)
+
+    def _decode(self, message, copy):
+        """
+        :param message: response, excluding its size field
+        :param copy: True to copy the outputs out of the message, which is then reused
+        :return: (outputs, (queued, run, batch size))
+        """
+        request_id, count, queued, run, batch_size = response_fields.unpack_from(message)
+        if request_id != self._request_id:
+            raise EOFError("Received the response to request {} for request {}".format(request_id, self._request_id))
+        if count == protocol.FAILED:
+            raise RuntimeError("{} failed on the inference server".format(self.info.name))
+
+        outputs = {}
+        offset = response_fields.size
+        for name, shape in self.info.outputs:
+            values = count * protocol.sample_size(shape)
+            output = np.frombuffer(message, np.float32, values, offset).reshape((count,) + tuple(shape))
+            outputs[name] = output.copy() if copy else output
+            offset += values * 4
+        return outputs, (queued, run, batch_size)
+
+    def _receive_ring(self):
+        while True:
+            response = None
+            # Every frame is read, for the ring to release it
+            for frame in self._reader.frames():
+                response = self._decode(frame, True)
+            if response is not None:
+                return response
+            readable, _, _ = select.select([self.sock], [], [], shm.recheck_interval)
+            if readable and self.sock.recv(4096) == b'':
+                raise EOFError("Inference server disconnected")
+
+    def close(self):
+        if self._writer is not None:
+            # Closes the socket
+            self._writer.close()
+            self._reader.close()
+        else:
+            self.sock.close()
+
+
+if __name__ == '__main__':
+    # Checks the server with models emulating the cost of inference, then compares running the requests of several
+    # recognizers one at a time and batched, and the round trip over a socket and over shared memory
+    # Run as: python -m components.inference.client
+    import threading
+
+    from .models import Model
+    from .server import InferenceServer
+
+    def emulated(name, input_shape, fixed_ms, per_sample_ms, fail=None):
+        """
+        A model taking fixed_ms + per_sample_ms per sample, which sums and doubles its samples
+        """
+        def run(batch):
+            if fail is not None and np.any(batch == fail):
+                raise ValueError("emulated failure")
+            time.sleep((fixed_ms + per_sample_ms * len(batch)) / 1000)
+            flat = batch.reshape((len(batch), -1))
+            return flat.sum(axis=1, keepdims=True), batch * 2
+
+        return Model(name, input_shape, (("sum", (1,)), ("double", input_shape)), 8, run)
+
+    def start(models, max_delay):
+        server = InferenceServer({model.name: model for model in models}, max_delay, 'localhost', unix_path)
+        server.start()
+        return server
+
+    unix_path = os.path.join(tempfile.gettempdir(), "realtime_inference_check.sock") if default_unix_path else None
+    addresses = [("tcp", "localhost")] + ([("unix", unix_path)] if unix_path else [])
+
+    # Outputs of concurrent clients, over every transport, including requests split above max_batch
+    server = start([emulated("model", (3, 4), 1, 0.1, fail=-1)], 0.002)
+    errors = []
+
+    def check(address, shared_memory, seed):
+        rng = np.random.RandomState(seed)
+        client = InferenceClient("model", address, shared_memory)
+        try:
+            for _ in range(50):
+                batch = rng.random_sample((rng.randint(1, 20), 3, 4)).astype(np.float32)
+                outputs, latency = client.run(batch)
+                assert np.allclose(outputs["sum"][:, 0], batch.sum(axis=(1, 2)), rtol=1e-5)
+                assert np.array_equal(outputs["double"], batch * 2)
+                assert 1 <= latency.batch_size <= 8 and latency.round_trip_ns > latency.run_ns > 0
+        except Exception as ex:
+            errors.append(ex)
+            raise
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=check, args=(address, shared_memory, i))
+               for i, ((_, address), shared_memory) in enumerate([(a, s) for a in addresses for s in (False, True)] * 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+
+    client = InferenceClient("model", addresses[-1][1])
+    try:
+        client.run(np.full((1, 3, 4), -1))
+        raise AssertionError("expected the failure of the model")
+    except RuntimeError:
+        pass
+    client.run(np.ones((1, 3, 4)))
+    client.close()
+    try:
+        InferenceClient("unknown", addresses[-1][1])
+        raise AssertionError("expected unknown to be rejected")
+    except ValueError:
+        pass
+    server.stop()
+    server.join()
+    print("checked {} concurrent clients over {}, with and without shared memory".format(
+        len(threads), " and ".join(name for name, _ in addresses)))
+
+    # 4 recognizers sending a frame at a time to a model taking 4 ms + 1 ms per sample
+    def throughput(max_delay, max_batch, duration=2.0):
+        model = emulated("model", (128, 128, 1), 4, 1)._replace(max_batch=max_batch)
+        server = start([model], max_delay)
+        latencies = [[] for _ in range(4)]
+
+        def closed_loop(latencies):
+            client = InferenceClient("model", addresses[-1][1])
+            frame = np.zeros((1, 128, 128, 1), dtype=np.float32)
+            end = time.perf_counter() + duration
+            while time.perf_counter() < end:
+                latencies.append(client.run(frame)[1].round_trip_ns / 1e6)
+            client.close()
+
+        threads = [threading.Thread(target=closed_loop, args=(l,)) for l in latencies]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        server.stop()
+        server.join()
+        flat = np.concatenate(latencies)
+        print("{:<34}{:>8.0f} frames/s  p50 {:5.1f} ms  p99 {:5.1f} ms".format(
+            "max batch {}, max delay {} ms".format(max_batch, max_delay * 1000),
+            len(flat) / duration, np.percentile(flat, 50), np.percentile(flat, 99)))
+
+    print("4 clients, model taking 4 ms + 1 ms per sample")
+    throughput(0, 1)
+    throughput(0.002, 8)
+    throughput(0.010, 8)
+
+    # Round trip of both hands to a model returning right away
+    server = start([emulated("model", (128, 128, 1), 0, 0)], 0.002)
+    hands = np.zeros((2, 128, 128, 1), dtype=np.float32)
+    print("round trip of a (2, 128, 128, 1) request")
+    for name, address in addresses:
+        for shared_memory in (False, True):
+            client = InferenceClient("model", address, shared_memory)
+            for _ in range(100):
+                client.run(hands)
+            round_trips = [client.run(hands)[1].round_trip_ns / 1e3 for _ in range(1000)]
+            print("  {:<24}p50 {:6.0f} us  p99 {:6.0f} us".format(
+                name + (" + shared memory" if shared_memory else ""),
+                np.percentile(round_trips, 50), np.percentile(round_trips, 99)))
+            client.close()
+    server.stop()
+    server.join()
@@ -0,0 +1,318 @@
+"""
+Exports the models of the recognizers as frozen graphs, see components.inference.frozen.
+
+Each model is built in eval mode from its checkpoint, as the recognizers build it, then
+- its variables are folded into constants and only the ops its outputs depend on are kept, which drops the training
+  ops, the summaries and the savers
+- the devices are cleared, for the graph to run on any machine
+With --optimize, the graph is also rewritten, which has not been checked against the checkpoints yet:
+- tf.where(x < 0, 0 * x, x), the leaky ReLU of the ResNets without leakiness, is replaced by Relu
+- the graph transform tool folds the constant expressions, e.g. the batch normalization with its moving statistics,
+  and folds the remaining batch normalization multiplications into the weights of the convolutions before them
+The outputs of the frozen model are then compared with those of the checkpoint.
+
+Run as:
+    python -m components.inference.export [--models hands_RH,head] [--directory ./models/frozen] [--optimize]
+    python -m components.inference.export --benchmark [--models hands_RH,head]
+"""
+import argparse
+import functools
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from . import frozen
+from . import models
+
+# sess and the tensors of a model built from its checkpoint
+# inputs and outputs map names, used by FrozenModel, to tensors
+# batch_size is None if the graph accepts any batch size
+# loops is True for graphs with while loops, whose Identity nodes must be kept
+# sample(rng, n) returns random feeds for a batch of n samples, by input name
+Exportable = namedtuple('Exportable', 'sess,inputs,outputs,batch_size,loops,sample')
+
+# Passes of the graph transform tool, see tensorflow/tools/graph_transforms
+transforms = [
+    'remove_nodes(op=Identity, op=CheckNumerics)',
+    'fold_constants(ignore_errors=true)',
+    'fold_batch_norms',
+    'fold_old_batch_norms',
+    'sort_by_execution_order',
+]
+loop_transforms = [
+    'fold_constants(ignore_errors=true)',
+    'fold_old_batch_norms',
+    'sort_by_execution_order',
+]
+
+
+def _images(shape):
+    def sample(rng, n):
+        return {"images": rng.random_sample((n,) + shape).astype(np.float32)}
+    return sample
+
+
+def _build_hands(hands, config, arm_batch):
+    import tensorflow as tf
+    from ..handRecognition.realtime_hand_recognition import RealTimeHandRecognition
+
+    with tf.Graph().as_default():
+        recognizer = RealTimeHandRecognition(hands, 32, 2, config)
+    model = recognizer.model
+    return Exportable(recognizer.sess, {"images": model._images},
+                      {"predictions": model.predictions, "feature": model.fc_x}, None, False, _images((128, 128, 1)))
+
+
+def _build_head(config, arm_batch):
+    import tensorflow as tf
+    from ..headRecognition.realtime_head_recognition import RealTimeHeadRecognition
+
+    with tf.Graph().as_default():
+        recognizer = RealTimeHeadRecognition(3, config)
+    model = recognizer.model
+    return Exportable(recognizer.sess, {"images": model._images}, {"predictions": model.predictions}, None, False,
+                      _images((128, 128, 30)))
+
+
+def _build_rgb_hands(hands, config, arm_batch):
+    import tensorflow as tf
+
+    with tf.Graph().as_default():
+        sess, images, probabilities = models.build_rgb_hands(hands, config)
+    # map_fn standardizes the images in a while loop
+    return Exportable(sess, {"images": images}, {"predictions": probabilities}, None, True, _images((128, 128, 3)))
+
+
+def _build_arm(arm, config, arm_batch):
+    from ..skeletonRecognition.Armsolver import load_arm_model
+
+    recognizer = load_arm_model(arm, arm_batch, config)
+    model = recognizer.model
+
+    def sample(rng, n):
+        return {"x": rng.standard_normal((n, 15, recognizer.feature_size)).astype(np.float32),
+                "n_frames": [15] * n, "keep_prob": 1.0}
+
+    # The LSTMs are unrolled by dynamic_rnn in a while loop, for a fixed batch size
+    return Exportable(model.sess, {"x": model.x, "n_frames": model.n_frames, "keep_prob": model.keep_prob},
+                      {"probabilities": model.probabilities}, arm_batch, True, sample)
+
+
+builders = {
+    'hands_LH': functools.partial(_build_hands, 'LH'),
+    'hands_RH': functools.partial(_build_hands, 'RH'),
+    'head': _build_head,
+    'rgb_LH': functools.partial(_build_rgb_hands, 'LH'),
+    'rgb_RH': functools.partial(_build_rgb_hands, 'RH'),
+    'arm_left': functools.partial(_build_arm, 'left'),
+    'arm_right': functools.partial(_build_arm, 'right'),
+}
+
+
+def _node_name(name):
+    return name.lstrip('^').split(':')[0]
+
+
+def where_to_relu(graph_def):
+    """
+    Replaces tf.where(x < 0, 0 * x, x) by Relu(x), which computes the same values in one op rather than three
+    :param graph_def: frozen GraphDef, modified in place
+    :return: number of replaced nodes
+    """
+    from tensorflow.python.framework import tensor_util
+
+    nodes = {node.name: node for node in graph_def.node}
+
+    def is_zero(name):
+        node = nodes.get(_node_name(name))
+        return node is not None and node.op == 'Const' and \
+            not np.any(tensor_util.MakeNdarray(node.attr['value'].tensor))
+
+    replaced = 0
+    for node in graph_def.node:
+        if node.op != 'Select' or len(node.input) != 3:
+            continue
+        condition, negative, x = node.input
+        less = nodes.get(_node_name(condition))
+        scaled = nodes.get(_node_name(negative))
+        if less is None or less.op != 'Less' or less.input[0] != x or not is_zero(less.input[1]):
+            continue
+        if scaled is None or scaled.op != 'Mul' or x not in scaled.input:
+            continue
+        if not is_zero(scaled.input[1] if scaled.input[0] == x else scaled.input[0]):
+            continue
+        # Select and Relu both have the attribute T
+        node.op = 'Relu'
+        del node.input[:]
+        node.input.append(x)
+        replaced += 1
+    return replaced
+
+
+def freeze(exportable, optimize=False):
+    """
+    :param optimize: True to replace the leaky ReLUs without leakiness by Relu and run the graph transform tool
+    :return: frozen GraphDef of the model
+    """
+    import tensorflow as tf
+    from tensorflow.tools.graph_transforms import TransformGraph
+
+    inputs = [tensor.op.name for tensor in exportable.inputs.values()]
+    outputs = [tensor.op.name for tensor in exportable.outputs.values()]
+
+    graph_def = tf.graph_util.convert_variables_to_constants(exportable.sess, exportable.sess.graph.as_graph_def(),
+                                                              outputs)
+    for node in graph_def.node:
+        node.device = ''
+    if not optimize:
+        return graph_def
+    if where_to_relu(graph_def):
+        # Drops the Less and Mul nodes left unused
+        graph_def = tf.graph_util.extract_sub_graph(graph_def, outputs)
+    return TransformGraph(graph_def, inputs, outputs, loop_transforms if exportable.loops else transforms)
+
+
+def export(name, directory, config, arm_batch=1, check_batch=2, optimize=False):
+    """
+    Exports a model and checks that the frozen model computes the outputs of the checkpoint
+    :param name: one of builders
+    :param directory: directory of the frozen models
+    :param config: tf.ConfigProto of the sessions
+    :param arm_batch: batch size of the arm models, whose graphs have a fixed batch size
+    :param check_batch: number of samples compared, at most the batch size of the graph
+    :param optimize: True to rewrite the graph, see freeze()
+    :return: largest absolute difference between the outputs of the checkpoint and of the frozen model
+    """
+    if name not in builders:
+        raise ValueError("Unknown model {}, expected one of {}".format(name, ", ".join(sorted(builders))))
+    print("Exporting {}".format(name))
+    exportable = builders[name](config, arm_batch)
+    graph_def = freeze(exportable, optimize)
+
+    graph_path, info_path = frozen.paths(directory, name)
+    os.makedirs(directory, exist_ok=True)
+    with open(graph_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+
+    def describe(tensors):
+        return {tensor_name: {'tensor': tensor.name, 'dtype': tensor.dtype.name,
+                              'shape': tensor.get_shape().as_list() if tensor.get_shape().ndims is not None else None}
+                for tensor_name, tensor in tensors.items()}
+
+    info = {'name': name, 'inputs': describe(exportable.inputs), 'outputs': describe(exportable.outputs),
+            'batch_size': exportable.batch_size,
+            'transforms': (loop_transforms if exportable.loops else transforms) if optimize else []}
+    with open(info_path, 'w') as f:
+        json.dump(info, f, indent=2)
+
+    n = check_batch if exportable.batch_size is None else exportable.batch_size
+    feeds = exportable.sample(np.random.RandomState(0), n)
+    names = sorted(exportable.outputs)
+    expected = exportable.sess.run([exportable.outputs[output] for output in names],
+                                   feed_dict={exportable.inputs[input_name]: value
+                                              for input_name, value in feeds.items()})
+    actual = frozen.FrozenModel(name, directory, config).run(names, feeds)
+    difference = max(float(np.max(np.abs(e - a))) for e, a in zip(expected, actual))
+    print("{}: {} nodes, {:.1f} MB, largest difference with the checkpoint {:.2e}".format(
+        graph_path, len(graph_def.node), os.path.getsize(graph_path) / 1e6, difference))
+    return difference
+
+
+def _time(name, directory, threads, frames, arm_batch):
+    """
+    Measures the cold start and the latency of a model in this process, and prints them as JSON
+    :param directory: directory of the frozen models, None to load the checkpoint
+    """
+    start = time.perf_counter()
+    import tensorflow as tf
+    imported = time.perf_counter()
+
+    config = frozen.runtime_config(cpu=True, threads=threads)
+    with tf.Graph().as_default():
+        # The arm graphs run a fixed batch size, that of the frozen arms
+        model = models.load(name, config, arm_batch if name.startswith('arm_') else 2, directory)
+    loaded = time.perf_counter()
+
+    rng = np.random.RandomState(0)
+    batch = rng.random_sample((1,) + model.input_shape).astype(np.float32)
+    model.run(batch)
+    first = time.perf_counter()
+
+    result = {'import_s': imported - start, 'load_s': loaded - imported, 'first_run_ms': (first - loaded) * 1e3}
+    for n in sorted({1, min(model.max_batch, 2)}):
+        batch = rng.random_sample((n,) + model.input_shape).astype(np.float32)
+        latencies = []
+        for _ in range(frames):
+            run_start = time.perf_counter()
+            model.run(batch)
+            latencies.append((time.perf_counter() - run_start) * 1e3)
+        result['batch_{}_p50_ms'.format(n)] = float(np.percentile(latencies, 50))
+        result['batch_{}_p99_ms'.format(n)] = float(np.percentile(latencies, 99))
+    print(json.dumps(result))
+
+
+def benchmark(names, directory, threads, frames, arm_batch):
+    """
+    Compares the cold start and the per frame latency on the CPU of the checkpoints and of the frozen models, each
+    loaded in a new process
+    """
+    for name in names:
+        for source in ('checkpoint', 'frozen'):
+            command = [sys.executable, '-m', 'components.inference.export', '--time', name, '--source', source,
+                       '--directory', directory, '--threads', str(threads), '--frames', str(frames),
+                       '--arm-batch', str(arm_batch)]
+            output = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print("{:<10}{:<12}import {:5.1f} s  load {:5.1f} s  first run {:7.1f} ms  {}".format(
+                name, source, result['import_s'], result['load_s'], result['first_run_ms'],
+                "  ".join("{} {:6.1f} ms".format(key[:-3].replace('_', ' '), value)
+                          for key, value in sorted(result.items()) if key.startswith('batch'))))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', default=",".join(sorted(builders)),
+                        help='Comma separated models, among {}'.format(", ".join(sorted(builders))))
+    parser.add_argument('--directory', default=frozen.default_directory, help='Directory of the frozen models')
+    parser.add_argument('--arm-batch', type=int, default=1,
+                        help='Batch size of the arm models, 1 for the recognizers, --max-batch for the inference server')
+    parser.add_argument('--optimize', action='store_true', default=False,
+                        help='Replace the leaky ReLUs without leakiness by Relu and run the graph transform tool, '
+                             'not checked against the checkpoints yet')
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help='Largest difference with the outputs of the checkpoint')
+    parser.add_argument('--benchmark', action='store_true', default=False,
+                        help='Compare the checkpoints and the exported models on the CPU rather than export them')
+    parser.add_argument('--threads', type=int, default=4, help='Threads of each op in the benchmark')
+    parser.add_argument('--frames', type=int, default=200, help='Frames run by the benchmark')
+    # Run by benchmark() in a new process
+    parser.add_argument('--time', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--source', choices=('checkpoint', 'frozen'), default='frozen', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.time is not None:
+        _time(args.time, args.directory if args.source == 'frozen' else None, args.threads, args.frames,
+              args.arm_batch)
+        return
+
+    names = args.models.split(',')
+    if args.benchmark:
+        benchmark(names, args.directory, args.threads, args.frames, args.arm_batch)
+        return
+
+    config = models.session_config(cpu=True)
+    failed = []
+    for name in names:
+        if export(name, args.directory, config, args.arm_batch, optimize=args.optimize) > args.tolerance:
+            failed.append(name)
+    if failed:
+        sys.exit("The outputs of {} differ from those of the checkpoints".format(", ".join(failed)))
+
+
+if __name__ == '__main__':
+    main()
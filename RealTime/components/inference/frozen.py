@@ -0,0 +1,91 @@
+"""
+Runtime of the frozen models exported by components.inference.export.
+A frozen model is a GraphDef holding only the inference ops, with the variables folded into constants, next to a
+JSON description of its inputs and outputs:
+    <directory>/<name>.pb
+    <directory>/<name>.json
+Loading it neither builds the training graph nor restores a checkpoint.
+"""
+import json
+import os
+
+# Where export writes the frozen models, relative to the working directory as ./models
+default_directory = os.path.join('.', 'models', 'frozen')
+
+
+def runtime_config(cpu=False, threads=None):
+    """
+    :param cpu: True to run on the CPU only, even when a GPU is visible
+    :param threads: threads of each op, None for the number of cores
+    :return: tf.ConfigProto for frozen models
+    """
+    import tensorflow as tf
+    config = tf.ConfigProto(device_count={'GPU': 0} if cpu else None)
+    if threads is not None:
+        config.intra_op_parallelism_threads = threads
+        config.inter_op_parallelism_threads = 1
+    config.gpu_options.allow_growth = True
+    config.allow_soft_placement = True
+    # The variables of the exported graph are constants, the optimizer folds the constant expressions at the first run
+    config.graph_options.optimizer_options.opt_level = tf.OptimizerOptions.L1
+    return config
+
+
+def paths(directory, name):
+    """
+    :return: (path of the GraphDef, path of the description) of a frozen model
+    """
+    path = os.path.join(directory, name)
+    return path + '.pb', path + '.json'
+
+
+class FrozenModel:
+    """
+    A frozen model loaded in its own graph and session
+    """
+
+    def __init__(self, name, directory=None, config=None):
+        """
+        :param name: name of the model, see models.loaders
+        :param directory: directory of the exported models, None for default_directory
+        :param config: tf.ConfigProto, None for runtime_config()
+        """
+        import tensorflow as tf
+
+        graph_path, info_path = paths(directory or default_directory, name)
+        with open(info_path) as f:
+            self.info = json.load(f)
+        graph_def = tf.GraphDef()
+        with open(graph_path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self.name = name
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.sess = tf.Session(graph=self.graph, config=config if config is not None else runtime_config())
+
+        self.inputs = {input_name: self.graph.get_tensor_by_name(tensor['tensor'])
+                       for input_name, tensor in self.info['inputs'].items()}
+        self.outputs = {output_name: self.graph.get_tensor_by_name(tensor['tensor'])
+                        for output_name, tensor in self.info['outputs'].items()}
+        # Graphs built for a fixed batch size, e.g. the arm LSTMs, None if any batch size is accepted
+        self.batch_size = self.info['batch_size']
+
+    def output_shape(self, name):
+        """
+        :return: shape of a sample of an output
+        """
+        return tuple(self.info['outputs'][name]['shape'][1:])
+
+    def run(self, fetches, feeds):
+        """
+        :param fetches: name of an output, or list of names
+        :param feeds: value of each input, by name
+        :return: the value of each fetched output, as for Session.run()
+        """
+        if isinstance(fetches, list):
+            tensors = [self.outputs[name] for name in fetches]
+        else:
+            tensors = self.outputs[fetches]
+        return self.sess.run(tensors, feed_dict={self.inputs[name]: value for name, value in feeds.items()})
@@ -0,0 +1,156 @@
+"""
+Models served by the inference server. Each is loaded once, in its own graph, by the recognizer class that the
+recognizers otherwise load in their own process, so that both compute the same outputs.
+With a frozen directory, the models are loaded from the frozen graphs exported by components.inference.export rather
+than from their checkpoints.
+"""
+import functools
+from collections import namedtuple
+
+import numpy as np
+
+# run() takes a float32 batch of at most max_batch samples of input_shape, and returns an array for each output
+# outputs holds a (name, shape of a sample) pair for each output
+Model = namedtuple('Model', 'name,input_shape,outputs,max_batch,run')
+
+
+def session_config(gpu_memory_fraction=None, cpu=False):
+    """
+    :param gpu_memory_fraction: fraction of the GPU memory the server may use, None to allocate it as needed
+    :param cpu: True to run on the CPU only, even when a GPU is visible
+    :return: tf.ConfigProto shared by the sessions of the server
+    """
+    import tensorflow as tf
+    config = tf.ConfigProto(device_count={'GPU': 0} if cpu else None)
+    if gpu_memory_fraction is not None:
+        config.gpu_options.per_process_gpu_memory_fraction = gpu_memory_fraction
+    config.gpu_options.allow_growth = True
+    config.allow_soft_placement = True
+    return config
+
+
+def _load_hands(hands, config, max_batch, frozen=None):
+    gestures = 32
+    if frozen is not None:
+        from ..handRecognition.realtime_hand_recognition import FrozenHandRecognition
+        recognizer = FrozenHandRecognition(hands, gestures, max_batch, frozen, config)
+    else:
+        import tensorflow as tf
+        from ..handRecognition.realtime_hand_recognition import RealTimeHandRecognition
+        with tf.Graph().as_default():
+            recognizer = RealTimeHandRecognition(hands, gestures, max_batch, config)
+    fetches = [recognizer.model.predictions, recognizer.model.fc_x]
+    outputs = (("predictions", (gestures,)), ("feature", recognizer.blind_feature.shape))
+    return Model("hands_" + hands, (128, 128, 1), outputs, max_batch,
+                 lambda batch: recognizer.run(fetches, batch))
+
+
+def _load_head(config, max_batch, frozen=None):
+    # nod, shake, other
+    gestures = 3
+    if frozen is not None:
+        from ..headRecognition.realtime_head_recognition import FrozenHeadRecognition
+        recognizer = FrozenHeadRecognition(gestures, frozen, config)
+    else:
+        import tensorflow as tf
+        from ..headRecognition.realtime_head_recognition import RealTimeHeadRecognition
+        with tf.Graph().as_default():
+            recognizer = RealTimeHeadRecognition(gestures, config)
+    fetches = [recognizer.model.predictions]
+    return Model("head", (128, 128, 30), (("predictions", (gestures,)),), max_batch,
+                 lambda batch: recognizer.run(fetches, batch))
+
+
+# Gestures of the RGB hand models
+rgb_gestures = 20
+
+
+def build_rgb_hands(hands, config):
+    """
+    Builds the RGB hand model for a batch of images, as rgbHandRecognition.RealTimeHandRecognition, and restores it
+    :param hands: 'LH' or 'RH'
+    :param config: tf.ConfigProto of the session
+    :return: (session, images placeholder, probabilities tensor)
+    """
+    import tensorflow as tf
+    from ..rgbHandRecognition.realtime_hand_recognition import checkpoints
+    from ..rgbHandRecognition.resnet_v2 import resnet_v2_50
+    from ..rgbHandRecognition import resnet_utils
+
+    images = tf.placeholder(tf.float32, [None, 128, 128, 3])
+    standardized_images = tf.map_fn(tf.image.per_image_standardization, images)
+    with tf.contrib.slim.arg_scope(resnet_utils.resnet_arg_scope()):
+        _, end_points = resnet_v2_50(standardized_images, rgb_gestures, False)
+
+    saver = tf.train.Saver()
+    sess = tf.Session(config=config)
+    print('Loading checkpoint %s' % checkpoints[hands])
+    saver.restore(sess, checkpoints[hands])
+    return sess, images, end_points['predictions']
+
+
+def _load_rgb_hands(hands, config, max_batch, frozen=None):
+    if frozen is not None:
+        from .frozen import FrozenModel
+        model = FrozenModel("rgb_" + hands, frozen, config)
+
+        def run(batch):
+            return [np.reshape(model.run("predictions", {"images": batch}), (len(batch), rgb_gestures))]
+    else:
+        import tensorflow as tf
+        with tf.Graph().as_default():
+            sess, images, probabilities = build_rgb_hands(hands, config)
+
+        def run(batch):
+            return [np.reshape(sess.run(probabilities, feed_dict={images: batch}), (len(batch), rgb_gestures))]
+
+    return Model("rgb_" + hands, (128, 128, 3), (("predictions", (rgb_gestures,)),), max_batch, run)
+
+
+def _load_arm(arm, config, max_batch, frozen=None):
+    if frozen is not None:
+        from ..skeletonRecognition.LSTMSolver import FrozenArmMotionRecognition
+        recognizer = FrozenArmMotionRecognition(arm, frozen, config)
+        # The graph was exported for a fixed batch size
+        max_batch = min(max_batch, recognizer.batch_size)
+    else:
+        from ..skeletonRecognition.Armsolver import load_arm_model
+        recognizer = load_arm_model(arm, max_batch, config)
+    # 15 frames of the 5 joints of the arm, normalized by RealTimeArmMotionRecognition.predict()
+    return Model("arm_" + arm, (15, 15), (("probabilities", (recognizer.n_classes,)),), max_batch,
+                 lambda batch: [recognizer.run(batch)])
+
+
+loaders = {
+    'hands_LH': functools.partial(_load_hands, 'LH'),
+    'hands_RH': functools.partial(_load_hands, 'RH'),
+    'head': _load_head,
+    'rgb_LH': functools.partial(_load_rgb_hands, 'LH'),
+    'rgb_RH': functools.partial(_load_rgb_hands, 'RH'),
+    'arm_left': functools.partial(_load_arm, 'left'),
+    'arm_right': functools.partial(_load_arm, 'right'),
+}
+
+
+def load(name, config, max_batch, frozen=None):
+    """
+    :param name: one of loaders
+    :param config: tf.ConfigProto, see session_config()
+    :param max_batch: largest batch run at once
+    :param frozen: directory of the frozen models, see components.inference.export; None to load the checkpoints
+    :return: Model
+    """
+    if name not in loaders:
+        raise ValueError("Unknown model {}, expected one of {}".format(name, ", ".join(sorted(loaders))))
+    print("Loading {}{}".format(name, " from " + frozen if frozen is not None else ""))
+    return loaders[name](config, max_batch, frozen)
+
+
+def warm_up(model):
+    """
+    Runs a model on blank samples, for the first request not to pay for the initialization of the graph
+    :return: the model
+    """
+    for n in sorted({1, model.max_batch}):
+        model.run(np.zeros((n,) + model.input_shape, dtype=np.float32))
+    return model
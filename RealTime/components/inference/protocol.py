@@ -0,0 +1,91 @@
+"""
+Messages between the recognizers and the inference server.
+
+A client connects for a single model and registers with
+# size (int) | flags (byte) | model name
+and the server replies with a JSON description of the model, see ModelInfo
+# size (int) | JSON
+then every request gets a response, in order
+# request: size (int) | request id (unsigned int) | count (int) | count input samples (float32)
+# response: size (int) | request id (unsigned int) | count (int) | queued (long long, ns) | run (long long, ns) |
+#           batch size (int) | for each output, count output samples (float32)
+The size fields count the bytes that follow them. A count of -1 in a response reports that the model failed.
+With shared memory the requests and responses go through two rings, and the socket only carries notifications.
+"""
+import json
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+from ..fusion.conf import shm
+
+SHARED_MEMORY = shm.SHARED_MEMORY
+
+size_field = struct.Struct("<i")
+registration = struct.Struct("<iB")
+# The headers start with the size field, the fields follow it in the messages read without their size
+request_header = struct.Struct("<iIi")
+request_fields = struct.Struct("<Ii")
+response_header = struct.Struct("<iIiqqi")
+response_fields = struct.Struct("<Iiqqi")
+
+FAILED = -1
+
+# input_shape and the output shapes are those of a single sample, max_batch bounds the count of a request
+# rings holds the names of the request and response rings, with shared memory
+ModelInfo = namedtuple('ModelInfo', 'name,input_shape,outputs,max_batch,rings')
+
+# Time spent by a request waiting for its batch and running, and the number of samples in its batch
+Latency = namedtuple('Latency', 'queued_ns,run_ns,batch_size,round_trip_ns')
+
+
+def sample_size(shape):
+    """
+    :return: number of float32 values in a sample of the shape
+    """
+    return int(np.prod(shape, dtype=np.int64))
+
+
+def encode_info(info):
+    data = json.dumps(info._asdict()).encode('utf-8')
+    return size_field.pack(len(data)) + data
+
+
+def decode_info(data):
+    fields = json.loads(bytes(data).decode('utf-8'))
+    if 'error' in fields:
+        raise ValueError(fields['error'])
+    fields['input_shape'] = tuple(fields['input_shape'])
+    fields['outputs'] = tuple((name, tuple(shape)) for name, shape in fields['outputs'])
+    return ModelInfo(**fields)
+
+
+def encode_error(message):
+    data = json.dumps({'error': message}).encode('utf-8')
+    return size_field.pack(len(data)) + data
+
+
+def recv_exactly(sock, view):
+    """
+    Fill a buffer from a blocking socket
+    :param view: writable buffer, e.g. a memoryview of a bytearray or numpy array
+    """
+    view = memoryview(view).cast('B')
+    received = 0
+    while received < len(view):
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise EOFError("Received only {} bytes out of {}".format(received, len(view)))
+        received += n
+
+
+def recv_message(sock):
+    """
+    :return: bytearray holding the next message, excluding its size field
+    """
+    size = bytearray(size_field.size)
+    recv_exactly(sock, size)
+    data = bytearray(size_field.unpack(size)[0])
+    recv_exactly(sock, data)
+    return data
@@ -0,0 +1,422 @@
+"""
+Inference server: loads the models of the recognizers once, in a single process, and runs the requests of all the
+recognizers. Requests received for a model within a short delay are run as a single batch.
+Run as: python -m components.inference.server --models hands_RH,head,arm_left,arm_right [--help]
+The recognizers then use it with --inference, see components.inference.client
+"""
+import argparse
+import collections
+import os
+import select
+import socket
+import threading
+import traceback
+
+import numpy as np
+
+from ..fusion.conf import endpoints
+from ..fusion.conf import metrics
+from ..fusion.conf import shm
+from ..fusion.conf import startup as startup_conf
+from ..fusion.conf import trace
+from . import protocol
+from .protocol import request_header, request_fields, response_header
+
+Request = collections.namedtuple('Request', 'connection,request_id,data,arrival')
+
+
+class Connection:
+    """
+    A client of a model, receiving its requests over the socket or a shared memory ring.
+    Requests are received by the server thread, and answered by the thread of the model.
+    """
+
+    def __init__(self, sock, batcher, request_ring=None, response_ring=None):
+        """
+        :param sock: socket of the client, once registered
+        :param batcher: ModelBatcher of the model of the client
+        :param request_ring: Ring of the requests with shared memory, None to receive them over the socket
+        :param response_ring: Ring of the responses with shared memory
+        """
+        self.sock = sock
+        self.batcher = batcher
+        self.reader = shm.RingReader(request_ring) if request_ring is not None else None
+        # The socket is non-blocking from then on, it only carries notifications
+        self.writer = shm.RingWriter(sock, response_ring) if response_ring is not None else None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _request(self, request_id, count, data):
+        model = self.batcher.model
+        if not 0 < count <= model.max_batch:
+            raise EOFError("Invalid request of {} samples for {}, at most {}".format(count, model.name, model.max_batch))
+        return Request(self, request_id, data, trace.now())
+
+    def receive(self, notified=True):
+        """
+        Receive the pending requests, once the socket is readable or the ring may hold requests
+        :param notified: True if the socket is readable
+        :return: list of Requests
+        """
+        model = self.batcher.model
+        sample_size = protocol.sample_size(model.input_shape)
+        if self.reader is None:
+            header = bytearray(request_header.size)
+            received = self.sock.recv_into(header)
+            if received == 0:
+                raise EOFError("Client of {} disconnected".format(model.name))
+            protocol.recv_exactly(self.sock, memoryview(header)[received:])
+            size, request_id, count = request_header.unpack(header)
+            if size != request_fields.size + count * sample_size * 4:
+                raise EOFError("Invalid request of {} bytes for {} samples of {}".format(size, count, model.name))
+            request = self._request(request_id, count, None)
+            # Received in place, the batch is copied once by the thread of the model
+            data = np.empty((count,) + model.input_shape, dtype=np.float32)
+            protocol.recv_exactly(self.sock, data)
+            return [request._replace(data=data)]
+
+        if notified and self.sock.recv(4096) == b'':
+            raise EOFError("Client of {} disconnected".format(model.name))
+        requests = []
+        for frame in self.reader.frames():
+            request_id, count = request_fields.unpack_from(frame)
+            request = self._request(request_id, count, None)
+            # Copied out of the ring, which reuses the memory once the next frame is read
+            data = np.frombuffer(frame, np.float32, count * sample_size, request_fields.size)
+            requests.append(request._replace(data=data.reshape((count,) + model.input_shape).copy()))
+        return requests
+
+    def respond(self, message):
+        """
+        Send a response, unless the client disconnected
+        :param message: the response, prefixed by its size
+        """
+        with self._lock:
+            if self._closed:
+                return
+            if self.writer is not None:
+                self.writer.sendall(message)
+            else:
+                self.sock.sendall(message)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self.reader is not None:
+                self.reader.close()
+            if self.writer is not None:
+                self.writer.close()
+            else:
+                self.sock.close()
+
+
+class ModelBatcher(threading.Thread):
+    """
+    Runs the requests of all the clients of a model. The clients wait for their responses, so each has at most one
+    request pending: the batch is run once every client sent a request, or max_delay after the first request.
+    """
+
+    def __init__(self, model, max_delay):
+        """
+        :param model: models.Model
+        :param max_delay: seconds a request may wait for the requests of other clients
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.model = model
+        self.max_delay_ns = int(max_delay * 1e9)
+        self.connections = 0
+        self._pending = collections.deque()
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        self._batch = np.empty((model.max_batch,) + model.input_shape, dtype=np.float32)
+
+        self._requests = metrics.counter("inference_requests", model=model.name)
+        self._failures = metrics.counter("inference_failures", model=model.name)
+        self._queued = metrics.histogram("inference_queued_ns", model=model.name)
+        self._run_time = metrics.histogram("inference_run_ns", model=model.name)
+        self._batch_size = metrics.histogram("inference_batch_size", model=model.name)
+
+    def connect(self):
+        with self._condition:
+            self.connections += 1
+
+    def disconnect(self):
+        with self._condition:
+            self.connections -= 1
+            # The remaining clients may all have a request pending
+            self._condition.notify()
+
+    def submit(self, request):
+        with self._condition:
+            self._pending.append(request)
+            self._condition.notify()
+
+    def stop(self):
+        self._stopped.set()
+        with self._condition:
+            self._condition.notify()
+
+    def is_stopped(self):
+        return self._stopped.is_set()
+
+    def _pending_samples(self):
+        return sum(len(request.data) for request in self._pending)
+
+    def _next_batch(self):
+        """
+        Wait for the requests of the next batch
+        :return: list of Requests of at most max_batch samples in total, empty once stopped
+        """
+        max_batch = self.model.max_batch
+        with self._condition:
+            while not self._pending:
+                if self.is_stopped():
+                    return []
+                self._condition.wait(0.1)
+
+            deadline = self._pending[0].arrival + self.max_delay_ns
+            while len(self._pending) < self.connections and self._pending_samples() < max_batch \
+                    and not self.is_stopped():
+                remaining = deadline - trace.now()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining / 1e9)
+
+            requests = []
+            count = 0
+            while self._pending and count + len(self._pending[0].data) <= max_batch:
+                request = self._pending.popleft()
+                requests.append(request)
+                count += len(request.data)
+            return requests
+
+    def _run_batch(self, requests):
+        if len(requests) == 1:
+            batch = requests[0].data
+        else:
+            count = 0
+            for request in requests:
+                self._batch[count:count + len(request.data)] = request.data
+                count += len(request.data)
+            batch = self._batch[:count]
+
+        start = trace.now()
+        try:
+            outputs = [np.asarray(output, dtype=np.float32) for output in self.model.run(batch)]
+        except Exception:
+            traceback.print_exc()
+            outputs = None
+        end = trace.now()
+        self._run_time.record(end - start)
+        self._batch_size.record(len(batch))
+
+        offset = 0
+        for request in requests:
+            count = len(request.data)
+            self._requests.inc()
+            self._queued.record(start - request.arrival)
+            if outputs is None:
+                self._failures.inc()
+                parts = []
+                count = protocol.FAILED
+            else:
+                parts = [output[offset:offset + count].tobytes() for output in outputs]
+                offset += count
+            size = response_header.size - protocol.size_field.size + sum(len(part) for part in parts)
+            header = response_header.pack(size, request.request_id, count, start - request.arrival, end - start,
+                                          len(batch))
+            try:
+                request.connection.respond(b''.join([header] + parts))
+            except (OSError, ValueError) as ex:
+                # The server thread disconnects the client
+                print("Failed to respond to a client of {}: {}".format(self.model.name, ex))
+
+    def run(self):
+        while not self.is_stopped():
+            requests = self._next_batch()
+            if requests:
+                self._run_batch(requests)
+
+
+class InferenceServer(threading.Thread):
+    """
+    Accepts the clients of the models, and receives their requests
+    """
+
+    def __init__(self, models, max_delay=0.002, host='localhost', unix_path=None):
+        """
+        :param models: models.Model of each served model, by name
+        :param max_delay: seconds a request may wait for the requests of other clients, 0 to never wait
+        :param host: address to listen on for TCP clients, None to only accept clients on the Unix socket
+        :param unix_path: path of the Unix socket to listen on, None for TCP only
+        """
+        threading.Thread.__init__(self)
+        self.batchers = {name: ModelBatcher(model, max_delay) for name, model in models.items()}
+        self._stopped = threading.Event()
+        self._unix_path = unix_path
+        self._listeners = []
+
+        if host is not None:
+            self._listeners.append(endpoints.serve('inference', host))
+        if unix_path is not None:
+            if os.path.exists(unix_path):
+                # Left by a server that did not exit cleanly
+                os.unlink(unix_path)
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(unix_path)
+            self._listeners.append(listener)
+        for listener in self._listeners:
+            listener.listen(16)
+
+    def stop(self):
+        self._stopped.set()
+
+    def is_stopped(self):
+        return self._stopped.is_set()
+
+    def _accept(self, sock):
+        """
+        Read the registration of a client, and reply with the description of its model
+        :return: Connection, None if the client was rejected
+        """
+        sock.settimeout(10)
+        try:
+            data = protocol.recv_message(sock)
+            flags, name = data[0], bytes(data[1:]).decode('ascii')
+        except (OSError, EOFError, IndexError, UnicodeDecodeError) as ex:
+            print("Invalid registration: {}".format(ex))
+            sock.close()
+            return None
+
+        batcher = self.batchers.get(name)
+        if batcher is None:
+            print("Rejected a client of {}, which is not served".format(name))
+            sock.sendall(protocol.encode_error("{} is not served, serving {}".format(name, ", ".join(self.batchers))))
+            sock.close()
+            return None
+
+        model = batcher.model
+        rings = None
+        local = sock.family != socket.AF_INET or shm.is_local(sock.getsockname(), sock.getpeername())
+        if flags & protocol.SHARED_MEMORY and local and shm.is_available():
+            request_size = request_header.size + model.max_batch * protocol.sample_size(model.input_shape) * 4
+            try:
+                # Rings hold at least 2 requests, see RingWriter.sendall()
+                rings = (shm.Ring.create(max(shm.default_capacity, 4 * request_size)),
+                         shm.Ring.create(shm.default_capacity))
+            except OSError as ex:
+                print("Unable to create shared memory for a client of {}, using the socket: {}".format(name, ex))
+
+        info = protocol.ModelInfo(name, model.input_shape, model.outputs, model.max_batch,
+                                  [ring.name for ring in rings] if rings is not None else None)
+        try:
+            sock.sendall(protocol.encode_info(info))
+        except OSError:
+            for ring in rings or ():
+                ring.close()
+            sock.close()
+            return None
+
+        sock.settimeout(None)
+        if sock.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        print("Client of {} connected{}".format(name, " over shared memory" if rings is not None else ""))
+        batcher.connect()
+        return Connection(sock, batcher, *(rings or ()))
+
+    def run(self):
+        for batcher in self.batchers.values():
+            batcher.start()
+
+        connections = {}
+        print("Serving {}".format(", ".join(self.batchers)))
+
+        while not self.is_stopped():
+            read_socks, _, _ = select.select(self._listeners + list(connections), [], [], 0.01)
+
+            # Clients using shared memory only notify when their ring was empty, so also check the rings which were
+            # not notified, in case a notification raced with the end of the previous read
+            rings = [s for s, connection in connections.items() if connection.reader is not None and s not in read_socks]
+
+            for s in read_socks + rings:
+                if s in self._listeners:
+                    client_sock, _ = s.accept()
+                    connection = self._accept(client_sock)
+                    if connection is not None:
+                        connections[client_sock] = connection
+                    continue
+
+                connection = connections[s]
+                try:
+                    requests = connection.receive(s in read_socks)
+                except (OSError, EOFError) as ex:
+                    print("Disconnecting a client of {}: {}".format(connection.batcher.model.name, ex))
+                    del connections[s]
+                    connection.batcher.disconnect()
+                    connection.close()
+                    continue
+
+                for request in requests:
+                    connection.batcher.submit(request)
+
+        for batcher in self.batchers.values():
+            batcher.stop()
+        for batcher in self.batchers.values():
+            batcher.join()
+        for connection in connections.values():
+            connection.close()
+        for listener in self._listeners:
+            listener.close()
+        if self._unix_path is not None:
+            os.unlink(self._unix_path)
+        print("Stopped inference server")
+
+
+def main():
+    from . import client
+    from . import frozen
+    from . import models
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', default='hands_RH,head,arm_left,arm_right',
+                        help='Comma separated models to serve, among {}'.format(", ".join(sorted(models.loaders))))
+    parser.add_argument('--max-batch', type=int, default=8, help='Largest number of samples run at once')
+    parser.add_argument('--max-delay-ms', type=float, default=2.0,
+                        help='Time a request may wait for the requests of other recognizers to be batched with')
+    parser.add_argument('--host', default='localhost', help='Address to listen on for TCP clients')
+    parser.add_argument('--unix', default=client.default_unix_path,
+                        help='Path of the Unix socket to listen on, empty for TCP only')
+    parser.add_argument('--cpu', action='store_true', default=False, help='Run the models on the CPU only')
+    parser.add_argument('--gpu-memory-fraction', type=float, default=None,
+                        help='Fraction of the GPU memory used by all the models, by default allocated as needed')
+    parser.add_argument('--frozen', nargs='?', default=None, const=frozen.default_directory,
+                        help='Load the frozen models exported by components.inference.export, from this directory or '
+                             '{}, rather than the checkpoints'.format(frozen.default_directory))
+    metrics.add_arguments(parser)
+    startup_conf.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.from_arguments("inference_server", args)
+
+    config = models.session_config(args.gpu_memory_fraction, args.cpu)
+    # The models load concurrently, each in its own graph
+    startup = startup_conf.from_arguments("inference_server", args)
+    tasks = {}
+    for name in args.models.split(','):
+        tasks[name] = startup.task(name, models.load, name, config, args.max_batch, args.frozen)
+        if startup.warm_up_models:
+            tasks[name] = startup.task(name + " warm-up", models.warm_up, tasks[name])
+    startup.wait()
+    served = {name: task.result() for name, task in tasks.items()}
+
+    server = InferenceServer(served, args.max_delay_ms / 1000, args.host, args.unix or None)
+    server.start()
+    try:
+        while server.is_alive():
+            server.join(1)
+    except KeyboardInterrupt:
+        server.stop()
+        server.join()
+
+
+if __name__ == '__main__':
+    main()
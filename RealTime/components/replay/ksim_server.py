@@ -0,0 +1,188 @@
+import argparse
+import socket
+import struct
+import threading
+import time
+
+from ..fusion.conf import streams
+from ..fusion.conf.endpoints import serve
+from ..fusion.conf.reader import FrameReader
+from .recording import RecordingReader, ticks_per_second
+
+_frame_size = struct.Struct("<i")
+_timestamp = struct.Struct("<q")
+
+
+class _Client:
+    __slots__ = ('sock', 'addr', 'frame_types', 'sent')
+
+    def __init__(self, sock, addr, frame_types):
+        self.sock = sock
+        self.addr = addr
+        self.frame_types = frame_types
+        self.sent = 0
+
+
+class ReplayServer(threading.Thread):
+    """
+    Replays a recording to recognizers, speaking the protocol of the Kinect server (KSIM) on the kinect port.
+    Frames received together by the recorder, i.e. with the same timestamp, form a tick. Like KSIM, a client gets the
+    frames of a tick it subscribed to in increasing order of frame type, and none if one of them is missing.
+    Every client gets every tick, so a slow client slows the replay down instead of missing frames.
+    """
+
+    def __init__(self, path, speed=1.0, loop=False, clients=1):
+        """
+        :param path: Path of the recording
+        :param speed: Replay speed relative to the recording, None to replay as fast as the clients read
+        :param loop: True to replay forever, timestamps keep increasing across repetitions
+        :param clients: Number of clients to wait for before starting the replay
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.min_clients = clients
+        self._recording = RecordingReader(path)
+        self._clients = []
+        self._stop_event = threading.Event()
+        self.ticks = 0
+
+    def stop(self):
+        self._stop_event.set()
+
+    def is_stopped(self):
+        return self._stop_event.is_set()
+
+    def _accept(self, serv_sock):
+        """
+        Register the clients waiting to connect, without blocking
+        """
+        while True:
+            try:
+                sock, addr = serv_sock.accept()
+            except (BlockingIOError, socket.timeout):
+                return
+            sock.setblocking(True)
+            # Registration: client type (byte) | requested frame types (int)
+            sock.settimeout(1.0)
+            try:
+                client_type, requested = struct.unpack_from("<Bi", FrameReader(sock, size=64).read_frame())
+            except (socket.error, EOFError, struct.error):
+                print("Unable to receive registration data. Ignoring the client")
+                sock.close()
+                continue
+            sock.settimeout(None)
+
+            frame_types = frozenset(1 << bit for bit in range(31) if requested & (1 << bit))
+            missing = frame_types - self._recording.frame_types
+            if client_type != 1 or len(frame_types) == 0 or len(missing) > 0:
+                print("Rejecting {}:{}, requested frame types {} but recorded {}".format(
+                    addr[0], addr[1], sorted(frame_types), sorted(self._recording.frame_types)))
+                sock.close()
+                continue
+
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            print("Accepted {}:{} for {}".format(addr[0], addr[1], ", ".join(
+                streams.get_stream_name(t) if streams.is_valid_id(t) else str(t) for t in sorted(frame_types))))
+            self._clients.append(_Client(sock, addr, frame_types))
+
+    def _ticks(self):
+        """
+        :return: generator of (arrival time, frames by frame type) for every tick of the recording, repeated if looping
+        """
+        timestamp_offset = arrival_offset = 0
+        while True:
+            ticks = []
+            tick, tick_timestamp = {}, None
+            for record in self._recording.records():
+                if record.timestamp != tick_timestamp:
+                    if len(tick) > 0:
+                        yield ticks[-1][1] + arrival_offset, tick
+                    tick, tick_timestamp = {}, record.timestamp
+                    ticks.append((record.timestamp, record.arrival))
+                frame = record.frame
+                if timestamp_offset != 0:
+                    frame = bytearray(frame)
+                    _timestamp.pack_into(frame, 0, record.timestamp + timestamp_offset)
+                tick[record.frame_type] = frame
+            if len(tick) > 0:
+                yield ticks[-1][1] + arrival_offset, tick
+            if not self.loop or len(ticks) == 0:
+                return
+            # The next repetition starts one average tick period after the last tick
+            (first_timestamp, first_arrival), (last_timestamp, last_arrival) = ticks[0], ticks[-1]
+            periods = max(1, len(ticks) - 1)
+            timestamp_offset += last_timestamp - first_timestamp + (last_timestamp - first_timestamp) // periods
+            arrival_offset += last_arrival - first_arrival + (last_arrival - first_arrival) // periods
+
+    def _send(self, tick):
+        for client in list(self._clients):
+            if not client.frame_types <= tick.keys():
+                continue
+            data = b''.join(_frame_size.pack(len(tick[t])) + tick[t] for t in sorted(client.frame_types))
+            try:
+                client.sock.sendall(data)
+                client.sent += 1
+            except socket.error:
+                print("Client {}:{} disconnected after {} ticks".format(client.addr[0], client.addr[1], client.sent))
+                self._clients.remove(client)
+                client.sock.close()
+
+    def run(self):
+        serv_sock = serve('kinect')
+        serv_sock.listen(5)
+        serv_sock.settimeout(0.1)
+
+        print("Replaying {} frames of {}, {:.1f} s, at {}".format(
+            len(self._recording), self.path, self._recording.duration(),
+            "max speed" if self.speed is None else "{:g}x".format(self.speed)))
+        print("Waiting for {} client{} to connect".format(self.min_clients, "s" if self.min_clients > 1 else ""))
+        while len(self._clients) < self.min_clients and not self.is_stopped():
+            self._accept(serv_sock)
+        serv_sock.setblocking(False)
+
+        start = first_arrival = None
+        for arrival, tick in self._ticks():
+            if self.is_stopped():
+                break
+            self._accept(serv_sock)
+            if start is None:
+                start, first_arrival = time.perf_counter(), arrival
+            if self.speed is not None:
+                delay = start + (arrival - first_arrival) / ticks_per_second / self.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            self._send(tick)
+            self.ticks += 1
+
+        elapsed = time.perf_counter() - start if start is not None else 0.0
+        print("Replayed {} ticks in {:.1f} s, {:.1f} ticks/s".format(self.ticks, elapsed,
+                                                                   self.ticks / elapsed if elapsed > 0 else 0.0))
+        for client in self._clients:
+            client.sock.close()
+        serv_sock.close()
+        self._recording.close()
+        self._stop_event.set()
+
+
+if __name__ == '__main__':
+    # Stands in for KSIM.exe on port 8000, replaying a recording made with components.replay.recorder
+    # Run as: python -m components.replay.ksim_server session.krec [--speed N | --max-speed] [--loop]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('recording', help='Path of the recording')
+    parser.add_argument('--speed', help='Replay speed relative to the recording', type=float, default=1.0)
+    parser.add_argument('--max-speed', help='Replay as fast as the clients read', action='store_true', default=False)
+    parser.add_argument('--loop', help='Replay forever', action='store_true', default=False)
+    parser.add_argument('--clients', help='Number of clients to wait for before starting', type=int, default=1)
+    args = parser.parse_args()
+
+    server = ReplayServer(args.recording, None if args.max_speed else args.speed, args.loop, args.clients)
+    server.start()
+    try:
+        while not server.is_stopped():
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        server.stop()
+        time.sleep(0.2)
@@ -0,0 +1,81 @@
+import argparse
+import struct
+import socket
+import sys
+import time
+
+from ..fusion.conf import streams
+from ..fusion.conf.endpoints import connect
+from ..fusion.conf.reader import FrameReader
+from .recording import RecordingWriter
+
+
+class TapReader:
+    """
+    Wraps the FrameReader of a connection to the Kinect server, so that every frame returned by read_frame() is
+    also appended to a recording. Can be passed to decode.read_frame() in place of the FrameReader.
+    """
+
+    def __init__(self, reader, writer, frame_types=None):
+        """
+        :param reader: FrameReader connected to the Kinect server
+        :param writer: RecordingWriter
+        :param frame_types: Frame types to record, None to record all of them
+        """
+        self.reader = reader
+        self.writer = writer
+        self.frame_types = frame_types
+
+    def read_frame(self):
+        frame = self.reader.read_frame()
+        # Timestamp (long long) | frame type (int)
+        if self.frame_types is None or struct.unpack_from("<i", frame, 8)[0] in self.frame_types:
+            self.writer.append(frame)
+        return frame
+
+    def recv(self, size):
+        return self.reader.recv(size)
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def close(self):
+        self.reader.close()
+
+
+if __name__ == '__main__':
+    # Records the frames of the Kinect server, to be replayed with components.replay.ksim_server
+    # Run as: python -m components.replay.recorder --streams Body LH RH --output session.krec
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--kinect-host', help='Host name of the machine running Kinect Server', default='127.0.0.1')
+    parser.add_argument('--streams', help='Streams to record', nargs='+', default=["Body", "LH", "RH"],
+                        choices=sorted(streams.get_stream_names()))
+    parser.add_argument('--output', help='Path of the recording, which must not exist', required=True)
+    parser.add_argument('--duration', help='Seconds to record, until interrupted by default', type=float, default=None)
+    args = parser.parse_args()
+
+    kinect_socket = connect('kinect', args.kinect_host, args.streams)
+    if kinect_socket is None:
+        sys.exit(1)
+
+    writer = RecordingWriter(args.output)
+    tap = TapReader(FrameReader(kinect_socket), writer)
+    print("Recording {} to {}, press Ctrl+C to stop".format(", ".join(args.streams), args.output))
+
+    start_time = time.time()
+    frame_count = 0
+    try:
+        while args.duration is None or time.time() - start_time < args.duration:
+            tap.read_frame()
+            frame_count += 1
+            if frame_count % (100 * len(args.streams)) == 0:
+                print("{} frames, {:.1f} s".format(frame_count, time.time() - start_time))
+    except KeyboardInterrupt:
+        pass
+    except (socket.error, EOFError) as ex:
+        print("Connection to the Kinect server lost: {}".format(ex))
+    finally:
+        writer.close()
+        kinect_socket.close()
+
+    print("Recorded {} frames in {:.1f} s".format(len(writer), time.time() - start_time))
@@ -0,0 +1,214 @@
+import os
+import struct
+import time
+from collections import namedtuple
+
+# Recording of the frames sent by the Kinect server, as received by the recognizers
+# magic (4s) | version (int)
+# records, appended while recording:
+#   size (int) | arrival time (long long, ticks) | frame (size bytes: timestamp, frame type, content and tail)
+# index, appended when the recording is closed:
+#   (offset of the record (long long) | timestamp (long long) | frame type (int)) * count
+# trailer: index offset (long long) | count (int) | magic (4s)
+# A recording which was not closed, e.g. after a crash, has no index and is indexed by scanning its records
+_magic = b"KREC"
+_index_magic = b"KIDX"
+_version = 1
+_file_header = struct.Struct("<4si")
+_record_header = struct.Struct("<iq")
+_frame_header = struct.Struct("<qi")
+_index_entry = struct.Struct("<qqi")
+_trailer = struct.Struct("<qi4s")
+
+ticks_per_second = 10000000
+
+# A recorded frame
+# arrival is the time at which the frame was received, in ticks of a monotonic clock
+# timestamp and frame_type are read from the header of the frame, which is the frame excluding its size field
+Record = namedtuple('Record', ['arrival', 'timestamp', 'frame_type', 'frame'])
+
+# Position of a record in the file
+IndexEntry = namedtuple('IndexEntry', ['offset', 'timestamp', 'frame_type'])
+
+
+def now():
+    """
+    :return: Current time of the monotonic clock used for arrival times, in ticks
+    """
+    return int(time.perf_counter() * 1e7)
+
+
+class RecordingWriter:
+    """
+    Appends frames to a new recording, and writes its index when closed
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the recording, which must not exist
+        """
+        self.path = path
+        self._file = open(path, 'xb')
+        self._file.write(_file_header.pack(_magic, _version))
+        self._index = []
+
+    def append(self, frame, arrival=None):
+        """
+        Append a frame
+        :param frame: Frame as read by FrameReader.read_frame(), excluding its size field
+        :param arrival: Time at which the frame was received in ticks, None for now()
+        """
+        if arrival is None:
+            arrival = now()
+        timestamp, frame_type = _frame_header.unpack_from(frame)
+        self._index.append((self._file.tell(), timestamp, frame_type))
+        self._file.write(_record_header.pack(len(frame), arrival))
+        self._file.write(frame)
+
+    def __len__(self):
+        return len(self._index)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        index_offset = self._file.tell()
+        for entry in self._index:
+            self._file.write(_index_entry.pack(*entry))
+        self._file.write(_trailer.pack(index_offset, len(self._index), _index_magic))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RecordingReader:
+    """
+    Reads a recording, in the order in which the frames were received
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the recording
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        magic, version = _file_header.unpack(self._file.read(_file_header.size))
+        if magic != _magic:
+            raise ValueError("{} is not a recording".format(path))
+        if version != _version:
+            raise ValueError("Unsupported version of recording {}: {}".format(path, version))
+        self.index = self._read_index()
+        if self.index is None:
+            print("Recording {} was not closed, indexing it".format(path))
+            self.index = self._scan()
+        self.frame_types = frozenset(entry.frame_type for entry in self.index)
+
+    def _read_index(self):
+        size = self._file.seek(0, os.SEEK_END)
+        if size < _file_header.size + _trailer.size:
+            return None
+        self._file.seek(size - _trailer.size)
+        index_offset, count, magic = _trailer.unpack(self._file.read(_trailer.size))
+        if magic != _index_magic or index_offset + count * _index_entry.size + _trailer.size != size:
+            return None
+        self._file.seek(index_offset)
+        data = self._file.read(count * _index_entry.size)
+        self._end = index_offset
+        return [IndexEntry(*entry) for entry in _index_entry.iter_unpack(data)]
+
+    def _scan(self):
+        index = []
+        size = self._file.seek(0, os.SEEK_END)
+        offset = _file_header.size
+        while offset + _record_header.size + _frame_header.size <= size:
+            self._file.seek(offset)
+            frame_size, _ = _record_header.unpack(self._file.read(_record_header.size))
+            if offset + _record_header.size + frame_size > size:
+                # Truncated while being written
+                break
+            timestamp, frame_type = _frame_header.unpack(self._file.read(_frame_header.size))
+            index.append(IndexEntry(offset, timestamp, frame_type))
+            offset += _record_header.size + frame_size
+        self._end = offset
+        return index
+
+    def __len__(self):
+        return len(self.index)
+
+    def duration(self):
+        """
+        :return: Seconds between the arrival of the first and the last frame
+        """
+        if len(self.index) == 0:
+            return 0.0
+        first, last = self.read(0), self.read(len(self.index) - 1)
+        return (last.arrival - first.arrival) / ticks_per_second
+
+    def read(self, i):
+        """
+        :param i: Index of the record
+        :return: Record
+        """
+        entry = self.index[i]
+        self._file.seek(entry.offset)
+        frame_size, arrival = _record_header.unpack(self._file.read(_record_header.size))
+        return Record(arrival, entry.timestamp, entry.frame_type, self._file.read(frame_size))
+
+    def records(self):
+        """
+        :return: generator of all the Records, read sequentially
+        """
+        self._file.seek(_file_header.size)
+        for entry in self.index:
+            frame_size, arrival = _record_header.unpack(self._file.read(_record_header.size))
+            yield Record(arrival, entry.timestamp, entry.frame_type, self._file.read(frame_size))
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == '__main__':
+    # Round trip of a recording, closed and truncated as after a crash
+    # Run as: python -m components.replay.recording
+    import random
+    import tempfile
+
+    rng = random.Random(0)
+    frames = []
+    for i in range(1000):
+        frame_type = rng.choice([4, 32, 64, 128])
+        frames.append((i * 333333, _frame_header.pack(i // 3, frame_type) + bytes(rng.randrange(200))))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "test.krec")
+        with RecordingWriter(path) as writer:
+            for arrival, frame in frames:
+                writer.append(frame, arrival)
+
+        with RecordingReader(path) as reader:
+            assert len(reader) == len(frames)
+            for record, (arrival, frame) in zip(reader.records(), frames):
+                assert record.arrival == arrival and record.frame == frame
+                assert (record.timestamp, record.frame_type) == _frame_header.unpack_from(frame)
+            assert reader.read(500).frame == frames[500][1]
+            print("{} frames, {:.1f} s, frame types {}".format(len(reader), reader.duration(),
+                                                               sorted(reader.frame_types)))
+            end = reader.index[-1].offset
+
+        # Cut in the middle of the last record, and without the index
+        with open(path, 'r+b') as f:
+            f.truncate(end + 10)
+        with RecordingReader(path) as reader:
+            assert len(reader) == len(frames) - 1
+            assert [record.frame for record in reader.records()] == [frame for _, frame in frames[:-1]]
+    print("Round trips OK")
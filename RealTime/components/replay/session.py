@@ -0,0 +1,561 @@
+import ast
+import os
+import queue
+import struct
+import threading
+
+import numpy as np
+
+from components.fusion.conf import postures
+from components.fusion.thread_sync import RingQueue
+from components.fusion.conf import decode
+from components.replay.recording import RecordingReader, now
+
+# A session is a directory holding one pair of files per channel, e.g. the depth crops of the left hand, the skeleton
+# frames or the outputs of a recognizer.
+# <channel>.dat: records of fixed size, which can be mapped with np.memmap() and sliced without reading them
+#   magic (4s) | version (int) | data offset (int) | dtype length (int) | dtype (repr of numpy dtype.descr, utf-8)
+#   padding up to the data offset, then the records, every record starts with timestamp (long long) | arrival (long long)
+# <channel>.idx: timestamps of the records (long long), contiguous so that seeking by timestamp is a binary search
+# touching O(log n) pages
+# Timestamps of a channel never decrease. The number of records is given by the index, which is written after the
+# records, so a session which was not closed, e.g. after a crash, is readable up to its last indexed record.
+_magic = b"KSES"
+_version = 1
+_file_header = struct.Struct("<4siii")
+_alignment = 64
+_data_suffix = ".dat"
+_index_suffix = ".idx"
+_timestamp = np.dtype("<i8")
+
+# Depth crops are stored in blocks of crop_size x crop_size pixels, padded with zeros
+# KSIM crops 396 mm around the joint, which is about 230 pixels at the minimum depth of the Kinect
+crop_size = 256
+joint_count = 25
+
+
+def crop_dtype(size=crop_size):
+    """
+    :param size: Size of the blocks the crops are stored in, larger crops are clipped
+    :return: dtype of the records of depth crops, width and height are the ones of the crop before clipping
+    """
+    return np.dtype([('timestamp', '<i8'), ('arrival', '<i8'), ('width', '<i4'), ('height', '<i4'),
+                     ('pos_x', '<f4'), ('pos_y', '<f4'), ('depth', '<u2', (size, size))])
+
+
+# Skeleton of the closest body, as sent by KSIM, all zeros when no body is engaged
+skeleton_dtype = np.dtype([('timestamp', '<i8'), ('arrival', '<i8'), ('tracked_count', 'u1'), ('engaged', 'u1'),
+                           ('tracking_id', '<u8'),
+                           # Left hand confidence, left hand state, right hand confidence, right hand state
+                           ('hand_states', 'u1', (4,)),
+                           ('joint_type', 'u1', (joint_count,)), ('tracking_state', 'u1', (joint_count,)),
+                           ('position', '<f4', (joint_count, 3)),
+                           # W, X, Y, Z
+                           ('orientation', '<f4', (joint_count, 4))])
+
+
+def _posture_dtype(index_name, count):
+    return np.dtype([('timestamp', '<i8'), ('arrival', '<i8'), (index_name, '<i4'), ('probabilities', '<f4', (count,))])
+
+
+# Outputs of the recognizers, as synced by fusion
+output_dtypes = {
+    "LH": _posture_dtype('idx_hand', len(postures.left_hand_postures)),
+    "RH": _posture_dtype('idx_hand', len(postures.right_hand_postures)),
+    "Head": _posture_dtype('idx_head', len(postures.head_postures)),
+    # Points are x, y, var_x, var_y
+    "Body": np.dtype([('timestamp', '<i8'), ('arrival', '<i8'), ('idx_l_arm', '<i4'), ('idx_r_arm', '<i4'),
+                      ('point_l', '<f4', (4,)), ('point_r', '<f4', (4,)),
+                      ('p_l_arm', '<f4', (8,)), ('p_r_arm', '<f4', (8,)), ('engaged', 'u1')]),
+    # Commands longer than the field are truncated
+    "Speech": np.dtype([('timestamp', '<i8'), ('arrival', '<i8'), ('command', 'S128')]),
+    "Emotion": np.dtype([('timestamp', '<i8'), ('arrival', '<i8'), ('attentive', '<i4'), ('probabilities', '<f4', (1,))]),
+}
+
+# Channels of the frames sent by KSIM, by frame type
+frame_channels = {32: "Skeleton", 64: "LHDepth", 128: "RHDepth", 256: "HeadDepth"}
+
+
+def _fill_crop(records, i, content):
+    # (width, height, pos_x, pos_y, depth_data) as decoded by decode.decode_content_depth()
+    width, height, posx, posy, depth_data = content
+    records['width'][i], records['height'][i] = width, height
+    records['pos_x'][i], records['pos_y'][i] = posx, posy
+    depth = records['depth'][i]
+    h, w = min(height, depth.shape[0]), min(width, depth.shape[1])
+    depth[h:, :] = 0
+    depth[:h, w:] = 0
+    depth[:h, :w] = np.asarray(depth_data).reshape((height, width))[:h, :w]
+
+
+def _fill_skeleton(records, i, content):
+    # (tracked body count, engaged, frame pieces) as decoded by skeleton_client.decode_content()
+    tracked_count, engaged, pieces = content
+    record = records[i:i + 1]
+    record[...] = 0
+    records['tracked_count'][i], records['engaged'][i] = tracked_count, engaged
+    if engaged:
+        records['tracking_id'][i] = pieces[0]
+        records['hand_states'][i] = pieces[1:5]
+        joints = np.array(pieces[5:5 + 9 * joint_count], dtype=np.float64).reshape((joint_count, 9))
+        records['joint_type'][i] = joints[:, 0]
+        records['tracking_state'][i] = joints[:, 1]
+        records['position'][i] = joints[:, 2:5]
+        records['orientation'][i] = joints[:, 5:9]
+
+
+def _fill_posture(index_name):
+    def fill(records, i, data):
+        records[index_name][i] = getattr(data, index_name)
+        records['probabilities'][i] = data.probabilities
+    return fill
+
+
+def _fill_body(records, i, data):
+    records['idx_l_arm'][i], records['idx_r_arm'][i] = data.idx_l_arm, data.idx_r_arm
+    records['point_l'][i] = (data.pos_l_x, data.pos_l_y, data.var_l_x, data.var_l_y)
+    records['point_r'][i] = (data.pos_r_x, data.pos_r_y, data.var_r_x, data.var_r_y)
+    records['p_l_arm'][i], records['p_r_arm'][i] = data.p_l_arm, data.p_r_arm
+    records['engaged'][i] = data.engaged
+
+
+def _fill_speech(records, i, data):
+    records['command'][i] = data.command.encode('ascii')
+
+
+def _fill_emotion(records, i, data):
+    records['attentive'][i] = data.attentive
+    records['probabilities'][i] = data.probabilities
+
+
+# dtype and function filling a record from the content appended to the channel
+_channels = {
+    "LHDepth": (crop_dtype(), _fill_crop),
+    "RHDepth": (crop_dtype(), _fill_crop),
+    "HeadDepth": (crop_dtype(), _fill_crop),
+    "Skeleton": (skeleton_dtype, _fill_skeleton),
+    "LH": (output_dtypes["LH"], _fill_posture('idx_hand')),
+    "RH": (output_dtypes["RH"], _fill_posture('idx_hand')),
+    "Head": (output_dtypes["Head"], _fill_posture('idx_head')),
+    "Body": (output_dtypes["Body"], _fill_body),
+    "Speech": (output_dtypes["Speech"], _fill_speech),
+    "Emotion": (output_dtypes["Emotion"], _fill_emotion),
+}
+
+
+def crop(record):
+    """
+    :param record: Record of a depth crop channel
+    :return: view of the depth pixels of the crop, clipped to the size of the block
+    """
+    return record['depth'][:record['height'], :record['width']]
+
+
+class _ChannelWriter:
+    """
+    Buffers the records of a channel into a block, written to its files when full or flushed
+    """
+
+    def __init__(self, directory, name, dtype, fill, block_size):
+        self.name = name
+        self.fill = fill
+        self._data = open(os.path.join(directory, name + _data_suffix), 'xb')
+        self._index = open(os.path.join(directory, name + _index_suffix), 'xb')
+        descr = repr(dtype.descr).encode('utf-8')
+        data_offset = -(-(_file_header.size + len(descr)) // _alignment) * _alignment
+        self._data.write(_file_header.pack(_magic, _version, data_offset, len(descr)) + descr)
+        self._data.write(bytes(data_offset - self._data.tell()))
+        self._records = np.zeros(max(1, block_size // dtype.itemsize), dtype=dtype)
+        self._count = 0
+        self.last_timestamp = None
+        self.written = 0
+        self.out_of_order = 0
+
+    def append(self, timestamp, arrival, content):
+        if self.last_timestamp is not None and timestamp < self.last_timestamp:
+            self.out_of_order += 1
+            return
+        self.last_timestamp = timestamp
+        i = self._count
+        self._records['timestamp'][i], self._records['arrival'][i] = timestamp, arrival
+        self.fill(self._records, i, content)
+        self._count += 1
+        if self._count == len(self._records):
+            self.flush()
+
+    def flush(self):
+        if self._count > 0:
+            # Records first, so that the index never points past them
+            self._data.write(self._records[:self._count])
+            self._data.flush()
+            self._index.write(np.ascontiguousarray(self._records['timestamp'][:self._count]))
+            self._index.flush()
+            self.written += self._count
+            self._count = 0
+
+    def close(self):
+        self.flush()
+        self._data.close()
+        self._index.close()
+
+
+class SessionWriter(threading.Thread):
+    """
+    Writes a new session from a background thread.
+    append() only queues the content, which is converted to records and written by the thread, so it never blocks the
+    caller. When the thread falls behind, the oldest queued contents are dropped, and counted.
+    """
+
+    def __init__(self, path, capacity=1024, block_size=1 << 20, flush_interval=0.5):
+        """
+        :param path: Path of the session directory, which must not exist
+        :param capacity: Number of contents queued before dropping the oldest ones
+        :param block_size: Bytes of records of a channel buffered before writing them
+        :param flush_interval: Seconds after which idle buffered records are written
+        """
+        threading.Thread.__init__(self, name="SessionWriter")
+        self.path = path
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        os.makedirs(path)
+        self._queue = RingQueue(capacity)
+        self._channels = {}
+        self._stop_event = threading.Event()
+        self.daemon = True
+        self.start()
+
+    def append(self, channel, timestamp, content, arrival=None):
+        """
+        Queue a record
+        :param channel: Name of the channel, e.g. "LHDepth", "Skeleton" or the name of a recognizer stream
+        :param timestamp: Timestamp of the record, timestamps of a channel must not decrease
+        :param content: Content of the record, as decoded by the recognizers or fusion, e.g. the data of a
+        Fusion.Message. It is used after append() returns, so it must not be a view of a buffer which is reused.
+        :param arrival: Time at which the content was received in ticks, None for now()
+        """
+        if channel not in _channels:
+            raise ValueError("Invalid session channel: {}".format(channel))
+        self._queue.put((channel, timestamp, now() if arrival is None else arrival, content))
+
+    def append_synced(self, synced_msgs):
+        """
+        Queue the outputs of the recognizers synced by fusion
+        :param synced_msgs: dict of Fusion.Message by stream name
+        """
+        arrival = now()
+        for name, msg in synced_msgs.items():
+            self.append(name, msg.header.timestamp, msg.data, arrival)
+
+    def _write(self, channel, timestamp, arrival, content):
+        writer = self._channels.get(channel)
+        if writer is None:
+            dtype, fill = _channels[channel]
+            writer = self._channels[channel] = _ChannelWriter(self.path, channel, dtype, fill, self.block_size)
+        writer.append(timestamp, arrival, content)
+
+    def run(self):
+        while True:
+            try:
+                self._write(*self._queue.get(True, self.flush_interval))
+                continue
+            except queue.Empty:
+                pass
+            for writer in self._channels.values():
+                writer.flush()
+            if self._stop_event.is_set():
+                break
+        for writer in self._channels.values():
+            writer.close()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def is_stopped(self):
+        return self._stop_event.is_set()
+
+    def close(self):
+        """
+        Write the queued records, close the files and print a summary
+        """
+        self.stop()
+        self.join()
+        for writer in self._channels.values():
+            if writer.out_of_order > 0:
+                print("Session channel {}: dropped {} records older than the previous one".format(
+                    writer.name, writer.out_of_order))
+        stats = self._queue.stats()
+        print("Session {}: {} records in {} channels, {} dropped because the writer fell behind".format(
+            self.path, sum(writer.written for writer in self._channels.values()), len(self._channels),
+            stats.dropped))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SessionReader:
+    """
+    Maps the channels of a session, without reading them.
+    The records of a channel are a read-only structured np.memmap, e.g. reader["Body"]['p_l_arm'][1000:2000]
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the session directory
+        """
+        self.path = path
+        self.channels = sorted(name[:-len(_data_suffix)] for name in os.listdir(path) if name.endswith(_data_suffix))
+        self._records = {}
+        self._timestamps = {}
+        for name in self.channels:
+            self._open(name)
+
+    def _open(self, name):
+        data_path = os.path.join(self.path, name + _data_suffix)
+        with open(data_path, 'rb') as f:
+            magic, version, data_offset, descr_length = _file_header.unpack(f.read(_file_header.size))
+            if magic != _magic:
+                raise ValueError("{} is not a session channel".format(data_path))
+            if version != _version:
+                raise ValueError("Unsupported version of session channel {}: {}".format(data_path, version))
+            dtype = np.dtype(ast.literal_eval(f.read(descr_length).decode('utf-8')))
+            data_size = f.seek(0, os.SEEK_END)
+        index_path = os.path.join(self.path, name + _index_suffix)
+        count = min(os.path.getsize(index_path) // _timestamp.itemsize, (data_size - data_offset) // dtype.itemsize)
+        if count == 0:
+            # Files of size 0 cannot be mapped
+            self._records[name] = np.zeros(0, dtype=dtype)
+            self._timestamps[name] = np.zeros(0, dtype=_timestamp)
+        else:
+            self._records[name] = np.memmap(data_path, dtype=dtype, mode='r', offset=data_offset, shape=(count,))
+            self._timestamps[name] = np.memmap(index_path, dtype=_timestamp, mode='r', shape=(count,))
+
+    def __getitem__(self, channel):
+        """
+        :return: np.memmap of the records of the channel
+        """
+        return self._records[channel]
+
+    def __contains__(self, channel):
+        return channel in self._records
+
+    def __len__(self):
+        return len(self.channels)
+
+    def timestamps(self, channel):
+        """
+        :return: np.memmap of the timestamps of the channel
+        """
+        return self._timestamps[channel]
+
+    def seek(self, channel, timestamp):
+        """
+        Binary search of the index, O(log n)
+        :return: index of the first record of the channel with a timestamp at or after timestamp
+        """
+        return int(np.searchsorted(self._timestamps[channel], timestamp, side='left'))
+
+    def between(self, channel, start, end):
+        """
+        :return: np.memmap of the records of the channel with a timestamp in [start, end)
+        """
+        return self._records[channel][self.seek(channel, start):self.seek(channel, end)]
+
+    def latest(self, channel, timestamp):
+        """
+        :return: the last record of the channel with a timestamp at or before timestamp, None if there is none
+        """
+        i = int(np.searchsorted(self._timestamps[channel], timestamp, side='right'))
+        return self._records[channel][i - 1] if i > 0 else None
+
+    def close(self):
+        # Mappings are released once the arrays viewing them are
+        self._records.clear()
+        self._timestamps.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_skeleton_content = struct.Struct("<BB")
+_skeleton_body = struct.Struct("<Q4B" + "BB7f" * joint_count)
+
+
+def _decode_skeleton(raw_frame, offset):
+    # Same layout as skeleton_client.decode_content(), without depending on the arm motion recognizers
+    tracked_count, engaged = _skeleton_content.unpack_from(raw_frame, offset)
+    pieces = _skeleton_body.unpack_from(raw_frame, offset + _skeleton_content.size) if engaged else ()
+    return (tracked_count, engaged, pieces)
+
+
+def from_recording(recording_path, session_path, **writer_options):
+    """
+    Convert the depth crops and skeleton frames of a recording made by the recorder into a session
+    :param writer_options: Keyword arguments of the SessionWriter
+    :return: dict of the number of records by channel
+    """
+    counts = {}
+    # Conversion is offline, the writer must not drop anything
+    writer_options.setdefault('capacity', 1 << 30)
+    with RecordingReader(recording_path) as reader, SessionWriter(session_path, **writer_options) as writer:
+        for record in reader.records():
+            channel = frame_channels.get(record.frame_type)
+            if channel is None:
+                continue
+            (timestamp, frame_type), offset = decode._decode_header(record.frame)
+            if channel == "Skeleton":
+                content = _decode_skeleton(record.frame, offset)
+            else:
+                content, _ = decode.decode_content_depth(record.frame, offset)
+            writer.append(channel, timestamp, content, record.arrival)
+            counts[channel] = counts.get(channel, 0) + 1
+    return counts
+
+
+if __name__ == '__main__':
+    # Converts a recording into a session, or, without arguments, checks round trips and benchmarks writing, slicing
+    # and seeking
+    # Run as: python -m components.replay.session [--recording R.krec --output SESSION]
+    import argparse
+    import random
+    import shutil
+    import tempfile
+    import time
+
+    from components.fusion.fusion_thread import Fusion
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--recording', help='recording to convert', type=str)
+    parser.add_argument('--output', help='session directory to create', type=str)
+    parser.add_argument('--records', default=2000000, type=int, help='records of the seek benchmark')
+    args = parser.parse_args()
+
+    if args.recording is not None:
+        if args.output is None:
+            parser.error("--output is required with --recording")
+        start = time.perf_counter()
+        counts = from_recording(args.recording, args.output)
+        print("Converted {} in {:.1f} s: {}".format(args.recording, time.perf_counter() - start, counts))
+    else:
+        rng = random.Random(0)
+        directory = tempfile.mkdtemp()
+        try:
+            # Round trips of every channel
+            path = os.path.join(directory, "check")
+            crops, skeletons, bodies, speeches = [], [], [], []
+            with SessionWriter(path, block_size=1 << 16) as writer:
+                for i in range(300):
+                    width, height = rng.randrange(100, 300), rng.randrange(100, 300)
+                    depth = np.random.randint(0, 4500, size=(height, width)).astype('<u2')
+                    crops.append((width, height, 10.5, 20.5, depth))
+                    writer.append("LHDepth", i * 10, crops[-1])
+                    engaged = i % 5 != 0
+                    pieces = (i, 1, 2, 3, 4) + sum(((j, 2) + tuple(rng.random() for _ in range(7))
+                                                    for j in range(joint_count)), ()) if engaged else ()
+                    skeletons.append((1, int(engaged), pieces))
+                    writer.append("Skeleton", i * 10, skeletons[-1])
+                    probs = tuple(rng.random() for _ in range(8))
+                    bodies.append(Fusion.BodyData(i % 34, 3, *(rng.random() for _ in range(8)),
+                                                  p_l_arm=probs, p_r_arm=probs[::-1], engaged=engaged))
+                    speeches.append(Fusion.SpeechData(rng.choice(["", "yes", "put that there"])))
+                    writer.append_synced({
+                        "Body": Fusion.Message(Fusion.Header(32, i * 10, "Body"), bodies[-1]),
+                        "Speech": Fusion.Message(Fusion.Header(4, i * 10, "Speech"), speeches[-1])})
+                # Out of order, dropped
+                writer.append("Speech", 0, Fusion.SpeechData("late"))
+
+            with SessionReader(path) as reader:
+                assert reader.channels == ["Body", "LHDepth", "Skeleton", "Speech"], reader.channels
+                records = reader["LHDepth"]
+                assert len(records) == len(crops)
+                for record, (width, height, posx, posy, depth) in zip(records, crops):
+                    expected = depth[:crop_size, :crop_size]
+                    assert (record['width'], record['height']) == (width, height)
+                    assert np.array_equal(crop(record), expected)
+                    assert not record['depth'][expected.shape[0]:].any() and not record['depth'][:, expected.shape[1]:].any()
+                for record, (tracked_count, engaged, pieces) in zip(reader["Skeleton"], skeletons):
+                    assert record['engaged'] == engaged
+                    if engaged:
+                        assert record['tracking_id'] == pieces[0]
+                        assert np.allclose(record['position'][7], pieces[5 + 7 * 9 + 2:5 + 7 * 9 + 5])
+                        assert np.allclose(record['orientation'][24], pieces[5 + 24 * 9 + 5:5 + 24 * 9 + 9])
+                    else:
+                        assert not record['position'].any()
+                assert np.allclose(reader["Body"]['p_r_arm'][7], bodies[7].p_r_arm)
+                assert list(reader["Body"]['idx_l_arm']) == [body.idx_l_arm for body in bodies]
+                assert [c.decode('ascii') for c in reader["Speech"]['command']] == [s.command for s in speeches]
+                assert reader.seek("Body", 1000) == 100 and reader.seek("Body", 1001) == 101
+                assert len(reader.between("Body", 1000, 2000)) == 100
+                assert reader.latest("Body", 1009)['timestamp'] == 1000 and reader.latest("Body", -1) is None
+                assert len(reader.between("Body", 10 ** 9, 10 ** 10)) == 0
+
+            # A session which was not closed: an index shorter than the records, and a partial record
+            with open(os.path.join(path, "Body" + _index_suffix), 'r+b') as f:
+                f.truncate(250 * _timestamp.itemsize)
+            with open(os.path.join(path, "Speech" + _data_suffix), 'r+b') as f:
+                f.truncate(f.seek(0, os.SEEK_END) - 3)
+            with SessionReader(path) as reader:
+                assert len(reader["Body"]) == 250 and len(reader["Speech"]) == 299
+            print("Round trips OK")
+
+            # Cost of append() for the caller, against filling and writing the records in the caller's thread
+            count = 3000
+            contents = [crops[i % len(crops)] for i in range(count)]
+            start = time.perf_counter()
+            with SessionWriter(os.path.join(directory, "queued"), capacity=count) as writer:
+                for i, content in enumerate(contents):
+                    writer.append("RHDepth", i, content)
+                queued = time.perf_counter() - start
+            total = time.perf_counter() - start
+            start = time.perf_counter()
+            channel = _ChannelWriter(directory, "inline", *_channels["RHDepth"], block_size=1 << 20)
+            for i, content in enumerate(contents):
+                channel.append(i, 0, content)
+            channel.close()
+            inline = time.perf_counter() - start
+            print("Depth crops: append() {:.1f} us/record, written {:.1f} us/record in the background, "
+                  "{:.1f} us/record inline".format(queued * 1e6 / count, total * 1e6 / count, inline * 1e6 / count))
+
+            # Slicing and seeking a long session: 2M body records is more than 18 hours at 30 Hz
+            path = os.path.join(directory, "long")
+            os.makedirs(path)
+            channel = _ChannelWriter(path, "Body", output_dtypes["Body"], lambda records, i, data: None, 1 << 20)
+            block = np.zeros(100000, dtype=output_dtypes["Body"])
+            for first in range(0, args.records, len(block)):
+                block['timestamp'] = np.arange(first, first + len(block)) * 333333
+                block['p_l_arm'][:, 0] = np.arange(first, first + len(block))
+                channel._data.write(block)
+                channel._index.write(np.ascontiguousarray(block['timestamp']))
+            channel.close()
+            size = os.path.getsize(os.path.join(path, "Body" + _data_suffix))
+
+            start = time.perf_counter()
+            reader = SessionReader(path)
+            opened = time.perf_counter() - start
+            timestamps = reader.timestamps("Body")
+            targets = [rng.randrange(int(timestamps[-1])) for _ in range(10000)]
+            start = time.perf_counter()
+            for target in targets:
+                i = reader.seek("Body", target)
+            seek = time.perf_counter() - start
+            assert reader.seek("Body", timestamps[12345]) == 12345
+            start = time.perf_counter()
+            window = reader.between("Body", timestamps[1000000 % len(timestamps)], timestamps[-1] + 1)[:9000]
+            mean = float(window['p_l_arm'][:, 0].mean())
+            sliced = time.perf_counter() - start
+            assert mean == float(np.arange(1000000 % len(timestamps), 1000000 % len(timestamps) + 9000).mean())
+            start = time.perf_counter()
+            loaded = np.fromfile(os.path.join(path, "Body" + _data_suffix), dtype=np.uint8)
+            load = time.perf_counter() - start
+            del loaded, window, timestamps
+            reader.close()
+            print("{} records, {:.0f} MB: open {:.2f} ms, seek {:.2f} us, 5 min window mean {:.2f} ms, "
+                  "reading the whole file {:.0f} ms".format(args.records, size / 1e6, opened * 1e3,
+                                                            seek * 1e6 / len(targets), sliced * 1e3, load * 1e3))
+        finally:
+            shutil.rmtree(directory)
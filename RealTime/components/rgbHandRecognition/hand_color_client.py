@@ -2,7 +2,6 @@ import argparse
 import socket
 import sys
 import struct
-import time
 import os
 
 import numpy as np
@@ -11,6 +10,8 @@ from skimage.transform import resize
 from .realtime_hand_recognition import RealTimeHandRecognition
 from ..fusion.conf.endpoints import connect
 from ..fusion.conf import streams
+from ..fusion.conf import metrics
+from ..fusion.conf.reader import FrameReader
 
 
 def connect_rgb(hostname, hand):
@@ -67,22 +68,11 @@ def decode_frame_openpose(raw_frame):
     return decoded
 
 
-def recv_all(sock, size):
-    result = b''
-    while len(result) < size:
-        data = sock.recv(size - len(result))
-        if not data:
-            raise EOFError("Error: Received only {} bytes into {} byte message".format(len(data), size))
-        result += data
-    return result
-
-
-def recv_color_frame(sock):
+def recv_color_frame(reader):
     """
     Experimental function to read each stream frame from the server
     """
-    (frame_size,) = struct.unpack("<i", recv_all(sock, 4))
-    return recv_all(sock, frame_size) 
+    return reader.read_frame()
 
 
 if __name__ == '__main__':
@@ -90,8 +80,10 @@ if __name__ == '__main__':
     parser.add_argument('hand', help='Hand to follow', choices=['LH', 'RH'])
     parser.add_argument('kinect_host', help='Host name of the machine running Kinect Server')
     parser.add_argument('--fusion-host', help='Host name of the machine running Kinect Server', default=None)
+    metrics.add_arguments(parser)
 
     hand = sys.argv[1]
+    metrics.from_arguments("hand_color_client_" + hand, parser.parse_args())
     stream_id = streams.get_stream_id(hand)
     FRAME_TYPE = 1 if hand == 'RH' else 0
 
@@ -111,15 +103,19 @@ if __name__ == '__main__':
 
     if s is None:
         sys.exit(0)
+
+    kinect_reader = FrameReader(s)
     
     i = 0
     avg_frame_time = 0.0
 
-    start_time = time.time()
+    frames = metrics.counter("frames")
+    # Printed by the metrics reporter rather than for every frame
+    gesture = metrics.gauge("gesture", hand=hand)
 
     while True:
         try:
-            f = recv_color_frame(s)
+            f = recv_color_frame(kinect_reader)
         except:
             break
 
@@ -131,7 +127,7 @@ if __name__ == '__main__':
             if np.sum(image_rgb) == 0:
                 fusion_probs = [0 for _ in range(33)]
                 fusion_probs[0] = 1
-                print(timestamp, "blind")
+                gesture.set("blind")
 
             else:
                 image_rgb = image_rgb[:,:,[2,1,0]]
@@ -139,7 +135,7 @@ if __name__ == '__main__':
 
                 rgb_max_index, probs = r.classify(image_rgb)
 
-                print(timestamp, gesture_list[rgb_max_index])
+                gesture.set(gesture_list[rgb_max_index])
 
                 fusion_probs = [0 for _ in range(33)]
 
@@ -156,10 +152,7 @@ if __name__ == '__main__':
                 fusion_socket.send(bytes)
 
             i += 1
-
-            if i % 100 == 0:
-                print("=" * 100, "FPS", 100 / (time.time() - start_time))
-                start_time = time.time()
+            frames.inc()
 
     s.close()
     sys.exit(0)
@@ -6,6 +6,11 @@ import tensorflow as tf
 
 slim = tf.contrib.slim
 
+checkpoints = {
+    "RH": "/s/red/a/nobackup/cwc/tf/hands_demo_rgb/RH_fine/model.ckpt-5590",
+    "LH": "/s/red/a/nobackup/cwc/tf/hands_demo_rgb/LH_fine/model.ckpt-40734",
+}
+
 
 class RealTimeHandRecognition():
     def __init__(self, hands, gestures):
@@ -28,10 +33,7 @@ class RealTimeHandRecognition():
 
         self.probabilities_tensor = end_points['predictions']
 
-        if hands == "RH":
-            ckpt = "/s/red/a/nobackup/cwc/tf/hands_demo_rgb/RH_fine/model.ckpt-5590"
-        else:
-            ckpt = "/s/red/a/nobackup/cwc/tf/hands_demo_rgb/LH_fine/model.ckpt-40734"
+        ckpt = checkpoints["RH" if hands == "RH" else "LH"]
 
         print('Loading checkpoint %s' % ckpt)
         saver.restore(sess, ckpt)
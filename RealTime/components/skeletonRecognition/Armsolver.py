@@ -2,6 +2,7 @@ import numpy as np
 from itertools import chain
 from collections import deque
 import os
+import threading
 from ..fusion.conf.postures import left_arm_motions, right_arm_motions
 from .receiveAndShow import Pointing
 
@@ -228,25 +229,91 @@ class Solver(object):
 
 
 
+# Checkpoint and number of hidden units of the LSTM of each arm
+arm_models = {
+    'left': ('./models/body/la/model.ckpt-0', 50),
+    'right': ('./models/body/ra/model.ckpt-0', 75),
+}
+
+
+def load_arm_model(arm, batch_size=1, config=None):
+    """
+    Builds the LSTM of an arm in its own graph and restores it
+    :param arm: 'left' or 'right'
+    :param batch_size: number of sequences the graph recognizes together
+    :param config: tf.ConfigProto of the session, None for the default of a recognizer process
+    :return: RealTimeArmMotionRecognition
+    """
+    from .LSTMSolver import RealTimeArmMotionRecognition
+    from .Models import Arms_LSTM
+
+    import tensorflow as tf
+    path, n_hidden = arm_models[arm]
+    with tf.Graph().as_default():
+        print ('Loading {} arm model'.format(arm.capitalize()))
+        model = Arms_LSTM(logs_path=os.path.abspath(path), n_hidden=n_hidden, n_layers=2, batch_size=batch_size,
+                          config=config)
+    return RealTimeArmMotionRecognition(model)
+
+
+def arm_model(arm, inference=None, shared_memory=False, frozen=None):
+    """
+    Loads the model of an arm
+    :param arm: 'left' or 'right'
+    :param inference: address of the inference server running the arm models, None to load them in this process
+    :param shared_memory: True to send the sequences to the inference server over shared memory
+    :param frozen: directory of the frozen arm models to load in this process, None to load the checkpoints
+    :return: RealTimeArmMotionRecognition
+    """
+    if inference is not None:
+        from .LSTMSolver import RemoteArmMotionRecognition
+        return RemoteArmMotionRecognition(arm, inference, shared_memory)
+    if frozen is not None:
+        from .LSTMSolver import FrozenArmMotionRecognition
+        return FrozenArmMotionRecognition(arm, frozen)
+    return load_arm_model(arm)
+
+
+def load_arm_models(inference=None, shared_memory=False, frozen=None):
+    """
+    Loads the models of both arms concurrently, each in its own graph, see arm_model()
+    :return: (left, right) models
+    """
+    models = {}
+
+    def load(arm):
+        models[arm] = arm_model(arm, inference, shared_memory, frozen)
+
+    left = threading.Thread(target=load, args=('left',), name="Load left arm")
+    left.start()
+    load('right')
+    left.join()
+    if 'left' not in models:
+        raise RuntimeError("Unable to load the left arm model")
+    return models['left'], models['right']
+
+
 class ArmMotionRecogntion(Solver):
-    def __init__(self, pointing_mode):
+    def __init__(self, pointing_mode, inference=None, shared_memory=False, frozen=None, loaded_models=None):
+        """
+        :param pointing_mode: see Solver
+        :param inference: address of the inference server running the arm models, None to load them in this process
+        :param shared_memory: True to send the sequences to the inference server over shared memory
+        :param frozen: directory of the frozen arm models to load in this process, None to load the checkpoints
+        :param loaded_models: (left, right) models already loaded, e.g. by arm_model() during the startup of the
+        client; None to load them, see load_arm_models()
+        """
         super(ArmMotionRecogntion, self).__init__(pointing_mode=pointing_mode)
-        from .LSTMSolver import RealTimeArmMotionRecognition
-        from .Models import Arms_LSTM
-
-        import tensorflow as tf
-        g1 = tf.Graph()
-        with g1.as_default():
-            print ('Loading Left arm model')
-            model_left = Arms_LSTM(logs_path=os.path.abspath('./models/body/la/model.ckpt-0'), n_hidden=50, n_layers=2)
-        self._left_arm_model = RealTimeArmMotionRecognition(model_left)
-
-
-        g2 = tf.Graph()
-        with g2.as_default():
-            print ('Loading Right arm model')
-            model_right = Arms_LSTM(logs_path=os.path.abspath('./models/body/ra/model.ckpt-0'), n_hidden=75, n_layers=2)
-        self._right_arm_model = RealTimeArmMotionRecognition(model_right)
+        if loaded_models is None:
+            loaded_models = load_arm_models(inference, shared_memory, frozen)
+        self._left_arm_model, self._right_arm_model = loaded_models
+
+    def warm_up(self):
+        """
+        Runs both arm models on blank sequences, see RealTimeArmMotionRecognition.warm_up()
+        """
+        self._left_arm_model.warm_up()
+        self._right_arm_model.warm_up()
 
 
     def prune_joints(self, data, body_part):
@@ -1,10 +1,14 @@
 import numpy as np
 import os
 
+from components.inference.client import InferenceClient
+from components.inference.frozen import FrozenModel
+
+
 class RealTimeArmMotionRecognition(object):
     def __init__(self, model):
         self.n_classes = 8
-        self.batch_size = 1
+        self.batch_size = model.batch_size
         self.feature_size = 15
         self.model = model
         self.classes = np.load(os.path.abspath('./data/labels_body.npy'))
@@ -49,6 +53,36 @@ class RealTimeArmMotionRecognition(object):
         return velocity
 
 
+    def run(self, x_data):
+        """
+        Runs the model on a batch of sequences
+        :param x_data: (n, frames, features) normalized sequences, n is at most the batch size of the model
+        :return: (n, classes) probabilities
+        """
+        n, n_frames = x_data.shape[:2]
+        if n < self.batch_size:
+            # The graph has a fixed batch size
+            x_data = np.concatenate((x_data, np.zeros((self.batch_size - n,) + x_data.shape[1:], x_data.dtype)))
+
+        probs = self._run_batch(x_data, [n_frames] * self.batch_size)
+        return probs[:n]
+
+    def _run_batch(self, x_data, n_frames):
+        """
+        :param x_data: (batch size, frames, features) sequences
+        :param n_frames: length of each sequence
+        :return: (batch size, classes) probabilities
+        """
+        return self.model.sess.run(
+            self.model.probabilities,
+            feed_dict={self.model.x: x_data, self.model.n_frames: n_frames, self.model.keep_prob: 1.0})
+
+    def warm_up(self):
+        """
+        Runs the model on a blank sequence, for the first frame not to pay for the initialization of the graph
+        """
+        self.run(np.zeros((1, 15, self.feature_size), dtype=np.float32))
+
     def predict(self, data):
         data = data[:, [i for i in range(1, 24) if i % 4 != 0]]
         normalized_data = self.normalize_data(data, verbose=False)
@@ -56,15 +90,7 @@ class RealTimeArmMotionRecognition(object):
         assert normalized_data.shape==(15, 15)
 
         x_data = np.array(normalized_data)
-        n_frames = x_data.shape[0]
-
-        n_frame_batch = [n_frames] * self.batch_size
-
-        x_data = [x_data for _ in range(self.batch_size)]
-
-        pred_val, probs = self.model.sess.run(
-            [self.model.predicted_values, self.model.probabilities],
-            feed_dict={self.model.x: x_data, self.model.n_frames: n_frame_batch,self.model.keep_prob: 1.0})
+        probs = self.run(x_data[np.newaxis])
 
         # print ('Predicted value before smoothing: ', pred_val)
         # print ('Probability before: ', probs[0])
@@ -78,3 +104,51 @@ class RealTimeArmMotionRecognition(object):
         # print ('Predicted value after smoothing; ', pred_val)
         # print ('Probability after: ', self._past_probs)
         return self.classes[pred_val], self._past_probs
+
+
+class RemoteArmMotionRecognition(RealTimeArmMotionRecognition):
+    """
+    Recognizes the motion of an arm with the model loaded by the inference server, see components.inference.server
+    """
+    def __init__(self, arm, address=None, shared_memory=False):
+        """
+        :param arm: 'left' or 'right', the server serves the model as arm_<arm>
+        :param address: address of the inference server, see InferenceClient
+        :param shared_memory: True to send the sequences over shared memory
+        """
+        self.n_classes = 8
+        self.feature_size = 15
+        self.client = InferenceClient("arm_" + arm, address, shared_memory)
+        self.classes = np.load(os.path.abspath('./data/labels_body.npy'))
+        print ('Classes are: ', self.classes)
+
+        self._past_probs = None
+
+    def run(self, x_data):
+        outputs, _ = self.client.run(x_data)
+        return outputs["probabilities"]
+
+
+class FrozenArmMotionRecognition(RealTimeArmMotionRecognition):
+    """
+    Recognizes the motion of an arm with the frozen model exported by components.inference.export, which neither
+    builds the training graph nor restores the checkpoint
+    """
+    def __init__(self, arm, directory=None, config=None):
+        """
+        :param arm: 'left' or 'right', exported as arm_<arm>
+        :param directory: directory of the frozen models, see FrozenModel
+        :param config: tf.ConfigProto of the session, see FrozenModel
+        """
+        self.n_classes = 8
+        self.feature_size = 15
+        self.frozen = FrozenModel("arm_" + arm, directory, config)
+        # As the checkpoint, the graph has the fixed batch size it was exported with
+        self.batch_size = self.frozen.batch_size
+        self.classes = np.load(os.path.abspath('./data/labels_body.npy'))
+        print ('Classes are: ', self.classes)
+
+        self._past_probs = None
+
+    def _run_batch(self, x_data, n_frames):
+        return self.frozen.run("probabilities", {"x": x_data, "n_frames": n_frames, "keep_prob": 1.0})
@@ -6,7 +6,8 @@ os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 
 
 class Arms_LSTM:
-    def __init__(self, logs_path, cell_type='lstm', n_hidden=30, n_classes=8, batch_size=1, features=15, n_layers=2):
+    def __init__(self, logs_path, cell_type='lstm', n_hidden=30, n_classes=8, batch_size=1, features=15, n_layers=2,
+                 config=None):
 
         self.logs_path = logs_path
         self.n_hidden = n_hidden
@@ -78,10 +79,12 @@ class Arms_LSTM:
             self.probabilities = prediction
             self.predicted_values = tf.argmax(prediction, 1)
 
-        gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.2)
-        self.config = tf.ConfigProto(gpu_options=gpu_options)
-        #self.config.gpu_options.allow_growth = True
-        #self.config.allow_soft_placement = True
+        if config is None:
+            gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.2)
+            config = tf.ConfigProto(gpu_options=gpu_options)
+            #config.gpu_options.allow_growth = True
+            #config.allow_soft_placement = True
+        self.config = config
 
         self.sess = tf.Session(config=self.config)
 
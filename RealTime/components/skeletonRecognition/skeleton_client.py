@@ -1,14 +1,19 @@
 from __future__ import print_function
 
 import sys
-import time
 import struct
 import argparse
 
 from ..fusion.conf import streams
+from ..fusion.conf import codecs
 from ..fusion.conf.endpoints import connect
-from .Armsolver import PrimalRecognition, ArmMotionRecogntion
+from .Armsolver import PrimalRecognition, ArmMotionRecogntion, arm_model
 from ..fusion.conf import decode
+from ..fusion.conf import metrics
+from ..fusion.conf import trace
+from ..fusion.conf import startup as startup_conf
+from ..fusion.conf.reader import FrameReader
+from ..inference import client as inference
 
 def decode_content(raw_frame, offset):
     """
@@ -48,67 +53,87 @@ if __name__ == '__main__':
     parser.add_argument('--fusion-host', help='Fusion host name', type=str, default='127.0.0.1')
     parser.add_argument('--pointing-mode', default='screen', help='Pointing mode, default set to screen', type=str)
     parser.add_argument('--model', help='Choose between backend models for motion recognition, "primal" or "LSTM"', default="LSTM")
+    metrics.add_arguments(parser)
+    trace.add_arguments(parser)
+    inference.add_arguments(parser)
+    startup_conf.add_arguments(parser)
 
     args = parser.parse_args()
+    metrics.from_arguments("skeleton_client", args)
+    trace.from_arguments("skeleton_client", args)
     kinect_host, fusion_host, pointing_mode = args.kinect_host, args.fusion_host, args.pointing_mode
 
 
-    s = connect('kinect', kinect_host, 'Body')
-
-    if fusion_host is not None:
-        fusion_socket = connect('fusion', fusion_host, 'Body')
+    startup = startup_conf.from_arguments("skeleton_client", args)
+    if args.model == "LSTM":
+        # Both arm models load concurrently
+        arms = [startup.warm_up(arm + " warm-up",
+                                startup.task(arm + " arm", arm_model, arm, *inference.from_arguments(args), args.frozen))
+                for arm in ('left', 'right')]
     else:
-        fusion_socket = None
+        arms = []
+    # Kinect streams the frames right away, so it is connected once they can be processed
+    kinect = startup.connect("kinect", connect, 'kinect', kinect_host, 'Body', after=arms)
+    fusion = startup.connect("fusion", connect, 'fusion', fusion_host, 'Body') if fusion_host is not None else None
+    startup.wait()
 
+    s = kinect.result()
+    fusion_socket = fusion.result() if fusion is not None else None
 
     if s is None:
         sys.exit(0)
 
+    kinect_reader = FrameReader(s)
+
+    body_stream_id = streams.get_stream_id("Body")
+    body_encoder = codecs.get_codec(body_stream_id).encoder()
+
     if args.model == "LSTM":
-        m = ArmMotionRecogntion(pointing_mode='screen')
+        m = ArmMotionRecogntion('screen', loaded_models=[arm.result() for arm in arms])
     else:
         m = PrimalRecognition(pointing_mode='screen')
-    c = 0
-    start_time = time.time()
+    frames = metrics.counter("frames")
+    # Printed by the metrics reporter rather than for every frame
+    arm_motions = metrics.gauge("arm_motion", arm="left"), metrics.gauge("arm_motion", arm="right")
+    points = metrics.gauge("point", arm="left"), metrics.gauge("point", arm="right")
 
     while True:
+        # Includes waiting for the frame
+        read_start = trace.now()
         try:
-            (timestamp, frame_type), (tracked_body_count, engaged, frame_pieces), (writer_data,) = decode.read_frame(s, decode_content)
+            (timestamp, frame_type), (tracked_body_count, engaged, frame_pieces), (writer_data,) = decode.read_frame(kinect_reader, decode_content)
         except EOFError:
             print("Disconnected from Kinect Server")
             break
+        trace.record("read_frame", timestamp, read_start)
         
         #Pass this to the Recognition object
-        fd = (timestamp, frame_type, tracked_body_count, engaged) + frame_pieces
-        m.feed_input(fd)
-        result = m.get_result()
+        with trace.span("recognize", timestamp):
+            fd = (timestamp, frame_type, tracked_body_count, engaged) + frame_pieces
+            m.feed_input(fd)
+            result = m.get_result()
         timestamp = m.timestamp
         
 
         display_result = m.printable_result()
         if display_result is not None:
-            print('LPOINT', '{:> 7.3}'.format(m.point.lpoint[0]), '{:> 7.3}'.format(m.point.lpoint[1]),
-                  'RPOINT', '{:> 7.3}'.format(m.point.rpoint[0]), '{:> 7.3}'.format(m.point.rpoint[1]),
-                  '{:24}'.format(display_result[0]), '{:24}'.format(display_result[1]))
+            points[0].set('{:.3}, {:.3}'.format(m.point.lpoint[0], m.point.lpoint[1]))
+            points[1].set('{:.3}, {:.3}'.format(m.point.rpoint[0], m.point.rpoint[1]))
+            arm_motions[0].set(display_result[0])
+            arm_motions[1].set(display_result[1])
 
-        pack_list = [streams.get_stream_id("Body"), timestamp] + result
-        raw_data = struct.pack("<iqii" + "ffff" * 2 + "ff" * 8 + 'i', *pack_list)
+        raw_data = body_encoder.encode(body_stream_id, timestamp, *result)
 
         if fusion_socket is not None:
-            fusion_socket.sendall(struct.pack("<i", len(raw_data)))
-            fusion_socket.sendall(raw_data)
+            with trace.span("send", timestamp):
+                fusion_socket.sendall(raw_data)
 
-        c += 1
-        if c % 100 == 0:
-            print()
-            print ('=' * 30)
-            print ('FPS: ', 100.0 / (time.time() - start_time))
-            print ('=' * 30)
-            start_time = time.time()
+        frames.inc()
 
     s.close()
     if fusion_socket is not None:
         fusion_socket.close()
+    trace.disable()
 
     sys.exit(0)
 
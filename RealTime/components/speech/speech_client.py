@@ -4,6 +4,8 @@ import socket
 
 from ..fusion.conf.endpoints import connect
 from ..fusion.conf import decode
+from ..fusion.conf.reader import FrameReader
+from ..fusion.conf import codecs
 
 # Timestamp | frame type | command_length | command
 
@@ -40,11 +42,14 @@ if __name__ == '__main__':
     if k is None:
         sys.exit(0)
 
+    kinect_reader = FrameReader(k, size=1024)
+
     f = connect('fusion', args.fusion_host, 'Speech') if args.fusion_host is not None else None
+    speech_encoder = codecs.get_codec_by_name('Speech').encoder()
 
     while True:
         try:
-            (timestamp, frame_type), (command_length, command), (writer_data,) = decode.read_frame(k, decode_content)
+            (timestamp, frame_type), (command_length, command), (writer_data,) = decode.read_frame(kinect_reader, decode_content)
             #print("writer_data", writer_data)
         except socket.error:
             print("Unable to receive speech frame")
@@ -57,8 +62,7 @@ if __name__ == '__main__':
         if f is not None:
             try:
                 # Excluding frame size
-                raw_data = struct.pack("<iqi" + str(len(command)) + "s", frame_type, timestamp, len(command), command.encode('ascii'))
-                f.sendall(struct.pack("<i", len(raw_data)))
+                raw_data = speech_encoder.encode(frame_type, timestamp, command.encode('ascii'))
                 f.sendall(raw_data)
 
             except socket.error: